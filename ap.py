@@ -1,13 +1,48 @@
 import os
 import json
+import queue
+import random
+import atexit
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import time
 import base64
+import bisect
+import gzip
 import hashlib
+import heapq
+import hmac
+import ipaddress
+import math
+import mimetypes
+import re
 import secrets
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import zlib
+from array import array
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Без Pillow уменьшенные копии не создаются
+    Image = ImageOps = None
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from operator import xor
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect, url_for
+from flask import Flask, Response, abort, render_template, request, jsonify, send_file, session, redirect, url_for, stream_with_context
 from flask_cors import CORS
 from functools import wraps
+from werkzeug.security import safe_join
+from itertools import islice
 import uuid
 
 app = Flask(__name__, template_folder='.', static_folder='static')
@@ -25,24 +60,670 @@ os.makedirs(os.path.join(MEDIA_FOLDER, 'videos'), exist_ok=True)
 os.makedirs(os.path.join(MEDIA_FOLDER, 'images'), exist_ok=True)
 os.makedirs(os.path.join(MEDIA_FOLDER, 'stories'), exist_ok=True)
 os.makedirs(os.path.join(MEDIA_FOLDER, 'avatars'), exist_ok=True)
+BLOB_FOLDER = os.path.join(MEDIA_FOLDER, 'blobs')  # Файлы по хэшу содержимого: blobs/ab/cd/<sha256>.<ext>
+os.makedirs(os.path.join(BLOB_FOLDER, 'tmp'), exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
+app.config['USE_X_SENDFILE'] = False  # True — файлы отдает фронтенд-сервер (X-Sendfile)
+
+# Раздача медиа
+MEDIA_MAX_AGE = 300                        # Cache-Control для изменяемых имен (секунды)
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # Для имен по хэшу содержимого
+MEDIA_ETAG_HASH_LIMIT = 16 * 1024 * 1024   # Файлы больше — ETag по размеру и времени изменения
+MEDIA_ETAG_CACHE_SIZE = 10000
+CONTENT_ADDRESSED_RE = re.compile(r'^[0-9a-f]{32,128}(\.[A-Za-z0-9]+)?$')
+
+# Загрузка файлов
+UPLOAD_CHUNK_SIZE = 1024 * 1024   # Тело запроса читается и хэшируется частями
+BLOB_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "webp", "mp4", "webm", "mov", "mp3", "ogg", "m4a"}
+BLOB_ORPHAN_TTL = 24 * 3600       # Файлы без ссылок удаляются не раньше (секунды)
+BLOB_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Домашние ленты
+FEED_TIMELINE_LENGTH = 500    # Постов в заранее собранной ленте пользователя
+FEED_FANOUT_LIMIT = 5000      # Посты авторов с большим числом подписчиков подмешиваются при чтении
+FEED_BACKFILL = 50            # Последних постов автора добавляется в ленту при подписке
+FEED_FETCH_SIZE = 100         # Строк за одно чтение ленты
+FEED_PAGE_SIZE = 20
+FEED_MAX_PAGE_SIZE = 100
+
+# Загрузка частями с докачкой
+UPLOAD_MAX_SIZE = 2 * 1024 * 1024 * 1024  # Максимальный размер файла
+UPLOAD_PART_SIZE = 8 * 1024 * 1024        # Рекомендуемый размер части (меньше MAX_CONTENT_LENGTH)
+UPLOAD_SESSION_TTL = 24 * 3600            # Сессия без активности удаляется (секунды)
+UPLOAD_LEASE = 300                        # Максимальное время записи одной части (секунды)
+UPLOAD_MAX_SESSIONS = 5                   # Незавершенных загрузок на пользователя
+
+# Уменьшенные копии изображений и кадры-обложки видео
+MEDIA_VARIANT_SIZES = {"small": 320, "medium": 720, "large": 1280}  # ?size= -> наибольшая сторона
+MEDIA_VARIANT_QUALITY = 85
+MEDIA_IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "webp"}
+MEDIA_VIDEO_EXTENSIONS = {"mp4", "webm", "mov"}
+MEDIA_POSTER_OFFSET = 1.0         # Секунда видео для обложки
+MEDIA_WORKERS = 1                 # Процессов обработки при запуске сервера (0 — запускать отдельно)
+MEDIA_JOB_TIMEOUT = 120           # Максимум секунд на одну задачу
+MEDIA_JOB_MAX_ATTEMPTS = 3
+MEDIA_JOB_RETRY_DELAY = 30        # Задержка перед повтором, удваивается с каждой попыткой
+MEDIA_POLL_INTERVAL = 1.0         # Пауза воркера, когда задач нет (секунды)
 
 # Конфигурация безопасности
 MAX_REQUESTS_PER_MINUTE = 60  # Максимум запросов в минуту
 MAX_COMMENTS_PER_HOUR = 20    # Максимум комментариев в час
 MAX_POSTS_PER_DAY = 10        # Максимум постов в день
+MAX_UPLOADS_PER_HOUR = 30     # Максимум загрузок файлов в час
 MIN_PASSWORD_LENGTH = 8       # Минимальная длина пароля
 
-# JSON база данных
-DB_FILE = 'database.json'
+# Хэширование паролей
+PASSWORD_SCHEME = 'scrypt'        # 'scrypt' или 'pbkdf2_sha256' для новых хэшей
+PASSWORD_SCRYPT_N = 2 ** 14       # Стоимость scrypt (память 128 * N * r байт)
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+PASSWORD_PBKDF2_ITERATIONS = 600000
+PASSWORD_WORKERS = min(4, os.cpu_count() or 1)  # Потоков для вычисления хэшей
+PASSWORD_CACHE_SIZE = 1024        # Успешных проверок в кэше
+PASSWORD_CACHE_TTL = 300          # Время жизни записи кэша (секунды)
+
+# Лимиты запросов: тип -> (максимум, окно в секундах)
+RATE_LIMITS = {
+    "requests": (MAX_REQUESTS_PER_MINUTE, 60),
+    "comments": (MAX_COMMENTS_PER_HOUR, 3600),
+    "posts": (MAX_POSTS_PER_DAY, 86400),
+    "uploads": (MAX_UPLOADS_PER_HOUR, 3600)
+}
+RATE_LIMIT_CLEANUP_INTERVAL = 60  # Как часто удалять неактивные IP (секунды)
+RATE_LIMIT_FILE = 'ratelimits.sqlite3'  # Общие счетчики для всех воркеров
+RATE_LIMIT_SHARED = True          # Делить лимиты между процессами
+RATE_LIMIT_LOCAL_SHARE = 0.1      # Доля оставшегося лимита, расходуемая без синхронизации
+RATE_LIMIT_SYNC_INTERVAL = 1.0    # Максимальный возраст локальной копии счетчиков (секунды)
+BAN_RELOAD_INTERVAL = 1.0         # Как часто проверять изменения bans.json (секунды)
+BAN_JOURNAL_COMPACT_EVERY = 500   # Операций в журнале банов до записи нового снимка
+
+# Спам-фильтр
+SPAM_KEYWORDS_FILE = 'spam_keywords.json'  # {"слово": вес} или ["слово", ...]; перечитывается при изменении
+SPAM_RELOAD_INTERVAL = 1.0                 # Как часто проверять изменения файла (секунды)
+SPAM_SCORE_THRESHOLD = 3                   # Больше этого числа баллов - спам
+DEFAULT_SPAM_KEYWORDS = [
+    "купить", "продать", "заработок", "бинарные", "крипта",
+    "казино", "ставки", "халява", "бесплатно", "реклама",
+    "http://", "https://", "www.", ".ru", ".com",
+    "прибыль", "инвестиции", "деньги", "быстро", "легко"
+]
+SPAM_LINK_MARKERS = ("http://", "https://", "www.")
+SPAM_REPEAT_MARKERS = ("!!!!!", "?????", "......")
+DUPLICATE_WINDOW = 3600          # Окно поиска почти одинаковых сообщений (секунды)
+DUPLICATE_MAX_DISTANCE = 6       # Максимум отличающихся бит SimHash у дубликатов
+DUPLICATE_INDEX_SIZE = 50000     # Максимум отпечатков в памяти
+DUPLICATE_MIN_WORDS = 6          # Более короткие тексты не проверяются
+DUPLICATE_ACTION = 'reject'      # 'reject' — отклонять, 'flag' — публиковать с репортом
+STREAM_CHUNK_SIZE = 64 * 1024   # Размер частей потоковых ответов (format=ndjson / stream)
+EXPORT_FETCH_SIZE = 1000        # Строк за одно чтение при экспорте
+IMPORT_BATCH_SIZE = 1000        # Записей в одной пачке вставки при импорте
+RESCAN_CHECKPOINT_FILE = os.path.join(LOGS_FOLDER, 'rescan_checkpoint.json')
+RESCAN_CHUNK_SIZE = 500      # Записей в одной пачке для воркера
+RESCAN_PROCESSES = None      # Число процессов (None — по числу ядер, 0 — без пула)
+
+# База данных
+STORAGE_FILE = 'database.sqlite3'  # SQLite хранилище (WAL)
+DB_FILE = 'database.json'          # Старая JSON база, импортируется один раз
 BANS_FILE = 'bans.json'
 LOGS_FILE = os.path.join(LOGS_FOLDER, 'activity.log')
+ADMIN_LOGS_RETENTION = 100000  # Сколько последних записей журнала хранится
+
+# Фоновая запись журнала активности
+LOG_QUEUE_SIZE = 10000        # Максимум записей в очереди
+LOG_QUEUE_POLICY = 'drop'     # 'drop' — отбрасывать при переполнении, 'block' — ждать места
+LOG_BATCH_SIZE = 500          # Максимум записей в одной пачке
+LOG_FLUSH_INTERVAL = 0.5      # Секунд ожидания новых записей перед записью пачки
+
+# Сводная статистика по дням и часам
+ROLLUP_METRICS = {"users": "registrations", "posts": "posts", "comments": "comments"}  # коллекция -> счетчик
+ROLLUP_HLL_PRECISION = 10     # 2^10 регистров HyperLogLog (погрешность ~3%)
+
+# Коллекции, которые хранятся построчно в собственных таблицах
+STORAGE_TABLES = ("users", "posts", "videos", "comments", "reports", "notifications", "admin_logs")
+# Журналы: хранятся в таблицах, но не входят в собранную базу
+LOG_TABLES = ("admin_logs",)
+# Коллекции, в которых новые записи идут в начало списка
+NEWEST_FIRST = ("posts",)
+# Остальные разделы базы хранятся целиком как JSON документы
+DOCUMENT_SECTIONS = ("clans", "stories", "live_streams", "messages", "system_settings")
+
+# ==================== ХРАНИЛИЩЕ ====================
+
+class Storage:
+    """SQLite хранилище в режиме WAL с построчными операциями"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        self._depth = 0
+    
+    def connect(self):
+        with self.lock:
+            # Соединение не наследуется после fork: у каждого воркера своё
+            if self._conn is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._depth = 0
+                conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                self._create_schema(conn)
+                self._conn = conn
+            return self._conn
+    
+    def _create_schema(self, conn):
+        for table in STORAGE_TABLES:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT UNIQUE,
+                    user_id TEXT,
+                    created_at TEXT,
+                    data TEXT NOT NULL
+                )""")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_id ON {table} (user_id)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_created_at ON {table} (created_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        # Сводная статистика: bucket — день (YYYY-MM-DD), час (YYYY-MM-DDTHH) или 'all'
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rollups (
+                bucket TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                value INTEGER NOT NULL,
+                PRIMARY KEY (bucket, metric)
+            )""")
+        conn.execute("CREATE TABLE IF NOT EXISTS rollup_users (bucket TEXT PRIMARY KEY, registers BLOB NOT NULL)")
+        # Загруженные файлы: refs — число записей, ссылающихся на файл
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                ext TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                content_type TEXT,
+                refs INTEGER NOT NULL DEFAULT 0,
+                touched_at TEXT NOT NULL
+            )""")
+        # Очередь обработки медиа: одна задача на исходный файл (путь внутри media/)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS media_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source TEXT UNIQUE NOT NULL,
+                status TEXT NOT NULL,
+                progress INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                run_after REAL NOT NULL,
+                lease_until REAL,
+                updated_at TEXT NOT NULL,
+                params TEXT
+            )""")
+        if "params" not in {row[1] for row in conn.execute("PRAGMA table_info(media_jobs)")}:
+            conn.execute("ALTER TABLE media_jobs ADD COLUMN params TEXT")  # Параметры фоновых задач
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_media_jobs_status ON media_jobs (status, run_after)")
+        # Ленты: посты подписок каждого пользователя по убыванию (created_at, post_id)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS timelines (
+                user_id TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                post_id TEXT NOT NULL,
+                author_id TEXT NOT NULL,
+                PRIMARY KEY (user_id, created_at, post_id)
+            ) WITHOUT ROWID""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_timelines_post_id ON timelines (post_id)")
+        # Незавершенные загрузки частями; данные — в UPLOAD_FOLDER/<id>.part
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                content_type TEXT,
+                size INTEGER NOT NULL,
+                received INTEGER NOT NULL DEFAULT 0,
+                sha256 TEXT,
+                lease_until REAL,
+                expires_at REAL NOT NULL,
+                created_at TEXT NOT NULL
+            )""")
+    
+    @contextmanager
+    def transaction(self):
+        """Транзакция; вложенные вызовы выполняются внутри внешней"""
+        with defer_activity_log(), self.lock:
+            conn = self.connect()
+            if self._depth > 0:
+                self._depth += 1
+                try:
+                    yield conn
+                finally:
+                    self._depth -= 1
+                return
+            
+            conn.execute("BEGIN IMMEDIATE")
+            self._depth = 1
+            try:
+                yield conn
+            except BaseException:
+                self._depth = 0
+                conn.execute("ROLLBACK")
+                raise
+            self._depth = 0
+            conn.execute("COMMIT")
+    
+    @staticmethod
+    def _row(record):
+        user_id = record.get("userId", record.get("user_id"))
+        created_at = record.get("createdAt", record.get("timestamp"))
+        return (record.get("id"), user_id, created_at, json.dumps(record, ensure_ascii=False))
+    
+    def close(self):
+        with self.lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+    
+    def data_version(self):
+        """Меняется, когда другое соединение (процесс) фиксирует изменения"""
+        with self.lock:
+            return self.connect().execute("PRAGMA data_version").fetchone()[0]
+    
+    def is_initialized(self):
+        with self.lock:
+            row = self.connect().execute("SELECT 1 FROM documents WHERE key = 'system_settings'").fetchone()
+            return row is not None
+    
+    def load_document(self):
+        """Сборка всей базы в виде словаря (формат database.json)"""
+        with self.lock:
+            conn = self.connect()
+            data = {}
+            for table in STORAGE_TABLES:
+                if table in LOG_TABLES:
+                    continue
+                order = "DESC" if table in NEWEST_FIRST else "ASC"
+                rows = conn.execute(f"SELECT data FROM {table} ORDER BY seq {order}")
+                data[table] = [json.loads(row[0]) for row in rows]
+            for key, value in conn.execute("SELECT key, data FROM documents"):
+                data[key] = json.loads(value)
+            return data
+    
+    def replace_document(self, data):
+        """Полная замена содержимого базы"""
+        with self.transaction() as conn:
+            for table in STORAGE_TABLES:
+                if table in LOG_TABLES and table not in data:
+                    continue  # Журнал не входит в собранную базу
+                conn.execute(f"DELETE FROM {table}")
+                records = data.get(table, [])
+                if table in NEWEST_FIRST:
+                    records = reversed(records)
+                self.insert_many(table, records)
+            conn.execute("DELETE FROM documents")
+            conn.execute("DELETE FROM rollups WHERE bucket = 'all' AND metric = 'backfilled'")  # Пересчитать сводку
+            conn.execute("DELETE FROM timelines")  # Ленты собираются заново
+            for key, value in data.items():
+                if key not in STORAGE_TABLES:
+                    self.set_document(key, value)
+    
+    def insert(self, collection, record):
+        with self.transaction() as conn:
+            conn.execute(f"INSERT INTO {collection} (id, user_id, created_at, data) VALUES (?, ?, ?, ?)",
+                         self._row(record))
+    
+    def insert_many(self, collection, records, replace=False):
+        """replace — обновлять записи с тем же id (на прежнем месте)"""
+        upsert = """ ON CONFLICT (id) DO UPDATE SET
+            user_id = excluded.user_id, created_at = excluded.created_at, data = excluded.data""" if replace else ""
+        with self.transaction() as conn:
+            conn.executemany(f"INSERT INTO {collection} (id, user_id, created_at, data) VALUES (?, ?, ?, ?)" + upsert,
+                             (self._row(r) for r in records))
+    
+    def get(self, collection, record_id):
+        """Сохранённая версия записи (до изменения в памяти)"""
+        with self.lock:
+            row = self.connect().execute(f"SELECT data FROM {collection} WHERE id = ?", (record_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def update(self, collection, record):
+        record_id, user_id, created_at, data = self._row(record)
+        with self.transaction() as conn:
+            conn.execute(f"UPDATE {collection} SET user_id = ?, created_at = ?, data = ? WHERE id = ?",
+                         (user_id, created_at, data, record_id))
+    
+    def delete(self, collection, record_id):
+        with self.transaction() as conn:
+            conn.execute(f"DELETE FROM {collection} WHERE id = ?", (record_id,))
+    
+    def trim(self, collection, keep):
+        """Оставляет только последние keep записей коллекции"""
+        with self.transaction() as conn:
+            conn.execute(f"DELETE FROM {collection} WHERE seq <= (SELECT MAX(seq) FROM {collection}) - ?", (keep,))
+    
+    def rows_after(self, collection, seq, limit=None):
+        """Строки (seq, запись) с номером больше seq — чтение журналов по мере роста"""
+        with self.lock:
+            if limit:
+                # Только последние limit строк
+                rows = self.connect().execute(
+                    f"SELECT seq, data FROM {collection} WHERE seq > ? ORDER BY seq DESC LIMIT ?", (seq, limit)
+                ).fetchall()[::-1]
+            else:
+                rows = self.connect().execute(
+                    f"SELECT seq, data FROM {collection} WHERE seq > ? ORDER BY seq", (seq,)
+                ).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+    
+    @contextmanager
+    def snapshot(self):
+        """Отдельное соединение с согласованным снимком для долгого чтения.
+        
+        В режиме WAL читатель видит базу на момент первого запроса
+        и не блокирует запись.
+        """
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        try:
+            conn.execute("BEGIN")
+            conn.execute("SELECT 1 FROM documents LIMIT 1").fetchall()  # Фиксирует снимок
+            yield conn
+        finally:
+            conn.execute("ROLLBACK")
+            conn.close()
+    
+    def set_document(self, key, value):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO documents (key, data) VALUES (?, ?)",
+                         (key, json.dumps(value, ensure_ascii=False)))
+
+storage = Storage(STORAGE_FILE)
+
+class TopK:
+    """K записей с наибольшей оценкой: словарь оценок и куча с ленивым удалением.
+    
+    При изменении оценки в кучу добавляется новый элемент, устаревшие
+    отбрасываются при чтении вершины. Одинаковые оценки упорядочены
+    как в исходном списке.
+    """
+    def __init__(self, k, score_of):
+        self.k = k
+        self.score_of = score_of
+        self.scores = {}    # id -> (оценка, порядок)
+        self.records = {}
+        self.heap = []      # (-оценка, порядок, id)
+        self.first = 0      # порядок для записей, добавленных в начало списка
+        self.last = 0
+    
+    def set(self, record, front=False, keep_heap=True):
+        record_id = record["id"]
+        current = self.scores.get(record_id)
+        if current:
+            order = current[1]
+        elif front:
+            self.first -= 1
+            order = self.first
+        else:
+            self.last += 1
+            order = self.last
+        entry = (self.score_of(record), order)
+        self.records[record_id] = record
+        if entry != current:
+            self.scores[record_id] = entry
+            if keep_heap:
+                heapq.heappush(self.heap, (-entry[0], order, record_id))
+                if len(self.heap) > 2 * len(self.scores) + self.k:
+                    self.rebuild()
+    
+    def discard(self, record_id):
+        self.scores.pop(record_id, None)
+        self.records.pop(record_id, None)
+    
+    def rebuild(self):
+        self.heap = [(-score, order, record_id) for record_id, (score, order) in self.scores.items()]
+        heapq.heapify(self.heap)
+    
+    def top(self):
+        result, valid, seen = [], [], set()
+        while self.heap and len(result) < self.k:
+            entry = heapq.heappop(self.heap)
+            score, order, record_id = -entry[0], entry[1], entry[2]
+            if record_id not in seen and self.scores.get(record_id) == (score, order):
+                seen.add(record_id)
+                valid.append(entry)
+                result.append(self.records[record_id])
+        for entry in valid:
+            heapq.heappush(self.heap, entry)
+        return result
+
+class DashboardMetrics:
+    """Счетчики дашборда, обновляемые при каждой записи"""
+    def __init__(self):
+        self.popular_posts = TopK(10, lambda p: len(p.get("likes", [])))
+        self.popular_videos = TopK(10, lambda v: v.get("views", 0))
+        self.report_status = {}  # id -> статус
+        self.reports_pending = 0
+        self.story_times = []    # createdAt историй по возрастанию
+        self.active_live = 0
+    
+    def add(self, collection, record, front=False, keep_heap=True):
+        if collection == "posts":
+            self.popular_posts.set(record, front, keep_heap)
+        elif collection == "videos":
+            self.popular_videos.set(record, front, keep_heap)
+        elif collection == "reports":
+            self._set_report_status(record["id"], record.get("status"))
+    
+    def remove(self, collection, record):
+        if collection == "posts":
+            self.popular_posts.discard(record["id"])
+        elif collection == "videos":
+            self.popular_videos.discard(record["id"])
+        elif collection == "reports":
+            self._set_report_status(record["id"], None)
+    
+    def update(self, collection, record):
+        if collection in ("posts", "videos", "reports"):
+            self.add(collection, record)
+    
+    def set_section(self, key, value):
+        if key == "stories":
+            self.story_times = sorted(s["createdAt"] for s in value)
+        elif key == "live_streams":
+            self.active_live = len([s for s in value if s.get("active", False)])
+    
+    def rebuild(self):
+        self.popular_posts.rebuild()
+        self.popular_videos.rebuild()
+    
+    def _set_report_status(self, report_id, status):
+        old = self.report_status.pop(report_id, None)
+        if status is not None:
+            self.report_status[report_id] = status
+        self.reports_pending += (status == "pending") - (old == "pending")
+    
+    def active_stories(self):
+        """Истории за последние 24 часа; более старые больше не понадобятся"""
+        cutoff = (datetime.now() - timedelta(hours=24)).isoformat()
+        expired = bisect.bisect_right(self.story_times, cutoff)
+        del self.story_times[:expired]
+        return len(self.story_times)
+
+class DatabaseIndex:
+    """Хэш-индексы id -> запись и username/email -> пользователь"""
+    COLLECTIONS = ("users", "posts", "videos", "clans", "comments", "reports", "notifications")
+    SORTED = ("users", "posts", "comments")  # Упорядочены по (createdAt, id) для курсорной пагинации
+    
+    def __init__(self, db):
+        self.by_id = {collection: {} for collection in self.COLLECTIONS}
+        self.by_username = {}
+        self.by_email = {}
+        self.user_keys = {}  # id -> (username, email) для переиндексации
+        self.sort_keys = {collection: {} for collection in self.SORTED}  # id -> ключ сортировки
+        self.reports_by_target = {}
+        self.metrics = DashboardMetrics()
+        for collection in self.COLLECTIONS:
+            for record in db.get(collection, []):
+                self.add(collection, record, keep_sorted=False)
+        self.sorted = {collection: sorted(self.sort_keys[collection].values()) for collection in self.SORTED}
+        self.metrics.rebuild()
+        for key in ("stories", "live_streams"):
+            self.metrics.set_section(key, db.get(key, []))
+    
+    def add(self, collection, record, keep_sorted=True):
+        if collection not in self.by_id or "id" not in record:
+            return
+        self.by_id[collection].setdefault(record["id"], record)
+        self.metrics.add(collection, record, front=keep_sorted and collection in NEWEST_FIRST, keep_heap=keep_sorted)
+        if collection == "users":
+            self._add_user_keys(record)
+        elif collection == "reports":
+            self.reports_by_target.setdefault(record.get("targetId"), []).append(record)
+        if collection in self.SORTED and record["id"] not in self.sort_keys[collection]:
+            key = sort_key(record)
+            self.sort_keys[collection][record["id"]] = key
+            if keep_sorted:
+                bisect.insort(self.sorted[collection], key)
+    
+    def remove(self, collection, record):
+        if collection not in self.by_id or "id" not in record:
+            return
+        if self.by_id[collection].get(record["id"]) is record:
+            del self.by_id[collection][record["id"]]
+            self.metrics.remove(collection, record)
+        if collection == "users":
+            self._remove_user_keys(record)
+        elif collection == "reports":
+            reports = self.reports_by_target.get(record.get("targetId"), [])
+            if record in reports:
+                reports.remove(record)
+        if collection in self.SORTED:
+            self._remove_sort_key(collection, record["id"])
+    
+    def update(self, collection, record):
+        self.metrics.update(collection, record)
+        if collection == "users":
+            self._remove_user_keys(record)
+            self._add_user_keys(record)
+        if collection in self.SORTED and self.sort_keys[collection].get(record["id"]) != sort_key(record):
+            self._remove_sort_key(collection, record["id"])
+            key = sort_key(record)
+            self.sort_keys[collection][record["id"]] = key
+            bisect.insort(self.sorted[collection], key)
+    
+    def count_since(self, collection, since):
+        """Число записей с createdAt позже since"""
+        keys = self.sorted[collection]
+        return len(keys) - bisect.bisect_right(keys, (since,))
+    
+    def _remove_sort_key(self, collection, record_id):
+        key = self.sort_keys[collection].pop(record_id, None)
+        keys = self.sorted[collection]
+        i = bisect.bisect_left(keys, key) if key else len(keys)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+    
+    def _add_user_keys(self, user):
+        username, email = user.get("username"), user.get("email")
+        self.by_username.setdefault(username, user)
+        self.by_email.setdefault(email, user)
+        self.user_keys[user["id"]] = (username, email)
+    
+    def _remove_user_keys(self, user):
+        username, email = self.user_keys.pop(user["id"], (None, None))
+        if self.by_username.get(username) is user:
+            del self.by_username[username]
+        if self.by_email.get(email) is user:
+            del self.by_email[email]
+
+class DocumentCache:
+    """Собранная база в памяти процесса со сквозной записью.
+    
+    Перечитывается только когда другой процесс зафиксировал изменения
+    (PRAGMA data_version), поэтому несколько воркеров с общим файлом видят
+    изменения друг друга, а собственные записи кэш не сбрасывают.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        # Общая с хранилищем блокировка: иначе запись внутри транзакции
+        # и фоновая запись журнала захватывают их в разном порядке
+        self.lock = storage.lock
+        self.data = None
+        self.index = None
+        self.stamp = None
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self):
+        with self.lock:
+            stamp = self.storage.data_version()
+            if self.data is not None and stamp == self.stamp:
+                self.hits += 1
+                return self.data
+            
+            self.misses += 1
+            self.data = self.storage.load_document()
+            self.index = DatabaseIndex(self.data)
+            self.stamp = stamp
+            return self.data
+    
+    @contextmanager
+    def writing(self, db=None):
+        """Запись в хранилище с обновлением кэша.
+        
+        Отдаёт закэшированную базу, если она актуальна (и совпадает с db,
+        если он передан), иначе None — тогда после записи кэш сбрасывается.
+        """
+        with self.lock:
+            fresh = self.data is not None and self.storage.data_version() == self.stamp
+            if db is not None and db is not self.data:
+                fresh = False
+            try:
+                yield self.data if fresh else None
+            except BaseException:
+                self.invalidate()
+                raise
+            if not fresh:
+                self.invalidate()
+    
+    def replace(self, data, stamp):
+        """Замена собранной базы; stamp — data_version до записи"""
+        with self.lock:
+            self.data = data
+            self.index = DatabaseIndex(data)
+            self.stamp = stamp
+    
+    def invalidate(self):
+        with self.lock:
+            self.data = None
+            self.index = None
+            self.stamp = None
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+document_cache = DocumentCache(storage)
+
+def migrate_json_database(path=DB_FILE):
+    """Одноразовый импорт database.json в SQLite хранилище"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    
+    for key in STORAGE_TABLES:
+        data.setdefault(key, [])
+    data["admin_logs"] = data["admin_logs"][-ADMIN_LOGS_RETENTION:]
+    data.setdefault("system_settings", {})
+    
+    storage.replace_document(data)
+    os.replace(path, path + '.migrated')  # Повторно не импортируем
+    return {key: len(data[key]) for key in STORAGE_TABLES}
 
 # Инициализация базы данных
 def init_database():
-    if not os.path.exists(DB_FILE):
+    if not storage.is_initialized():
         default_data = {
             "users": [],
             "posts": [],
@@ -60,7 +741,6 @@ def init_database():
             "messages": [],
             "notifications": [],
             "reports": [],
-            "admin_logs": [],
             "system_settings": {
                 "maintenance": False,
                 "registration_enabled": True,
@@ -69,12 +749,14 @@ def init_database():
                 "content_moderation": True
             }
         }
-        save_database(default_data)
+        if os.path.exists(DB_FILE):
+            migrate_json_database(DB_FILE)
+        else:
+            save_database(default_data)
     
     # Инициализация бананов
     if not os.path.exists(BANS_FILE):
-        with open(BANS_FILE, 'w') as f:
-            json.dump({"ip_bans": [], "user_bans": [], "temp_bans": {}}, f)
+        save_bans({"ip_bans": [], "user_bans": [], "temp_bans": {}})
     
     # Создаем первого администратора если нет пользователей
     db = load_database()
@@ -119,39 +801,1048 @@ def init_database():
             "login_attempts": 0,
             "status": "active"
         }
-        db["users"].append(admin_user)
-        save_database(db)
+        insert_record(db, "users", admin_user)
         log_activity("SYSTEM", "system", "Created default admin account", "127.0.0.1")
     
     return db
 
 def load_database():
-    try:
-        with open(DB_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
+    """База из кэша процесса. Общая для всех запросов — только для чтения,
+    изменения вносятся через построчные операции ниже внутри transaction().
+    Запросы читают её под document_cache.lock (read_locked, transactional)"""
+    db = document_cache.get()
+    if "system_settings" not in db:
         return init_database()
+    return db
+
+@contextmanager
+def transaction():
+    """Сериализованное изменение базы: отдаёт актуальную базу для чтения и записи.
+    
+    Между потоками процесса порядок задает общая блокировка кэша, между
+    процессами — блокировка записи SQLite (BEGIN IMMEDIATE, файловая).
+    Внутри транзакции база перечитывается, если её изменил другой процесс,
+    поэтому read-modify-write не теряет чужие изменения. При исключении
+    изменения откатываются, а кэш сбрасывается.
+    """
+    with defer_activity_log(), document_cache.lock:
+        try:
+            with storage.transaction():
+                yield load_database()
+        except BaseException:
+            document_cache.invalidate()
+            raise
+
+@contextmanager
+def read_snapshot():
+    """Согласованное чтение общей базы.
+    
+    Транзакция меняет записи закэшированной базы на месте и держит
+    document_cache.lock до фиксации (при откате кэш сбрасывается), поэтому
+    под этой блокировкой видно только зафиксированное состояние. Ответ
+    нужно сериализовать здесь же: записи и их списки общие с писателями.
+    """
+    with defer_activity_log(), document_cache.lock:
+        yield load_database()
+
+def read_locked(f):
+    """Запрос на чтение выполняется внутри read_snapshot()"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        with read_snapshot():
+            return f(*args, **kwargs)
+    return decorated_function
+
+def transactional(f):
+    """Изменяющие запросы (не GET) обрабатываются внутри transaction(), GET — внутри read_snapshot()"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method == 'GET':
+            with read_snapshot():
+                return f(*args, **kwargs)
+        with transaction():
+            return f(*args, **kwargs)
+    return decorated_function
 
 def save_database(data):
-    with open(DB_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Полная перезапись базы. Маршруты используют построчные операции ниже"""
+    with document_cache.lock:
+        stamp = storage.data_version()
+        storage.replace_document(data)
+        document_cache.replace(data, stamp)
+
+def sort_key(record):
+    """Стабильный ключ сортировки записей"""
+    return (record.get("createdAt") or "", record["id"])
+
+def get_index(db):
+    """Индексы базы, если db — закэшированная база процесса"""
+    if db is not None and db is document_cache.data:
+        return document_cache.index
+    return None
+
+# Построчные операции: изменяют загруженную базу, её индексы и строку хранилища
+def insert_record(db, collection, record):
+    with document_cache.writing(db), storage.transaction():
+        if collection in NEWEST_FIRST:
+            db[collection].insert(0, record)
+        else:
+            db[collection].append(record)
+        index = get_index(db)
+        if index:
+            index.add(collection, record)
+        storage.insert(collection, record)
+        if collection in ROLLUP_METRICS:
+            rollups.add(ROLLUP_METRICS[collection], record.get("createdAt"))
+        if collection in ("posts", "videos"):
+            rollups.add("likes", record.get("createdAt"), len(record.get("likes", [])))
+            blobs.retain(BlobStore.references(record))
+        if collection == "posts":
+            feeds.fan_out(db, record)
+
+def update_record(db, collection, record):
+    with document_cache.writing(db), storage.transaction():
+        index = get_index(db)
+        if index:
+            index.update(collection, record)
+        if collection in ("posts", "videos"):
+            # Лайки без времени: прирост относится к моменту изменения
+            stored = storage.get(collection, record["id"]) or {}
+            rollups.add("likes", datetime.now().isoformat(),
+                        len(record.get("likes", [])) - len(stored.get("likes", [])))
+            new_refs, old_refs = BlobStore.references(record), BlobStore.references(stored)
+            blobs.retain(new_refs - old_refs)
+            blobs.release(old_refs - new_refs)
+        storage.update(collection, record)
+
+def delete_record(db, collection, record_id):
+    with document_cache.writing(db), storage.transaction():
+        records = db[collection]
+        index = get_index(db)
+        for i, record in enumerate(records):
+            if record.get("id") == record_id:
+                del records[i]
+                if index:
+                    index.remove(collection, record)
+                if collection in ("posts", "videos"):
+                    # Лайки удалённой записи уходят только из общего итога
+                    rollups.add("likes", None, -len(record.get("likes", [])), total_only=True)
+                    blobs.release(BlobStore.references(record))
+                break
+        if collection == "posts":
+            feeds.remove_post(record_id)
+        elif collection == "users":
+            feeds.remove_user(record_id)
+        storage.delete(collection, record_id)
+
+def save_section(db, key):
+    with document_cache.writing(db):
+        index = get_index(db)
+        if index:
+            index.metrics.set_section(key, db[key])
+        storage.set_document(key, db[key])
 
-def load_bans():
+# Надёжная запись файлов
+def write_atomic(path, data, **dump_args):
+    """JSON во временный файл рядом с path, fsync и переименование.
+    
+    После сбоя на месте path остаётся либо старая, либо новая версия целиком.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, **dump_args)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if os.name != 'nt':
+        # Фиксируем само переименование в каталоге
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+@contextmanager
+def file_lock(path):
+    """Блокировка между процессами на файле path (flock, в Windows — msvcrt.locking)"""
+    with open(path, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK сдается через ~10 секунд — ждем дальше
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def load_bans(path=BANS_FILE):
+    """Снимок банов; отсутствующий файл — пустой список, поврежденный — ValueError"""
     try:
-        with open(BANS_FILE, 'r') as f:
+        with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
-    except:
+    except FileNotFoundError:
         return {"ip_bans": [], "user_bans": [], "temp_bans": {}}
 
-def save_bans(data):
-    with open(BANS_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+def save_bans(data, path=BANS_FILE):
+    write_atomic(path, data, indent=2)
 
 # Хэширование пароля
+class PasswordHasher:
+    """Версионированные хэши паролей.
+    
+    Форматы: scrypt$N$r$p$соль$хэш, pbkdf2_sha256$итерации$соль$хэш
+    и старый sha256 без соли (64 hex символа). Вычисления выполняются
+    в ограниченном пуле потоков (hashlib отпускает GIL), успешные
+    проверки ненадолго кэшируются по ключу HMAC от пароля.
+    """
+    def __init__(self, scheme=PASSWORD_SCHEME, workers=PASSWORD_WORKERS,
+                 cache_size=PASSWORD_CACHE_SIZE, cache_ttl=PASSWORD_CACHE_TTL):
+        self.scheme = scheme
+        self.workers = workers
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache = OrderedDict()  # ключ -> время проверки
+        self.cache_key = secrets.token_bytes(32)
+        self.lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+    
+    def pool(self):
+        # Потоки не переживают fork, пул создается заново в каждом процессе
+        with self.lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password")
+                self._pid = os.getpid()
+            return self._pool
+    
+    @staticmethod
+    def params(scheme):
+        if scheme == 'scrypt':
+            return [PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P]
+        return [PASSWORD_PBKDF2_ITERATIONS]
+    
+    @staticmethod
+    def derive(scheme, params, salt, password):
+        if scheme == 'scrypt':
+            n, r, p = params
+            return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                                  maxmem=256 * n * r * p, dklen=32)
+        if scheme == 'pbkdf2_sha256':
+            return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, params[0])
+        raise ValueError(f"Неизвестная схема хэширования: {scheme}")
+    
+    @staticmethod
+    def encode(scheme, params, salt, digest):
+        b64 = lambda b: base64.b64encode(b).decode().rstrip('=')
+        return '$'.join([scheme] + [str(x) for x in params] + [b64(salt), b64(digest)])
+    
+    @staticmethod
+    def decode(stored):
+        """(схема, параметры, соль, хэш); для старого формата схема 'sha256'"""
+        if '$' not in stored:
+            return 'sha256', [], b'', stored
+        scheme, *params, salt, digest = stored.split('$')
+        unb64 = lambda s: base64.b64decode(s + '=' * (-len(s) % 4))
+        return scheme, [int(x) for x in params], unb64(salt), unb64(digest)
+    
+    def _hash(self, password):
+        salt = secrets.token_bytes(16)
+        params = self.params(self.scheme)
+        return self.encode(self.scheme, params, salt, self.derive(self.scheme, params, salt, password))
+    
+    def _verify(self, password, stored):
+        scheme, params, salt, digest = self.decode(stored)
+        if scheme == 'sha256':
+            return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), digest)
+        return hmac.compare_digest(self.derive(scheme, params, salt, password), digest)
+    
+    def hash(self, password):
+        return self.pool().submit(self._hash, password).result()
+    
+    def verify(self, password, stored):
+        if not stored:
+            return False
+        key = hmac.new(self.cache_key, stored.encode() + b'\0' + password.encode(), 'sha256').digest()
+        now = time.time()
+        with self.lock:
+            checked = self.cache.get(key)
+            if checked and now - checked < self.cache_ttl:
+                self.cache.move_to_end(key)
+                return True
+        
+        ok = self.pool().submit(self._verify, password, stored).result()
+        if ok:
+            with self.lock:
+                self.cache[key] = now
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return ok
+    
+    def needs_rehash(self, stored):
+        """Хэш старого формата или с другими параметрами стоимости"""
+        scheme, params, _, _ = self.decode(stored)
+        return scheme != self.scheme or params != self.params(self.scheme)
+    
+    def benchmark(self, seconds=2.0, threads=None):
+        """Скорость хэширования текущей схемой: всего и на одно ядро"""
+        threads = threads or self.workers
+        deadline = time.perf_counter() + seconds
+        
+        def run():
+            count = 0
+            while time.perf_counter() < deadline:
+                self._hash("benchmark-password")
+                count += 1
+            return count
+        
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            total = sum(pool.map(lambda _: run(), range(threads)))
+        elapsed = time.perf_counter() - started
+        return {
+            "scheme": self.scheme,
+            "params": self.params(self.scheme),
+            "threads": threads,
+            "hashes_per_second": round(total / elapsed, 1),
+            "hashes_per_second_per_core": round(total / elapsed / min(threads, os.cpu_count() or 1), 1)
+        }
+
+passwords = PasswordHasher()
+
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    return passwords.hash(password)
+
+def verify_password(password, stored):
+    return passwords.verify(password, stored)
 
 # Логирование
+class ActivityLogWriter:
+    """Фоновая пакетная запись журнала: очередь в памяти и поток-писатель"""
+    def __init__(self, max_size=LOG_QUEUE_SIZE, policy=LOG_QUEUE_POLICY,
+                 batch_size=LOG_BATCH_SIZE, interval=LOG_FLUSH_INTERVAL):
+        self.max_size = max_size
+        self.policy = policy
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self.written = 0
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+    
+    def _ensure_started(self):
+        # Поток запускается лениво и заново после fork (воркеры gunicorn)
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.Queue(maxsize=self.max_size)
+                self._thread = threading.Thread(target=self._run, name="activity-log-writer", daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+    
+    def put(self, entry):
+        self._ensure_started()
+        if self.policy == 'block':
+            self._queue.put(entry)
+            return True
+        try:
+            self._queue.put_nowait(entry)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+    
+    def _run(self):
+        q = self._queue
+        while True:
+            entry = q.get()
+            if entry is None:
+                q.task_done()
+                return
+            
+            batch = [entry]
+            deadline = time.time() + self.interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    entry = q.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                batch.append(entry)
+            
+            try:
+                self.write_batch(batch)
+            except Exception:
+                app.logger.exception("Failed to write activity log batch")
+            for _ in range(len(batch) + stop):
+                q.task_done()
+            if stop:
+                return
+    
+    def write_batch(self, entries):
+        # Запись в файл
+        with open(LOGS_FILE, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in entries))
+        
+        # Запись в хранилище одной транзакцией (кэш базы остаётся актуальным)
+        with document_cache.writing():
+            with storage.transaction():
+                storage.insert_many("admin_logs", entries)
+                storage.trim("admin_logs", ADMIN_LOGS_RETENTION)  # Ограничиваем размер логов
+                rollups.add_active(entries)
+        self.written += len(entries)
+    
+    def flush(self):
+        """Ожидание записи всех поставленных в очередь записей"""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.join()
+    
+    def close(self, timeout=10):
+        """Запись остатка очереди и остановка потока (при завершении процесса)"""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+    
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "written": self.written,
+            "dropped": self.dropped,
+            "policy": self.policy
+        }
+
+activity_log = ActivityLogWriter()
+atexit.register(activity_log.close)
+
+class ActivityLogStore:
+    """Журнал активности в памяти для выборок.
+    
+    Кольцевой буфер на capacity записей в порядке записи (он же порядок
+    времени) и вторичные индексы action -> номера записей и
+    user_id -> номера записей. Новые строки подчитываются из таблицы
+    admin_logs, поэтому записи других воркеров тоже видны.
+    """
+    def __init__(self, storage, capacity=ADMIN_LOGS_RETENTION):
+        self.storage = storage
+        self.capacity = capacity
+        # Общая с хранилищем блокировка: запросы читают журнал под document_cache.lock
+        self.lock = storage.lock
+        self.buffer = [None] * capacity
+        self.start = 0     # Номер самой старой записи в буфере
+        self.end = 0       # Номер следующей записи
+        self.by_action = {}
+        self.by_user = {}
+        self.last_row = 0  # Последний прочитанный seq таблицы
+    
+    def refresh(self):
+        with self.lock:
+            rows = self.storage.rows_after("admin_logs", self.last_row, None if self.last_row else self.capacity)
+            for row_seq, entry in rows:
+                self.append(entry)
+                self.last_row = row_seq
+    
+    def reset(self):
+        """Сброс буфера и индексов: после замены таблицы журнал читается заново"""
+        with self.lock:
+            self.buffer = [None] * self.capacity
+            self.start = self.end = 0
+            self.by_action = {}
+            self.by_user = {}
+            self.last_row = 0
+    
+    def append(self, entry):
+        with self.lock:
+            if self.end - self.start >= self.capacity:
+                self._evict()
+            seq = self.end
+            self.buffer[seq % self.capacity] = entry
+            self.end += 1
+            self.by_action.setdefault(entry.get("action"), deque()).append(seq)
+            self.by_user.setdefault(entry.get("user_id"), deque()).append(seq)
+    
+    def _evict(self):
+        # Самая старая запись всегда в начале своих списков индексов
+        old = self.buffer[self.start % self.capacity]
+        for index, key in ((self.by_action, old.get("action")), (self.by_user, old.get("user_id"))):
+            seqs = index[key]
+            seqs.popleft()
+            if not seqs:
+                del index[key]
+        self.buffer[self.start % self.capacity] = None
+        self.start += 1
+    
+    def _entry(self, seq):
+        return self.buffer[seq % self.capacity]
+    
+    def _first_after(self, timestamp):
+        """Номер первой записи с временем строго больше timestamp (бинарный поиск)"""
+        lo, hi = self.start, self.end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)["timestamp"] > timestamp:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+    
+    def query(self, action=None, user_id=None, since=None, limit=100):
+        """Записи по фильтрам, новые сначала. Возвращает (записи, всего найдено)"""
+        with self.lock:
+            self.refresh()
+            lower = self._first_after(since) if since else self.start
+            
+            # Перебираем самый короткий из подходящих списков
+            candidates = [self.by_action.get(action, ()) if action else None,
+                          self.by_user.get(user_id, ()) if user_id else None]
+            candidates = [c for c in candidates if c is not None]
+            seqs = min(candidates, key=len) if candidates else range(self.start, self.end)
+            
+            logs = []
+            total = 0
+            for seq in reversed(seqs):
+                if seq < lower:
+                    break
+                entry = self._entry(seq)
+                if action and entry.get("action") != action:
+                    continue
+                if user_id and entry.get("user_id") != user_id:
+                    continue
+                total += 1
+                if len(logs) < limit:
+                    logs.append(entry)
+            return logs, total
+    
+    def recent(self, limit):
+        with self.lock:
+            self.refresh()
+            return [self._entry(seq) for seq in range(self.end - 1, max(self.end - limit, self.start) - 1, -1)]
+    
+    def active_users(self, since):
+        """Пользователи с записями позже since (просматривается только окно)"""
+        with self.lock:
+            self.refresh()
+            return {self._entry(seq).get("user_id") for seq in range(self._first_after(since), self.end)}
+
+activity_logs = ActivityLogStore(storage)
+
+# Сводная статистика
+class HyperLogLog:
+    """Оценка числа различных значений по 2^precision однобайтовым регистрам"""
+    def __init__(self, precision=ROLLUP_HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+    
+    def add(self, item):
+        """True, если регистр изменился"""
+        h = int.from_bytes(hashlib.blake2b(str(item).encode('utf-8'), digest_size=8).digest(), 'big')
+        bits = 64 - self.precision
+        i = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+            return True
+        return False
+    
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+    
+    def count(self):
+        m = self.size
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # Поправка для малых значений
+        return round(estimate)
+
+class RollupStore:
+    """Счетчики по дням и часам в таблицах хранилища.
+    
+    rollups хранит суммы (регистрации, посты, комментарии, лайки) за день,
+    час и за всё время, rollup_users — HyperLogLog активных пользователей
+    за день и час. Обновляются в транзакциях построчных операций и записи
+    журнала; существующие данные учитываются один раз при первом обращении.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+    
+    @staticmethod
+    def buckets(timestamp):
+        return (timestamp[:10], timestamp[:13], "all")
+    
+    def add(self, metric, timestamp, amount=1, total_only=False):
+        if not amount or not (timestamp or total_only):
+            return
+        buckets = ("all",) if total_only else self.buckets(timestamp)
+        with self.storage.transaction() as conn:
+            conn.executemany("""
+                INSERT INTO rollups (bucket, metric, value) VALUES (?, ?, ?)
+                ON CONFLICT (bucket, metric) DO UPDATE SET value = value + excluded.value
+            """, [(bucket, metric, amount) for bucket in buckets])
+    
+    def add_active(self, entries):
+        """Учет пользователей из записей журнала"""
+        with self.storage.transaction() as conn:
+            sketches = {}
+            changed = set()
+            for entry in entries:
+                timestamp = entry.get("timestamp")
+                if not timestamp:
+                    continue
+                for bucket in self.buckets(timestamp)[:2]:
+                    if bucket not in sketches:
+                        row = conn.execute("SELECT registers FROM rollup_users WHERE bucket = ?", (bucket,)).fetchone()
+                        sketches[bucket] = HyperLogLog(registers=row[0] if row else None)
+                    if sketches[bucket].add(entry.get("user_id")):
+                        changed.add(bucket)
+            conn.executemany("INSERT OR REPLACE INTO rollup_users (bucket, registers) VALUES (?, ?)",
+                             [(bucket, bytes(sketches[bucket].registers)) for bucket in changed])
+    
+    def series(self, metric, since, hourly=False):
+        """{бакет: значение} начиная с бакета, содержащего since"""
+        width = 13 if hourly else 10
+        self.ensure_backfilled()
+        with self.storage.lock:
+            rows = self.storage.connect().execute(
+                "SELECT bucket, value FROM rollups WHERE metric = ? AND length(bucket) = ? AND bucket >= ? ORDER BY bucket",
+                (metric, width, since[:width])
+            ).fetchall()
+        return {bucket: value for bucket, value in rows if value}
+    
+    def total(self, metric):
+        self.ensure_backfilled()
+        with self.storage.lock:
+            row = self.storage.connect().execute(
+                "SELECT value FROM rollups WHERE bucket = 'all' AND metric = ?", (metric,)
+            ).fetchone()
+        return row[0] if row else 0
+    
+    def active_users(self, since):
+        """Оценка числа различных пользователей в журнале начиная с часа since"""
+        self.ensure_backfilled()
+        next_day = (datetime.fromisoformat(since[:10]) + timedelta(days=1)).isoformat()[:10]
+        with self.storage.lock:
+            # Часы до конца первого дня, затем целые дни
+            rows = self.storage.connect().execute("""
+                SELECT registers FROM rollup_users
+                WHERE (length(bucket) = 13 AND bucket >= ? AND bucket < ?) OR (length(bucket) = 10 AND bucket >= ?)
+            """, (since[:13], next_day, next_day)).fetchall()
+        sketch = HyperLogLog()
+        for row in rows:
+            sketch.merge(HyperLogLog(registers=row[0]))
+        return sketch.count()
+    
+    def is_backfilled(self):
+        with self.storage.lock:
+            return self.storage.connect().execute(
+                "SELECT 1 FROM rollups WHERE bucket = 'all' AND metric = 'backfilled'"
+            ).fetchone() is not None
+    
+    def ensure_backfilled(self):
+        # Обычно сводка уже посчитана: проверка без блокировки записи
+        if self.is_backfilled():
+            return
+        with self.storage.transaction():
+            if not self.is_backfilled():
+                self.backfill(load_database())
+    
+    def backfill(self, db):
+        """Пересчет сводки по текущим данным и сохранённому журналу.
+        
+        Лайки существующих записей относятся ко времени их создания,
+        активные пользователи — только по хранимой части журнала.
+        """
+        with self.storage.transaction() as conn:
+            conn.execute("DELETE FROM rollups")
+            conn.execute("DELETE FROM rollup_users")
+            for collection, metric in ROLLUP_METRICS.items():
+                for record in db.get(collection, []):
+                    self.add(metric, record.get("createdAt"))
+            for collection in ("posts", "videos"):
+                for record in db.get(collection, []):
+                    self.add("likes", record.get("createdAt"), len(record.get("likes", [])))
+            self.add_active([entry for _, entry in self.storage.rows_after("admin_logs", 0)])
+            self.add("backfilled", None, total_only=True)
+
+rollups = RollupStore(storage)
+
+class ChecksumMismatch(ValueError):
+    """Содержимое файла не совпадает с заявленной контрольной суммой"""
+
+class BlobStore:
+    """Загруженные файлы по SHA-256 содержимого: каждый хранится один раз.
+    
+    Файл лежит в blobs/ab/cd/<sha256>.<ext> и раздается с immutable-кэшем,
+    таблица blobs считает ссылки из поля media постов и видео. Счетчики
+    меняются в транзакциях построчных операций; файлы без ссылок удаляет
+    collect_garbage() не раньше BLOB_ORPHAN_TTL после последнего обращения.
+    """
+    def __init__(self, storage, root=BLOB_FOLDER):
+        self.storage = storage
+        self.root = root
+    
+    @staticmethod
+    def references(record):
+        """Хэши файлов в поле media: строки или {"hash": ...}"""
+        digests = set()
+        for item in record.get("media") or []:
+            digest = item.get("hash") if isinstance(item, dict) else item
+            if isinstance(digest, str) and BLOB_HASH_RE.match(digest):
+                digests.add(digest)
+        return digests
+    
+    def path(self, digest, ext):
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}.{ext}")
+    
+    def url(self, digest, ext):
+        relative = os.path.relpath(self.path(digest, ext), MEDIA_FOLDER)
+        return "/media/" + relative.replace(os.sep, "/")
+    
+    def describe(self, digest, ext, size, content_type):
+        return {"hash": digest, "url": self.url(digest, ext), "size": size, "contentType": content_type}
+    
+    @staticmethod
+    def file_type(filename, content_type=None):
+        """(расширение, MIME-тип); ValueError — недопустимое расширение"""
+        ext = os.path.splitext(filename or "")[1].lstrip(".").lower()
+        if ext not in BLOB_EXTENSIONS:
+            raise ValueError("Недопустимый тип файла")
+        return ext, content_type or mimetypes.guess_type(f"file.{ext}")[0] or "application/octet-stream"
+    
+    def put(self, stream, filename, content_type=None):
+        """Сохранение потока частями с подсчетом SHA-256; в памяти только одна часть.
+        
+        Если такой файл уже есть, новая копия удаляется, а возвращается
+        существующий. ValueError — недопустимое расширение или пустой файл.
+        """
+        ext, content_type = self.file_type(filename, content_type)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if not size:
+                raise ValueError("Пустой файл")
+            return self._store(tmp_path, digest.hexdigest(), size, ext, content_type)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def put_file(self, path, filename, content_type=None, sha256=None):
+        """Перенос готового файла (например, собранной загрузки) в хранилище.
+        
+        sha256 — ожидаемая контрольная сумма; при несовпадении ChecksumMismatch.
+        Файл path перемещается или, если такой уже есть, остается на месте.
+        """
+        ext, content_type = self.file_type(filename, content_type)
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        if not size:
+            raise ValueError("Пустой файл")
+        digest = digest.hexdigest()
+        if sha256 and digest != sha256.lower():
+            raise ChecksumMismatch("Контрольная сумма не совпадает")
+        return self._store(path, digest, size, ext, content_type)
+    
+    def _store(self, tmp_path, digest, size, ext, content_type):
+        """Запись строки и перенос файла одной транзакцией.
+        
+        Файл переносится последним, а если транзакция не зафиксирована,
+        возвращается на прежнее место: файлов без строки в blobs не остается
+        (collect_garbage удаляет только файлы известных строк).
+        """
+        now = datetime.now().isoformat()
+        final_path = self.path(digest, ext)
+        moved = copied = False
+        try:
+            with self.storage.transaction() as conn:
+                row = conn.execute("SELECT ext, content_type FROM blobs WHERE hash = ?", (digest,)).fetchone()
+                if row and os.path.exists(self.path(digest, row[0])):
+                    conn.execute("UPDATE blobs SET touched_at = ? WHERE hash = ?", (now, digest))
+                    result = self.describe(digest, row[0], size, row[1])
+                    result["deduplicated"] = True
+                    return result
+                
+                conn.execute("""
+                    INSERT INTO blobs (hash, ext, size, content_type, refs, touched_at) VALUES (?, ?, ?, ?, 0, ?)
+                    ON CONFLICT (hash) DO UPDATE SET ext = excluded.ext, size = excluded.size,
+                        content_type = excluded.content_type, touched_at = excluded.touched_at
+                """, (digest, ext, size, content_type, now))
+                media_jobs.enqueue(media_relpath(final_path))
+                
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                try:
+                    os.replace(tmp_path, final_path)
+                    moved = True
+                except OSError:
+                    # Другой раздел диска: копия рядом с местом назначения и переименование.
+                    # Исходный файл удаляет вызывающий код (put, UploadSessions)
+                    shutil.copyfile(tmp_path, f"{final_path}.tmp")
+                    os.replace(f"{final_path}.tmp", final_path)
+                    copied = True
+        except BaseException:
+            if moved:
+                os.replace(final_path, tmp_path)
+            elif copied:
+                os.remove(final_path)
+            raise
+        result = self.describe(digest, ext, size, content_type)
+        result["deduplicated"] = False
+        return result
+    
+    def get(self, digest):
+        with self.storage.lock:
+            row = self.storage.connect().execute(
+                "SELECT ext, size, content_type, refs FROM blobs WHERE hash = ?", (digest,)
+            ).fetchone()
+        if not row:
+            return None
+        result = self.describe(digest, row[0], row[1], row[2])
+        result["refs"] = row[3]
+        return result
+    
+    def missing(self, digests):
+        """Хэши, для которых нет загруженного файла"""
+        digests = list(digests)
+        if not digests:
+            return set()
+        with self.storage.lock:
+            rows = self.storage.connect().execute(
+                f"SELECT hash FROM blobs WHERE hash IN ({', '.join('?' * len(digests))})", digests
+            ).fetchall()
+        return set(digests) - {row[0] for row in rows}
+    
+    def retain(self, digests, amount=1):
+        if not digests:
+            return
+        now = datetime.now().isoformat()
+        with self.storage.transaction() as conn:
+            conn.executemany("UPDATE blobs SET refs = MAX(refs + ?, 0), touched_at = ? WHERE hash = ?",
+                             [(amount, now, digest) for digest in digests])
+    
+    def release(self, digests):
+        self.retain(digests, -1)
+    
+    def recount(self, db):
+        """Пересчет ссылок по текущим данным (после импорта или полной замены базы)"""
+        counts = {}
+        for collection in ("posts", "videos"):
+            for record in db.get(collection, []):
+                for digest in self.references(record):
+                    counts[digest] = counts.get(digest, 0) + 1
+        with self.storage.transaction() as conn:
+            conn.execute("UPDATE blobs SET refs = 0")
+            conn.executemany("UPDATE blobs SET refs = ? WHERE hash = ?",
+                             [(count, digest) for digest, count in counts.items()])
+    
+    def collect_garbage(self, max_age=BLOB_ORPHAN_TTL):
+        """Удаление файлов без ссылок и брошенных временных файлов"""
+        cutoff = datetime.now() - timedelta(seconds=max_age)
+        removed = freed = 0
+        with transaction() as db:
+            self.recount(db)
+            conn = self.storage.connect()
+            rows = conn.execute("SELECT hash, ext, size FROM blobs WHERE refs = 0 AND touched_at < ?",
+                                (cutoff.isoformat(),)).fetchall()
+            # Файлы удаляются под блокировкой записи: put() не увидит запись без файла
+            for digest, ext, size in rows:
+                source = media_relpath(self.path(digest, ext))
+                for path in [self.path(digest, ext)] + [variant_path(source, name) for name in MEDIA_VARIANT_SIZES]:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                media_jobs.forget(source)
+                removed += 1
+                freed += size
+            conn.executemany("DELETE FROM blobs WHERE hash = ?", [(row[0],) for row in rows])
+        
+        tmp_folder = os.path.join(self.root, 'tmp')
+        for name in os.listdir(tmp_folder):
+            path = os.path.join(tmp_folder, name)
+            try:
+                if os.path.getmtime(path) < cutoff.timestamp():
+                    os.remove(path)
+            except OSError:
+                pass
+        return {"removed": removed, "freed_bytes": freed}
+
+blobs = BlobStore(storage)
+
+class UploadSessions:
+    """Докачиваемые загрузки частями: создание, PUT частей по смещению, завершение.
+    
+    Части пишутся сразу в UPLOAD_FOLDER/<id>.part, принятая длина хранится
+    в таблице upload_sessions, поэтому после обрыва клиент узнает смещение
+    и продолжает в любом воркере. Одну сессию в каждый момент пишет только
+    один запрос (аренда на UPLOAD_LEASE). Сессии без активности дольше
+    UPLOAD_SESSION_TTL удаляются вместе с файлом.
+    """
+    FIELDS = ("id", "user_id", "filename", "content_type", "size", "received", "sha256", "expires_at")
+    
+    def __init__(self, storage, folder=UPLOAD_FOLDER):
+        self.storage = storage
+        self.folder = folder
+    
+    def part_path(self, upload_id):
+        return os.path.join(self.folder, f"{upload_id}.part")
+    
+    @staticmethod
+    def describe(session):
+        return {
+            "id": session["id"],
+            "filename": session["filename"],
+            "size": session["size"],
+            "offset": session["received"],
+            "chunkSize": UPLOAD_PART_SIZE,
+            "expiresAt": datetime.fromtimestamp(session["expires_at"]).isoformat()
+        }
+    
+    def create(self, user_id, filename, size, sha256=None, content_type=None):
+        """Новая сессия; ValueError — недопустимый файл или слишком много сессий"""
+        BlobStore.file_type(filename, content_type)
+        if not isinstance(size, int) or not 0 < size <= UPLOAD_MAX_SIZE:
+            raise ValueError(f"Размер файла должен быть от 1 байта до {UPLOAD_MAX_SIZE} байт")
+        if sha256 is not None and not (isinstance(sha256, str) and BLOB_HASH_RE.match(sha256.lower())):
+            raise ValueError("Неверная контрольная сумма sha256")
+        
+        self.expire()
+        now = time.time()
+        session = {
+            "id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "filename": filename,
+            "content_type": content_type,
+            "size": size,
+            "received": 0,
+            "sha256": sha256.lower() if sha256 else None,
+            "expires_at": now + UPLOAD_SESSION_TTL
+        }
+        with self.storage.transaction() as conn:
+            active = conn.execute("SELECT COUNT(*) FROM upload_sessions WHERE user_id = ? AND expires_at > ?",
+                                  (user_id, now)).fetchone()[0]
+            if active >= UPLOAD_MAX_SESSIONS:
+                raise ValueError("Слишком много незавершенных загрузок")
+            open(self.part_path(session["id"]), 'wb').close()
+            conn.execute(f"INSERT INTO upload_sessions ({', '.join(self.FIELDS)}, created_at) VALUES "
+                         f"({', '.join('?' * len(self.FIELDS))}, ?)",
+                         [session[field] for field in self.FIELDS] + [datetime.now().isoformat()])
+        return session
+    
+    def get(self, upload_id):
+        with self.storage.lock:
+            row = self.storage.connect().execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM upload_sessions WHERE id = ? AND expires_at > ?",
+                (upload_id, time.time())
+            ).fetchone()
+        return dict(zip(self.FIELDS, row)) if row else None
+    
+    def acquire(self, upload_id, offset):
+        """Аренда сессии, если принято ровно offset байт и её никто не пишет"""
+        now = time.time()
+        with self.storage.transaction() as conn:
+            cursor = conn.execute("""
+                UPDATE upload_sessions SET lease_until = ?
+                WHERE id = ? AND received = ? AND expires_at > ? AND (lease_until IS NULL OR lease_until < ?)
+            """, (now + UPLOAD_LEASE, upload_id, offset, now, now))
+            return cursor.rowcount == 1
+    
+    def release(self, upload_id, received):
+        with self.storage.transaction() as conn:
+            conn.execute("UPDATE upload_sessions SET received = ?, lease_until = NULL, expires_at = ? WHERE id = ?",
+                         (received, time.time() + UPLOAD_SESSION_TTL, upload_id))
+    
+    def write(self, session, stream):
+        """Дописывание тела запроса с принятого смещения (сессия должна быть арендована).
+        
+        Принятая длина сохраняется и при обрыве соединения: следующий
+        запрос продолжит с последнего записанного байта.
+        """
+        received = session["received"]
+        try:
+            with open(self.part_path(session["id"]), 'r+b') as f:
+                f.seek(received)
+                f.truncate()
+                for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+                    if received + len(chunk) > session["size"]:
+                        raise ValueError("Данных больше объявленного размера")
+                    f.write(chunk)
+                    received += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            self.release(session["id"], received)
+        return received
+    
+    def complete(self, session, sha256=None):
+        """Проверка контрольной суммы и перенос файла в хранилище BlobStore.
+        
+        При несовпадении суммы сессия удаляется: данные придется загрузить
+        заново. При других ошибках (ввод-вывод, база) сессия сохраняется,
+        и завершение можно повторить.
+        """
+        if session["received"] != session["size"]:
+            raise ValueError(f"Загружено {session['received']} из {session['size']} байт")
+        expected = session["sha256"] or sha256
+        if not expected:
+            raise ValueError("Нужна контрольная сумма sha256")
+        try:
+            blob = blobs.put_file(self.part_path(session["id"]), session["filename"],
+                                  session["content_type"], sha256=expected)
+        except ChecksumMismatch:
+            self.remove(session["id"])
+            raise
+        self.remove(session["id"])
+        return blob
+    
+    def remove(self, upload_id):
+        with self.storage.transaction() as conn:
+            conn.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+        try:
+            os.remove(self.part_path(upload_id))
+        except FileNotFoundError:
+            pass
+    
+    def expire(self):
+        """Удаление брошенных сессий и их файлов"""
+        now = time.time()
+        with self.storage.lock:
+            rows = self.storage.connect().execute(
+                "SELECT id FROM upload_sessions WHERE expires_at < ? AND (lease_until IS NULL OR lease_until < ?)",
+                (now, now)
+            ).fetchall()
+        for row in rows:
+            self.remove(row[0])
+        return len(rows)
+
+upload_sessions = UploadSessions(storage)
+
 def log_activity(user_id, action, details, ip=None):
     log_entry = {
         "timestamp": datetime.now().isoformat(),
@@ -161,118 +1852,862 @@ def log_activity(user_id, action, details, ip=None):
         "ip": ip or (request.remote_addr if hasattr(request, 'remote_addr') else "127.0.0.1")
     }
     
-    # Запись в файл
-    with open(LOGS_FILE, 'a', encoding='utf-8') as f:
-        f.write(json.dumps(log_entry, ensure_ascii=False) + '\n')
+    # Запись в файл и базу выполняет фоновый поток
+    pending = getattr(_deferred_logs, 'entries', None)
+    if pending is not None:
+        pending.append(log_entry)
+    else:
+        activity_log.put(log_entry)
+
+_deferred_logs = threading.local()
+
+@contextmanager
+def defer_activity_log():
+    """Записи журнала из блока передаются писателю после его успешного завершения.
+    
+    Транзакции держат блокировки хранилища и кэша, которые нужны потоку-писателю:
+    ожидание места в очереди (LOG_QUEUE_POLICY='block') внутри них не кончилось бы.
+    При исключении записи отбрасываются вместе с откатом.
+    """
+    if getattr(_deferred_logs, 'entries', None) is not None:
+        yield  # Вложенный блок: записи отправит внешний
+        return
+    entries = _deferred_logs.entries = []
+    try:
+        yield
+    finally:
+        _deferred_logs.entries = None
+    for entry in entries:
+        activity_log.put(entry)
+
+# Защита от спама
+class SharedRateLimitBackend:
+    """Счетчики лимитов в отдельном SQLite файле, общие для всех процессов"""
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+    
+    def connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    limit_type TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    window INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (limit_type, key, window)
+                ) WITHOUT ROWID""")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+    
+    def hit(self, limit_type, key, window, elapsed, limit, pending=0, pending_window=None):
+        """Атомарно добавляет pending накопленных запросов и, если лимит позволяет,
+        текущий. Возвращает (разрешен, счетчик окна, счетчик предыдущего окна)"""
+        conn = self.connect()
+        add = ("INSERT INTO counters (limit_type, key, window, count) VALUES (?, ?, ?, ?) "
+               "ON CONFLICT (limit_type, key, window) DO UPDATE SET count = count + excluded.count")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if pending:
+                conn.execute(add, (limit_type, key, window if pending_window is None else pending_window, pending))
+            counts = dict(conn.execute(
+                "SELECT window, count FROM counters WHERE limit_type = ? AND key = ? AND window IN (?, ?)",
+                (limit_type, key, window, window - 1)).fetchall())
+            current, previous = counts.get(window, 0), counts.get(window - 1, 0)
+            allowed = previous * (1 - elapsed) + current < limit
+            if allowed:
+                conn.execute(add, (limit_type, key, window, 1))
+                current += 1
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, current, previous
+    
+    def cleanup(self, limit_type, min_window):
+        self.connect().execute("DELETE FROM counters WHERE limit_type = ? AND window < ?", (limit_type, min_window))
+
+class RateLimiter:
+    """Ограничение частоты по приблизительному скользящему окну.
+    
+    На каждый ключ хранится фиксированное состояние: номер текущего окна и
+    счетчики текущего и предыдущего окон. Оценка числа запросов за последние
+    window секунд = предыдущее окно * непрошедшая доля + текущее окно.
+    Ключи, неактивные больше двух окон, периодически удаляются.
+    
+    С общим backend счетчики окон берутся из него. Пока до лимита далеко,
+    запросы учитываются локально (pending) и передаются пачкой при следующей
+    синхронизации, так что обращение к backend нужно не на каждый запрос.
+    """
+    def __init__(self, limits=None, cleanup_interval=RATE_LIMIT_CLEANUP_INTERVAL, backend=None,
+                 local_share=RATE_LIMIT_LOCAL_SHARE, sync_interval=RATE_LIMIT_SYNC_INTERVAL):
+        self.limits = {}
+        # тип -> {ключ: [номер окна, текущий счетчик, предыдущий счетчик, локальные, время синхронизации]}
+        self.state = {}
+        self.cleanup_interval = cleanup_interval
+        self.last_cleanup = time.time()
+        self.backend = backend
+        self.local_share = local_share
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        for limit_type, (limit, window) in (limits or {}).items():
+            self.add_limit(limit_type, limit, window)
+    
+    def add_limit(self, limit_type, limit, window):
+        """Регистрация нового типа лимита"""
+        with self.lock:
+            self.limits[limit_type] = (limit, window)
+            self.state.setdefault(limit_type, {})
+    
+    def hit(self, limit_type, key, now=None):
+        """Учитывает запрос; False, если лимит исчерпан"""
+        if limit_type not in self.limits:
+            return True
+        
+        now = now or time.time()
+        limit, window = self.limits[limit_type]
+        current = int(now // window)
+        elapsed = (now - current * window) / window
+        
+        with self.lock:
+            if now - self.last_cleanup > self.cleanup_interval:
+                self._cleanup(now)
+            
+            keys = self.state[limit_type]
+            state = keys.get(key)
+            pending_window = None
+            if state is None or state[0] < current - 1:
+                pending_window = state[0] if state else None
+                state = keys[key] = [current, 0, 0, state[3] if state else 0, 0]
+            elif state[0] == current - 1:
+                pending_window = state[0]
+                state[:] = [current, 0, state[1], state[3], 0]
+            
+            estimate = state[2] * (1 - elapsed) + state[1] + state[3]
+            if self.backend is None:
+                if estimate >= limit:
+                    return False
+                state[1] += 1
+                return True
+            
+            # Быстрый путь: локальный учёт, пока запас до лимита велик
+            slack = limit - estimate
+            if state[3] + 1 <= slack * self.local_share and now - state[4] < self.sync_interval:
+                state[3] += 1
+                return True
+            
+            allowed, state[1], state[2] = self.backend.hit(
+                limit_type, key, current, elapsed, limit, state[3], pending_window)
+            state[3] = 0
+            state[4] = now
+            return allowed
+    
+    def _cleanup(self, now):
+        # Удаляем ключи без запросов в текущем и предыдущем окнах. Неотправленные
+        # локальные запросы таких ключей относятся к закрытым окнам и на оценку
+        # уже не влияют, поэтому отбрасываются вместе с ключом
+        for limit_type, keys in self.state.items():
+            current = int(now // self.limits[limit_type][1])
+            for key in [k for k, state in keys.items() if state[0] < current - 1]:
+                del keys[key]
+            if self.backend is not None:
+                self.backend.cleanup(limit_type, current - 1)
+        self.last_cleanup = now
+    
+    def size(self):
+        return sum(len(keys) for keys in self.state.values())
+
+class KeywordMatcher:
+    """Автомат Ахо-Корасик: все вхождения набора строк за один проход по тексту"""
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        
+        # Бор из всех шаблонов
+        for i, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(i)
+        
+        # Суффиксные ссылки обходом в ширину
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, target in self.goto[state].items():
+                pending.append(target)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[target] = self.goto[fallback].get(char, 0)
+                if self.fail[target] == target:
+                    self.fail[target] = 0
+                self.output[target] = self.output[target] + self.output[self.fail[target]]
+    
+    def find(self, text):
+        """Номера шаблонов для каждого вхождения"""
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                yield from output[state]
+
+class SpamRules:
+    """Скомпилированные правила спам-фильтра: ключевые слова с весами,
+    маркеры ссылок и повторяющихся символов в одном автомате"""
+    def __init__(self, weights):
+        self.weights = dict(weights)
+        self.patterns = sorted(set(self.weights) | set(SPAM_LINK_MARKERS) | set(SPAM_REPEAT_MARKERS))
+        self.matcher = KeywordMatcher(self.patterns)
+        self.pattern_weights = [self.weights.get(p, 0) for p in self.patterns]
+        self.is_link = [p in SPAM_LINK_MARKERS for p in self.patterns]
+        self.is_repeat = [p in SPAM_REPEAT_MARKERS for p in self.patterns]
+    
+    def score(self, text):
+        found = set()
+        link_count = 0
+        for i in self.matcher.find(text.lower()):
+            found.add(i)
+            if self.is_link[i]:
+                link_count += 1
+        
+        # Каждое ключевое слово учитывается один раз
+        spam_score = sum(self.pattern_weights[i] for i in found)
+        
+        # Проверка на слишком много ссылок
+        if link_count > 2:
+            spam_score += link_count
+        
+        # Проверка на повторяющиеся символы
+        if any(self.is_repeat[i] for i in found):
+            spam_score += 2
+        
+        return spam_score
+
+def load_spam_keywords(path=SPAM_KEYWORDS_FILE):
+    """Ключевые слова с весами из файла или список по умолчанию"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = DEFAULT_SPAM_KEYWORDS
+    if isinstance(data, list):
+        data = {keyword: 1 for keyword in data}
+    return {str(k).lower(): float(v) for k, v in data.items() if k}
+
+def save_spam_keywords(weights, path=SPAM_KEYWORDS_FILE):
+    write_atomic(path, weights, ensure_ascii=False, indent=2)
+
+class AntiSpam:
+    def __init__(self):
+        backend = SharedRateLimitBackend(RATE_LIMIT_FILE) if RATE_LIMIT_SHARED else None
+        self.limiter = RateLimiter(RATE_LIMITS, backend=backend)
+        self._rules = None
+        self._rules_stamp = None
+        self._rules_checked_at = 0
+        self._rules_lock = threading.Lock()
+    
+    def check_rate_limit(self, ip_address, limit_type="requests"):
+        return self.limiter.hit(limit_type, ip_address)
+    
+    def rules(self):
+        """Текущие правила; автомат пересобирается при изменении файла ключевых слов"""
+        now = time.time()
+        if self._rules is not None and now - self._rules_checked_at < SPAM_RELOAD_INTERVAL:
+            return self._rules
+        with self._rules_lock:
+            self._rules_checked_at = now
+            try:
+                st = os.stat(SPAM_KEYWORDS_FILE)
+                stamp = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                stamp = None
+            if self._rules is None or stamp != self._rules_stamp:
+                self._rules = SpamRules(load_spam_keywords())
+                self._rules_stamp = stamp
+            return self._rules
+    
+    def score_content(self, text):
+        return self.rules().score(text)
+    
+    def check_content_spam(self, text, user_id=None):
+        """Проверка текста на спам"""
+        return self.score_content(text) > SPAM_SCORE_THRESHOLD  # Если больше порога - считаем спамом
+
+anti_spam = AntiSpam()
+
+# Поиск почти одинаковых сообщений
+_WORD_RE = re.compile(r"\w+")
+
+# Табличное хэширование шинглов: у каждой позиции шингла своя таблица
+# символ -> случайное 64-битное значение, хэш шингла — XOR значений
+_SHINGLE_TABLES = [{} for _ in range(4)]
+# Байт -> 0/1 для каждого бита (подсчет установленных бит столбца через translate)
+_BYTE_BITS = [bytes((byte >> bit) & 1 for byte in range(256)) for bit in range(8)]
+
+def simhash(text):
+    """64-битный SimHash по 4-символьным шинглам; None для слишком коротких текстов"""
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < DUPLICATE_MIN_WORDS:
+        return None
+    
+    normalized = ' '.join(words)
+    for position, table in enumerate(_SHINGLE_TABLES):
+        for char in set(normalized) - table.keys():
+            table[char] = int.from_bytes(hashlib.blake2b(f"{position}{char}".encode('utf-8'), digest_size=8).digest(), 'little')
+    t0, t1, t2, t3 = ([table[char] for char in normalized] for table in _SHINGLE_TABLES)
+    hashes = array('Q', map(xor, map(xor, t0, t1[1:]), map(xor, t2[2:], t3[3:]))).tobytes()
+    
+    # Столбец j — байт j всех хэшей; бит отпечатка ставится, если он есть у большинства шинглов
+    half = len(hashes) // 8 / 2
+    fingerprint = 0
+    for j in range(8):
+        column = hashes[j::8]
+        for bit in range(8):
+            if column.translate(_BYTE_BITS[bit]).count(1) > half:
+                fingerprint |= 1 << (8 * j + bit)
+    return fingerprint
+
+class DuplicateIndex:
+    """Отпечатки SimHash недавних постов и комментариев.
+    
+    64 бита делятся на DUPLICATE_MAX_DISTANCE + 1 полос; отпечатки,
+    отличающиеся не более чем на DUPLICATE_MAX_DISTANCE бит, совпадают
+    хотя бы в одной полосе, поэтому кандидаты ищутся по хэш-таблицам полос.
+    Старые записи вытесняются по времени и по размеру индекса. Новые посты
+    и комментарии подчитываются из хранилища после зафиксированных строк,
+    поэтому сообщения других воркеров тоже видны, а откаченные — нет.
+    """
+    def __init__(self, storage, window=DUPLICATE_WINDOW, max_distance=DUPLICATE_MAX_DISTANCE,
+                 max_size=DUPLICATE_INDEX_SIZE):
+        self.storage = storage
+        self.window = window
+        self.max_distance = max_distance
+        self.max_size = max_size
+        self.bands = max_distance + 1
+        self.band_bits = 64 // self.bands
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()  # Поиск ждет, пока другой поток подчитывает строки
+        self.entries = {}       # номер -> (отпечаток, user_id, время, ссылка)
+        self.order = deque()    # номера в порядке добавления
+        self.buckets = [{} for _ in range(self.bands)]  # значение полосы -> множество номеров
+        self.next_id = 0
+        self.last_rows = {"posts": 0, "comments": 0}  # Последний прочитанный seq таблиц
+    
+    def _band_keys(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [(fingerprint >> (i * self.band_bits)) & mask for i in range(self.bands)]
+    
+    def _evict(self, now):
+        while self.order:
+            entry_id = self.order[0]
+            if now - self.entries[entry_id][2] <= self.window and len(self.order) <= self.max_size:
+                break
+            self.order.popleft()
+            fingerprint = self.entries.pop(entry_id)[0]
+            for band, key in enumerate(self._band_keys(fingerprint)):
+                bucket = self.buckets[band][key]
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self.buckets[band][key]
+    
+    def add(self, fingerprint, user_id, ref, timestamp=None):
+        if fingerprint is None:
+            return
+        now = timestamp or time.time()
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (fingerprint, user_id, now, ref)
+            self.order.append(entry_id)
+            for band, key in enumerate(self._band_keys(fingerprint)):
+                self.buckets[band].setdefault(key, set()).add(entry_id)
+            self._evict(time.time())
+    
+    def find(self, fingerprint, user_id):
+        """Ссылка на недавнее почти такое же сообщение другого пользователя или None"""
+        if fingerprint is None:
+            return None
+        with self.lock:
+            now = time.time()
+            self._evict(now)
+            for band, key in enumerate(self._band_keys(fingerprint)):
+                for entry_id in self.buckets[band].get(key, ()):
+                    other, other_user, added, ref = self.entries[entry_id]
+                    if other_user != user_id and bin(other ^ fingerprint).count('1') <= self.max_distance:
+                        return ref
+        return None
+    
+    def refresh(self):
+        """Подчитывание сообщений, добавленных после последнего чтения.
+        
+        Первый вызов читает не больше max_size последних строк. Внутри
+        транзакции записи не выполняется: её строки еще не зафиксированы.
+        """
+        with self.storage.lock:
+            if self.storage._depth:
+                return
+        with self.refresh_lock:
+            since = (datetime.now() - timedelta(seconds=self.window)).isoformat()
+            recent = []
+            for collection, kind, field in (("posts", "post", "content"), ("comments", "comment", "text")):
+                last = self.last_rows[collection]
+                for row_seq, record in self.storage.rows_after(collection, last, None if last else self.max_size):
+                    self.last_rows[collection] = row_seq
+                    if record.get("createdAt", "") > since:
+                        recent.append((kind, record, record.get(field) or ""))
+            recent.sort(key=lambda item: item[1]["createdAt"])
+            for kind, record, text in recent:
+                added = datetime.fromisoformat(record["createdAt"]).timestamp()
+                self.add(simhash(text), record.get("userId"), (kind, record["id"]), added)
+
+duplicate_index = DuplicateIndex(storage)
+
+def check_duplicate(text, user_id):
+    """Ссылка на недавнее почти такое же сообщение другого пользователя или None.
     
-    # Запись в базу данных
-    db = load_database()
-    db["admin_logs"].append(log_entry)
-    if len(db["admin_logs"]) > 1000:  # Ограничиваем размер логов
-        db["admin_logs"] = db["admin_logs"][-1000:]
-    save_database(db)
+    Вызывается до транзакции записи: отпечаток считается без блокировки.
+    """
+    duplicate_index.refresh()
+    return duplicate_index.find(simhash(text), user_id)
 
-# Защита от спама
-class AntiSpam:
-    def __init__(self):
-        self.request_logs = {}
-        self.comment_logs = {}
-        self.post_logs = {}
+def flag_duplicate(db, kind, record_id, duplicate_of):
+    """Автоматический репорт на почти дословный повтор чужого сообщения"""
+    insert_record(db, "reports", {
+        "id": generate_id("report"),
+        "reporterId": "SYSTEM",
+        "targetId": record_id,
+        "type": kind,
+        "reason": "duplicate",
+        "details": f"Почти совпадает с {duplicate_of[0]} {duplicate_of[1]} другого пользователя",
+        "status": "pending",
+        "createdAt": datetime.now().isoformat(),
+        "source": "duplicate"
+    })
+
+# Баны
+class _TrieNode:
+    __slots__ = ("key", "length", "children", "value")
     
-    def check_rate_limit(self, ip_address, limit_type="requests"):
-        now = time.time()
+    def __init__(self, key, length, value=None):
+        self.key = key
+        self.length = length
+        self.children = [None, None]
+        self.value = value
+
+class IPPrefixTrie:
+    """Сжатое двоичное префиксное дерево (radix trie) для поиска самого
+    длинного совпадающего префикса адреса за O(длины префикса)"""
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = None
+        self.size = 0
+    
+    def _mask(self, length):
+        return ((1 << length) - 1) << (self.bits - length)
+    
+    def _bit(self, key, position):
+        return (key >> (self.bits - 1 - position)) & 1
+    
+    def _common(self, a, b, length):
+        """Длина общего префикса a и b (не больше length)"""
+        diff = (a ^ b) & self._mask(length)
+        return length if diff == 0 else self.bits - diff.bit_length()
+    
+    def insert(self, key, length, value):
+        key &= self._mask(length)
+        parent, node = None, self.root
+        while True:
+            if node is None:
+                node = _TrieNode(key, length, value)
+                break
+            common = self._common(node.key, key, min(node.length, length))
+            if common < node.length:
+                # Разделяем ребро: общий префикс становится промежуточным узлом
+                split = _TrieNode(key & self._mask(common), common)
+                split.children[self._bit(node.key, common)] = node
+                if common == length:
+                    split.value = value
+                else:
+                    split.children[self._bit(key, common)] = _TrieNode(key, length, value)
+                node = split
+                break
+            if length == node.length:
+                if node.value is None:
+                    self.size += 1
+                node.value = value
+                return
+            parent, node = node, node.children[self._bit(key, node.length)]
+            if node is None:
+                node = _TrieNode(key, length, value)
+                break
         
-        if limit_type == "requests":
-            logs = self.request_logs
-            limit = MAX_REQUESTS_PER_MINUTE
-            window = 60  # 1 минута
-        elif limit_type == "comments":
-            logs = self.comment_logs
-            limit = MAX_COMMENTS_PER_HOUR
-            window = 3600  # 1 час
-        elif limit_type == "posts":
-            logs = self.post_logs
-            limit = MAX_POSTS_PER_DAY
-            window = 86400  # 1 день
+        self.size += 1
+        if parent is None:
+            self.root = node
         else:
-            return True
-        
-        if ip_address not in logs:
-            logs[ip_address] = []
+            parent.children[self._bit(key, parent.length)] = node
+    
+    def remove(self, key, length):
+        key &= self._mask(length)
+        path = []
+        node = self.root
+        while node is not None and node.length <= length:
+            if self._common(node.key, key, node.length) < node.length:
+                return False
+            path.append(node)
+            if node.length == length:
+                break
+            node = node.children[self._bit(key, node.length)]
+        if not path or path[-1].length != length or path[-1].value is None:
+            return False
         
-        # Удаляем старые записи
-        logs[ip_address] = [t for t in logs[ip_address] if now - t < window]
+        path[-1].value = None
+        self.size -= 1
         
-        # Проверяем лимит
-        if len(logs[ip_address]) >= limit:
+        # Удаляем опустевшие узлы и склеиваем узлы с одним потомком
+        while path:
+            node = path.pop()
+            if node.value is not None:
+                break
+            children = [c for c in node.children if c is not None]
+            if len(children) == 2:
+                break
+            replacement = children[0] if children else None
+            if path:
+                parent = path[-1]
+                parent.children[self._bit(node.key, parent.length)] = replacement
+            else:
+                self.root = replacement
+            if replacement is not None:
+                break
+        return True
+    
+    def lookup(self, key):
+        """Значение самого длинного префикса, содержащего адрес key"""
+        best = None
+        node = self.root
+        while node is not None:
+            if self._common(node.key, key, node.length) < node.length:
+                break
+            if node.value is not None:
+                best = node.value
+            if node.length == self.bits:
+                break
+            node = node.children[self._bit(key, node.length)]
+        return best
+
+def normalize_ip_target(target):
+    """Канонический вид IP, подсети (CIDR) или диапазона a-b; ValueError если неверно"""
+    target = str(target).strip()
+    if '-' in target:
+        first, last = (ipaddress.ip_address(part.strip()) for part in target.split('-', 1))
+        if first.version != last.version or first > last:
+            raise ValueError(f"Invalid IP range: {target}")
+        return f"{first}-{last}"
+    network = ipaddress.ip_network(target, strict=False)
+    if network.num_addresses == 1:
+        return str(network.network_address)
+    return network.with_prefixlen
+
+def ip_target_networks(target):
+    """Подсети, покрывающие IP, подсеть или диапазон"""
+    if '-' in target:
+        first, last = (ipaddress.ip_address(part) for part in target.split('-', 1))
+        return list(ipaddress.summarize_address_range(first, last))
+    return [ipaddress.ip_network(target, strict=False)]
+
+class BanManager:
+    """Баны в памяти процесса.
+    
+    IP баны — словарь ip -> запись; подсети (CIDR) и диапазоны дополнительно
+    лежат в префиксных деревьях для IPv4 и IPv6. Баны пользователей — упорядоченное
+    множество, сроки действия — min-куча (истекшие удаляются лениво при
+    проверке).
+    
+    На диске: снимок bans.json и журнал bans.json.journal — по строке JSON
+    на изменение, дописывается с fsync. Изменения выполняются под файловой
+    блокировкой, другие процессы дочитывают только новые строки журнала.
+    Каждые BAN_JOURNAL_COMPACT_EVERY операций снимок переписывается
+    атомарно, а журнал очищается; незавершенная последняя строка после
+    сбоя пропускается.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.lock_path = path + '.lock'
+        self.offset = 0        # Прочитанная часть журнала (байт)
+        self.journal_ops = 0   # Операций в журнале после снимка
+        self.lock = threading.RLock()
+        self.ip_bans = {}
+        self.ip_tries = {4: IPPrefixTrie(32), 6: IPPrefixTrie(128)}  # подсеть -> ключ бана
+        self.user_bans = {}  # user_id -> None (порядок добавления сохраняется)
+        self.temp_bans = {}
+        self.expiry_heap = []  # (expires, тип, цель)
+        self.stamp = None
+        self.checked_at = 0
+    
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            return None
+    
+    def _load(self):
+        try:
+            data = load_bans(self.path)
+        except ValueError:
+            # Снимок пишется атомарно, сюда попадаем только при ручной порче файла:
+            # оставляем баны в памяти, а не снимаем все
+            app.logger.exception("Corrupted bans snapshot %s", self.path)
             return False
-        
-        # Добавляем текущий запрос
-        logs[ip_address].append(now)
+        self.ip_bans = {}
+        self.ip_tries = {4: IPPrefixTrie(32), 6: IPPrefixTrie(128)}
+        for ban in data.get("ip_bans", []):
+            self._index_ip_ban(ban)
+        self.user_bans = dict.fromkeys(data.get("user_bans", []))
+        self.temp_bans = dict(data.get("temp_bans", {}))
+        self.expiry_heap = [(ban["expires"], "ip", ip) for ip, ban in self.ip_bans.items() if "expires" in ban]
+        self.expiry_heap += [(ban["expires"], "temp", user_id) for user_id, ban in self.temp_bans.items()]
+        heapq.heapify(self.expiry_heap)
+        self.offset = 0
+        self.journal_ops = 0
         return True
     
-    def check_content_spam(self, text, user_id=None):
-        """Проверка текста на спам"""
-        spam_keywords = [
-            "купить", "продать", "заработок", "бинарные", "крипта",
-            "казино", "ставки", "халява", "бесплатно", "реклама",
-            "http://", "https://", "www.", ".ru", ".com",
-            "прибыль", "инвестиции", "деньги", "быстро", "легко"
-        ]
-        
-        text_lower = text.lower()
-        
-        # Проверка на ключевые слова
-        spam_score = 0
-        for keyword in spam_keywords:
-            if keyword in text_lower:
-                spam_score += 1
-        
-        # Проверка на слишком много ссылок
-        link_count = text_lower.count('http://') + text_lower.count('https://') + text_lower.count('www.')
-        if link_count > 2:
-            spam_score += link_count
-        
-        # Проверка на повторяющиеся символы
-        if '!!!!!' in text or '?????' in text or '......' in text:
-            spam_score += 2
+    def _apply(self, op):
+        kind = op["op"]
+        if kind == "ip":
+            ban = dict(op["ban"])
+            self._unindex_ip_ban(normalize_ip_target(ban["ip"]))
+            self._index_ip_ban(ban)
+            if "expires" in ban:
+                heapq.heappush(self.expiry_heap, (ban["expires"], "ip", ban["ip"]))
+        elif kind == "unip":
+            self._unindex_ip_ban(op["ip"])
+        elif kind == "user":
+            self.user_bans[op["user_id"]] = None
+        elif kind == "unuser":
+            self.user_bans.pop(op["user_id"], None)
+        elif kind == "temp":
+            self.temp_bans[op["user_id"]] = op["ban"]
+            heapq.heappush(self.expiry_heap, (op["ban"]["expires"], "temp", op["user_id"]))
+        elif kind == "untemp":
+            self.temp_bans.pop(op["user_id"], None)
+    
+    def _replay(self):
+        """Применение строк журнала после self.offset"""
+        try:
+            with open(self.journal_path, 'rb') as f:
+                f.seek(self.offset)
+                tail = f.read()
+        except FileNotFoundError:
+            return
+        end = tail.rfind(b'\n') + 1  # Незавершенная строка ещё пишется или оборвана сбоем
+        for line in tail[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError):
+                app.logger.warning("Skipping corrupted bans journal line: %r", line[:200])
+            self.journal_ops += 1
+        self.offset += end
+    
+    def _index_ip_ban(self, ban):
+        try:
+            ban["ip"] = normalize_ip_target(ban["ip"])
+        except ValueError:
+            pass  # Некорректная запись — только точное совпадение строки
+        self.ip_bans[ban["ip"]] = ban
+        if '/' in ban["ip"] or '-' in ban["ip"]:
+            for network in ip_target_networks(ban["ip"]):
+                self.ip_tries[network.version].insert(int(network.network_address), network.prefixlen, ban["ip"])
+    
+    def _unindex_ip_ban(self, target):
+        ban = self.ip_bans.pop(target, None)
+        if ban and ('/' in target or '-' in target):
+            removed = set(ip_target_networks(target))
+            for network in removed:
+                self.ip_tries[network.version].remove(int(network.network_address), network.prefixlen)
+            # Та же подсеть может входить в другой бан (например, CIDR и диапазон): возвращаем её
+            for other in self.ip_bans:
+                if '/' in other or '-' in other:
+                    try:
+                        networks = ip_target_networks(other)
+                    except ValueError:
+                        continue
+                    for network in networks:
+                        if network in removed:
+                            self.ip_tries[network.version].insert(int(network.network_address), network.prefixlen, other)
+        return ban
+    
+    def refresh(self, force=False):
+        """Подхватывает новый снимок или новые строки журнала (не чаще BAN_RELOAD_INTERVAL)"""
+        now = time.time()
+        if not force and now - self.checked_at < BAN_RELOAD_INTERVAL:
+            return
+        with self.lock:
+            self.checked_at = now
+            stamp = self._file_stamp()
+            try:
+                journal_size = os.path.getsize(self.journal_path)
+            except OSError:
+                journal_size = 0
+            if stamp != self.stamp or journal_size < self.offset:
+                if self._load():
+                    self.stamp = stamp
+                else:
+                    return
+            if journal_size > self.offset:
+                self._replay()
+    
+    def _expire(self, now):
+        heap = self.expiry_heap
+        while heap and heap[0][0] <= now:
+            expires, kind, target = heapq.heappop(heap)
+            # Запись могла быть заменена или снята — удаляем только совпадающую
+            bans = self.ip_bans if kind == "ip" else self.temp_bans
+            if target in bans and bans[target].get("expires") == expires:
+                if kind == "ip":
+                    self._unindex_ip_ban(target)
+                else:
+                    del bans[target]
+    
+    def _commit(self, op):
+        """Применение изменения и запись его в журнал (под self.lock)"""
+        with file_lock(self.lock_path):
+            self.refresh(force=True)
+            self._apply(op)
+            with open(self.journal_path, 'ab') as f:
+                # Хвост без перевода строки — обрыв после сбоя, отделяем его
+                prefix = b'\n' if f.tell() > self.offset else b''
+                line = prefix + json.dumps(op, ensure_ascii=False).encode('utf-8') + b'\n'
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+                self.offset = f.tell()
+            self.journal_ops += 1
+            if self.journal_ops >= BAN_JOURNAL_COMPACT_EVERY:
+                self._compact()
+    
+    def compact(self):
+        """Новый снимок (атомарно) и пустой журнал"""
+        with self.lock, file_lock(self.lock_path):
+            self.refresh(force=True)
+            self._compact()
+    
+    def _compact(self):
+        self._expire(datetime.now().isoformat())
+        save_bans(self.snapshot(), self.path)
+        with open(self.journal_path, 'wb') as f:
+            os.fsync(f.fileno())
+        self.stamp = self._file_stamp()
+        self.offset = 0
+        self.journal_ops = 0
+    
+    def is_banned(self, ip_address=None, user_id=None):
+        self.refresh()
+        with self.lock:
+            self._expire(datetime.now().isoformat())
+            
+            # Проверка IP банов: точное совпадение, затем самая узкая подсеть
+            if ip_address:
+                key = ip_address if ip_address in self.ip_bans else None
+                if key is None:
+                    try:
+                        address = ipaddress.ip_address(ip_address)
+                        key = self.ip_tries[address.version].lookup(int(address))
+                    except ValueError:
+                        pass
+                if key is not None:
+                    return True, self.ip_bans[key].get("reason", "IP заблокирован")
+            
+            # Проверка банов пользователей
+            if user_id:
+                if user_id in self.user_bans:
+                    return True, "Аккаунт заблокирован"
+                
+                # Проверка временных банов
+                if user_id in self.temp_bans:
+                    return True, f"Временная блокировка до {self.temp_bans[user_id]['expires']}"
         
-        return spam_score > 3  # Если больше 3 баллов - считаем спамом
+        return False, None
+    
+    def snapshot(self):
+        with self.lock:
+            return {
+                "ip_bans": list(self.ip_bans.values()),
+                "user_bans": list(self.user_bans),
+                "temp_bans": dict(self.temp_bans)
+            }
+    
+    def counts(self):
+        self.refresh()
+        with self.lock:
+            self._expire(datetime.now().isoformat())
+            return len(self.ip_bans), len(self.user_bans), len(self.temp_bans)
+    
+    # Изменения администратором: сначала подхватываем чужие изменения файла
+    def add_ip_ban(self, ban):
+        ban["ip"] = normalize_ip_target(ban["ip"])
+        with self.lock:
+            self._commit({"op": "ip", "ban": ban})
+    
+    def remove_ip_ban(self, ip):
+        try:
+            ip = normalize_ip_target(ip)
+        except ValueError:
+            pass
+        with self.lock:
+            self._commit({"op": "unip", "ip": ip})
+    
+    def add_user_ban(self, user_id):
+        """Возвращает False, если пользователь уже заблокирован"""
+        with self.lock:
+            self.refresh(force=True)
+            if user_id in self.user_bans:
+                return False
+            self._commit({"op": "user", "user_id": user_id})
+            return True
+    
+    def remove_user_ban(self, user_id):
+        """Возвращает False, если пользователь не был заблокирован"""
+        with self.lock:
+            self.refresh(force=True)
+            if user_id not in self.user_bans:
+                return False
+            self._commit({"op": "unuser", "user_id": user_id})
+            return True
+    
+    def add_temp_ban(self, user_id, ban):
+        with self.lock:
+            self._commit({"op": "temp", "user_id": user_id, "ban": ban})
+    
+    def remove_temp_ban(self, user_id):
+        with self.lock:
+            self._commit({"op": "untemp", "user_id": user_id})
 
-anti_spam = AntiSpam()
+ban_manager = BanManager(BANS_FILE)
 
 # Проверка бана
 def is_banned(ip_address=None, user_id=None):
-    bans = load_bans()
-    now = datetime.now().isoformat()
-    
-    # Проверка IP банов
-    if ip_address:
-        for ban in bans["ip_bans"]:
-            if ban["ip"] == ip_address:
-                if "expires" in ban and ban["expires"] < now:
-                    # Удаляем просроченный бан
-                    bans["ip_bans"] = [b for b in bans["ip_bans"] if b["ip"] != ip_address]
-                    save_bans(bans)
-                else:
-                    return True, ban.get("reason", "IP заблокирован")
-    
-    # Проверка банов пользователей
-    if user_id:
-        if user_id in bans["user_bans"]:
-            return True, "Аккаунт заблокирован"
-        
-        # Проверка временных банов
-        if user_id in bans["temp_bans"]:
-            ban_info = bans["temp_bans"][user_id]
-            if ban_info["expires"] > now:
-                return True, f"Временная блокировка до {ban_info['expires']}"
-            else:
-                # Удаляем просроченный бан
-                del bans["temp_bans"][user_id]
-                save_bans(bans)
-    
-    return False, None
+    return ban_manager.is_banned(ip_address=ip_address, user_id=user_id)
 
 # Декораторы для проверки
 def require_admin(f):
@@ -330,36 +2765,805 @@ def spam_protection(limit_type="requests"):
 def generate_id(prefix):
     return f"{prefix}_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
 
+def find_record_by_id(collection, record_id, db):
+    index = get_index(db)
+    if index:
+        return index.by_id[collection].get(record_id)
+    for record in db[collection]:
+        if record["id"] == record_id:
+            return record
+    return None
+
 def find_user_by_id(user_id, db):
+    return find_record_by_id("users", user_id, db)
+
+def find_user_by_username(username, db):
+    index = get_index(db)
+    if index:
+        return index.by_username.get(username)
     for user in db["users"]:
-        if user["id"] == user_id:
+        if user["username"] == username:
             return user
     return None
 
-def find_user_by_username(username, db):
+def find_user_by_email(email, db):
+    index = get_index(db)
+    if index:
+        return index.by_email.get(email)
     for user in db["users"]:
-        if user["username"] == username:
+        if user["email"] == email:
             return user
     return None
 
 def find_post_by_id(post_id, db):
-    for post in db["posts"]:
-        if post["id"] == post_id:
-            return post
-    return None
+    return find_record_by_id("posts", post_id, db)
 
 def find_video_by_id(video_id, db):
-    for video in db["videos"]:
-        if video["id"] == video_id:
-            return video
-    return None
+    return find_record_by_id("videos", video_id, db)
 
 def find_clan_by_id(clan_id, db):
-    for clan in db["clans"]:
-        if clan["id"] == clan_id:
-            return clan
+    return find_record_by_id("clans", clan_id, db)
+
+def reports_for_target(target_id, db):
+    index = get_index(db)
+    if index:
+        return index.reports_by_target.get(target_id, [])
+    return [r for r in db["reports"] if r.get("targetId") == target_id]
+
+# Курсорная пагинация
+def encode_cursor(record):
+    raw = json.dumps(list(sort_key(record)), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, record_id = json.loads(raw)
+        return (str(created_at), str(record_id))
+    except (ValueError, TypeError):
+        return None
+
+def keyset_page(db, collection, cursor_key, limit, predicate=None):
+    """Страница записей по убыванию (createdAt, id) строго после курсора.
+    
+    Возвращает (записи, следующий курсор или None). Просматриваются только
+    записи до заполнения страницы.
+    """
+    index = get_index(db)
+    if index and collection in index.sorted:
+        keys = index.sorted[collection]
+        by_id = index.by_id[collection]
+        start = bisect.bisect_left(keys, cursor_key) if cursor_key else len(keys)
+        candidates = (by_id[keys[i][1]] for i in range(start - 1, -1, -1))
+    else:
+        candidates = sorted(db[collection], key=sort_key, reverse=True)
+        if cursor_key:
+            candidates = (r for r in candidates if sort_key(r) < cursor_key)
+    
+    page = []
+    for record in candidates:
+        if predicate is None or predicate(record):
+            page.append(record)
+            if len(page) > limit:
+                break
+    
+    if len(page) > limit:
+        page = page[:limit]
+        return page, encode_cursor(page[-1])
+    return page, None
+
+def parse_fields(value):
+    """Список полей из параметра fields=a,b,c (None — все поля)"""
+    fields = [f.strip() for f in (value or '').split(',') if f.strip()]
+    return fields or None
+
+def project(record, fields):
+    if not fields:
+        return record
+    return {k: record[k] for k in fields if k in record}
+
+# Потоковые ответы: записи сериализуются по мере генерации, а не целым списком
+def stream_format():
+    """'ndjson' — запись на строку, 'stream' — JSON по частям, None — обычный ответ"""
+    fmt = request.args.get('format')
+    return fmt if fmt in ('ndjson', 'stream') else None
+
+def buffered(pieces, size=STREAM_CHUNK_SIZE):
+    """Склейка мелких строк в части около size символов"""
+    buffer, length = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def json_array(items):
+    yield '['
+    for i, item in enumerate(items):
+        yield (', ' if i else '') + json.dumps(item, ensure_ascii=False)
+    yield ']'
+
+def stream_response(pieces, fmt, headers=None):
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return Response(stream_with_context(buffered(pieces)), mimetype=mimetype, headers=headers)
+
+def stream_list(head, key, items, fmt):
+    """Ответ со списком items в режиме fmt.
+    
+    stream — объект head с массивом key; ndjson — только записи,
+    поля head (total, next_cursor) передаются заголовками X-Total, X-Next-Cursor.
+    """
+    if fmt == 'ndjson':
+        headers = {"X-" + k.replace('_', '-').title(): str(v)
+                   for k, v in head.items() if k != "success" and v is not None}
+        return stream_response((json.dumps(item, ensure_ascii=False) + '\n' for item in items), fmt, headers)
+    
+    def pieces():
+        yield json.dumps(head, ensure_ascii=False)[:-1] + (', ' if head else '') + json.dumps(key) + ': '
+        yield from json_array(items)
+        yield '}'
+    return stream_response(pieces(), fmt)
+
+def find_comment_by_id(comment_id, db):
+    return find_record_by_id("comments", comment_id, db)
+
+def find_report_by_id(report_id, db):
+    return find_record_by_id("reports", report_id, db)
+
+# ==================== ЛЕНТА ====================
+
+def can_see_post(post, viewer, author):
+    """Видит ли viewer (None — гость) пост автора author.
+    
+    Скрытые посты не видны никому, кроме автора; friends — взаимные
+    подписчики, clan — участники того же клана.
+    """
+    if viewer and viewer["id"] == post["userId"]:
+        return True
+    if post.get("hidden"):
+        return False
+    visibility = post.get("visibility", "public")
+    if visibility == "public":
+        return True
+    if not viewer:
+        return False
+    if visibility == "friends":
+        return viewer["id"] in author.get("following", []) and author["id"] in viewer.get("following", [])
+    if visibility == "clan":
+        return bool(author.get("clan")) and viewer.get("clan") == author.get("clan")
+    return False
+
+class FeedStore:
+    """Домашние ленты: заранее собранные списки постов подписок.
+    
+    При публикации пост раскладывается (fan-out on write) в таблицу
+    timelines автору и подписчикам, которым он виден; лента каждого
+    ограничена FEED_TIMELINE_LENGTH последними постами. Посты авторов
+    с числом подписчиков больше FEED_FANOUT_LIMIT не раскладываются,
+    а подмешиваются при чтении (fan-out on read). При чтении видимость
+    проверяется повторно: пост могли скрыть, а подписки — изменить.
+    """
+    BUILT_MARKER = ("", "", "built", "")  # Служебная строка: ленты собраны
+    
+    def __init__(self, storage):
+        self.storage = storage
+    
+    @staticmethod
+    def is_popular(author):
+        return len(author.get("followers", [])) > FEED_FANOUT_LIMIT
+    
+    @staticmethod
+    def recipients(db, post, author):
+        """Автор и подписчики, которым пост виден"""
+        user_ids = [author["id"]]
+        for follower_id in author.get("followers", []):
+            follower = find_user_by_id(follower_id, db)
+            if follower and follower_id != author["id"] and can_see_post(post, follower, author):
+                user_ids.append(follower_id)
+        return user_ids
+    
+    def push(self, entries):
+        """Добавление пар (пользователь, пост) с обрезкой лент до FEED_TIMELINE_LENGTH"""
+        if not entries:
+            return
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO timelines (user_id, created_at, post_id, author_id) VALUES (?, ?, ?, ?)",
+                             [(user_id, post.get("createdAt") or "", post["id"], post["userId"])
+                              for user_id, post in entries])
+            conn.executemany("""
+                DELETE FROM timelines WHERE user_id = ? AND created_at < (
+                    SELECT created_at FROM timelines WHERE user_id = ? ORDER BY created_at DESC LIMIT 1 OFFSET ?
+                )""", [(user_id, user_id, FEED_TIMELINE_LENGTH - 1) for user_id in {user_id for user_id, _ in entries}])
+    
+    def fan_out(self, db, post):
+        if post.get("hidden"):
+            return
+        author = find_user_by_id(post["userId"], db)
+        if not author or self.is_popular(author):
+            return
+        self.push([(user_id, post) for user_id in self.recipients(db, post, author)])
+    
+    def remove_post(self, post_id):
+        with self.storage.transaction() as conn:
+            conn.execute("DELETE FROM timelines WHERE post_id = ?", (post_id,))
+    
+    def remove_user(self, user_id):
+        with self.storage.transaction() as conn:
+            conn.execute("DELETE FROM timelines WHERE user_id = ?", (user_id,))
+    
+    def follow(self, db, follower, author):
+        """Последние посты нового автора в ленте подписчика"""
+        if self.is_popular(author):
+            return
+        entries = []
+        for _, post_id in self._scan("posts", "id", author["id"], None):
+            post = find_record_by_id("posts", post_id, db)
+            if post and can_see_post(post, follower, author):
+                entries.append((follower["id"], post))
+                if len(entries) >= FEED_BACKFILL:
+                    break
+        self.push(entries)
+    
+    def unfollow(self, follower_id, author_id):
+        with self.storage.transaction() as conn:
+            conn.execute("DELETE FROM timelines WHERE user_id = ? AND author_id = ?", (follower_id, author_id))
+    
+    def is_built(self):
+        with self.storage.lock:
+            return self.storage.connect().execute(
+                "SELECT 1 FROM timelines WHERE user_id = '' AND post_id = 'built'"
+            ).fetchone() is not None
+    
+    def ensure_built(self, db):
+        # Проверка чтением: ленты мог сбросить импорт в другом процессе,
+        # а блокировка записи нужна только для сборки
+        if self.is_built():
+            return
+        with self.storage.transaction():
+            if not self.is_built():
+                self.rebuild(db)
+    
+    def rebuild(self, db):
+        """Сборка всех лент по текущим постам и подпискам"""
+        timelines = {}
+        for post in sorted(db["posts"], key=sort_key, reverse=True):
+            author = find_user_by_id(post["userId"], db)
+            if post.get("hidden") or not author or self.is_popular(author):
+                continue
+            for user_id in self.recipients(db, post, author):
+                timeline = timelines.setdefault(user_id, [])
+                if len(timeline) < FEED_TIMELINE_LENGTH:
+                    timeline.append((user_id, post.get("createdAt") or "", post["id"], post["userId"]))
+        with self.storage.transaction() as conn:
+            conn.execute("DELETE FROM timelines")
+            conn.executemany("INSERT INTO timelines (user_id, created_at, post_id, author_id) VALUES (?, ?, ?, ?)",
+                             (entry for timeline in timelines.values() for entry in timeline))
+            conn.execute("INSERT INTO timelines (user_id, created_at, post_id, author_id) VALUES (?, ?, ?, ?)",
+                         self.BUILT_MARKER)
+    
+    def _scan(self, table, id_column, user_id, before):
+        """(created_at, id) строк пользователя по убыванию строго после before, частями"""
+        while True:
+            where = "user_id = ?" + (f" AND (created_at, {id_column}) < (?, ?)" if before else "")
+            with self.storage.lock:
+                rows = self.storage.connect().execute(
+                    f"SELECT created_at, {id_column} FROM {table} WHERE {where} "
+                    f"ORDER BY created_at DESC, {id_column} DESC LIMIT ?",
+                    (user_id, *(before or ()), FEED_FETCH_SIZE)
+                ).fetchall()
+            yield from rows
+            if len(rows) < FEED_FETCH_SIZE:
+                return
+            before = rows[-1]
+    
+    @staticmethod
+    def _page(db, viewer, keys, limit):
+        """Первые limit видимых постов из упорядоченных ключей и следующий курсор"""
+        page = []
+        seen = set()
+        for _, post_id in keys:
+            if post_id in seen:
+                continue
+            seen.add(post_id)
+            post = find_record_by_id("posts", post_id, db)
+            author = post and find_user_by_id(post["userId"], db)
+            if author and can_see_post(post, viewer, author):
+                page.append(post)
+                if len(page) > limit:
+                    break
+        
+        if len(page) > limit:
+            page = page[:limit]
+            return page, encode_cursor(page[-1])
+        return page, None
+    
+    def home(self, db, viewer, cursor_key, limit):
+        """Страница домашней ленты: собранная лента и посты популярных авторов"""
+        self.ensure_built(db)
+        sources = [self._scan("timelines", "post_id", viewer["id"], cursor_key)]
+        for author_id in set(viewer.get("following", [])) | {viewer["id"]}:
+            author = find_user_by_id(author_id, db)
+            if author and self.is_popular(author):
+                sources.append(self._scan("posts", "id", author_id, cursor_key))
+        return self._page(db, viewer, heapq.merge(*sources, reverse=True), limit)
+    
+    def profile(self, db, viewer, author, cursor_key, limit):
+        """Страница постов автора, видимых viewer"""
+        return self._page(db, viewer, self._scan("posts", "id", author["id"], cursor_key), limit)
+
+feeds = FeedStore(storage)
+
+# ==================== ОБРАБОТКА МЕДИА ====================
+
+def media_relpath(path):
+    """Путь файла внутри media/ с разделителями '/'"""
+    return os.path.relpath(path, MEDIA_FOLDER).replace(os.sep, "/")
+
+def media_kind(source):
+    """'image', 'video' или None, если для файла копии не создаются"""
+    if source.startswith(("variants/", "blobs/tmp/")):
+        return None
+    ext = os.path.splitext(source)[1].lstrip(".").lower()
+    if ext in MEDIA_IMAGE_EXTENSIONS:
+        return "image"
+    if ext in MEDIA_VIDEO_EXTENSIONS:
+        return "video"
+    return None
+
+def variant_path(source, size):
+    """media/variants/<размер>/<путь без расширения>.jpg; имя-хэш остаётся хэшем"""
+    return os.path.join(MEDIA_FOLDER, 'variants', size, os.path.splitext(source)[0] + '.jpg')
+
+class MediaJobQueue:
+    """Очередь задач в SQLite, общая для процессов-воркеров.
+    
+    Задача уникальна по исходному файлу, поэтому повторная постановка ничего
+    не меняет. Кроме медиа, здесь же выполняются фоновые задачи из
+    BACKGROUND_TASKS (source — имя задачи, params — JSON аргументов):
+    завершенная задача запускается заново, выполняющаяся — нет. Воркер берет задачу в аренду на 2 * MEDIA_JOB_TIMEOUT: задача
+    упавшего воркера по истечении аренды достается другому. Ошибки
+    повторяются с растущей задержкой до MEDIA_JOB_MAX_ATTEMPTS попыток.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+    
+    def enqueue(self, source, retry_failed=False, params=None):
+        """Постановка задачи; retry_failed — заново запустить завершившуюся ошибкой.
+        
+        Возвращает True, если задача поставлена или перезапущена.
+        """
+        task = source in BACKGROUND_TASKS
+        if not task and not media_kind(source):
+            return False
+        now = datetime.now().isoformat()
+        restart = "('done', 'failed')" if task else "('failed')"
+        reset = f""" DO UPDATE SET status = 'pending', attempts = 0, error = NULL, progress = 0,
+            run_after = excluded.run_after, updated_at = excluded.updated_at, params = excluded.params
+            WHERE media_jobs.status IN {restart}""" if retry_failed or task else " DO NOTHING"
+        with self.storage.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO media_jobs (source, status, run_after, updated_at, params) VALUES (?, 'pending', ?, ?, ?)"
+                " ON CONFLICT (source)" + reset,
+                (source, time.time(), now, json.dumps(params, ensure_ascii=False) if params is not None else None)
+            )
+            return cursor.rowcount == 1
+    
+    def status(self, source):
+        with self.storage.lock:
+            row = self.storage.connect().execute(
+                "SELECT status, progress, attempts, error FROM media_jobs WHERE source = ?", (source,)
+            ).fetchone()
+        if not row:
+            return None
+        return {"status": row[0], "progress": row[1], "attempts": row[2], "error": row[3]}
+    
+    def forget(self, source):
+        with self.storage.transaction() as conn:
+            conn.execute("DELETE FROM media_jobs WHERE source = ?", (source,))
+    
+    def claim(self):
+        """Следующая готовая задача (id, source, попытка, параметры) или None"""
+        now = time.time()
+        with self.storage.transaction() as conn:
+            # Воркер несколько раз не уложился в аренду (завис или был убит)
+            conn.execute("""
+                UPDATE media_jobs SET status = 'failed', error = 'Превышено время обработки', lease_until = NULL
+                WHERE status = 'running' AND lease_until < ? AND attempts >= ?
+            """, (now, MEDIA_JOB_MAX_ATTEMPTS))
+            row = conn.execute("""
+                SELECT id, source, attempts, params FROM media_jobs
+                WHERE (status = 'pending' AND run_after <= ?) OR (status = 'running' AND lease_until < ?)
+                ORDER BY run_after, id LIMIT 1
+            """, (now, now)).fetchone()
+            if not row:
+                return None
+            conn.execute("""
+                UPDATE media_jobs SET status = 'running', attempts = attempts + 1, progress = 0,
+                    lease_until = ?, updated_at = ? WHERE id = ?
+            """, (now + 2 * MEDIA_JOB_TIMEOUT, datetime.now().isoformat(), row[0]))
+        return row[0], row[1], row[2] + 1, json.loads(row[3]) if row[3] else {}
+    
+    def progress(self, job_id, percent):
+        """Прогресс задачи; заодно продлевает аренду долгих задач"""
+        with self.storage.transaction() as conn:
+            conn.execute("UPDATE media_jobs SET progress = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+                         (percent, time.time() + 2 * MEDIA_JOB_TIMEOUT, datetime.now().isoformat(), job_id))
+    
+    def complete(self, job_id):
+        with self.storage.transaction() as conn:
+            conn.execute("""
+                UPDATE media_jobs SET status = 'done', progress = 100, error = NULL, lease_until = NULL,
+                    updated_at = ? WHERE id = ?
+            """, (datetime.now().isoformat(), job_id))
+    
+    def fail(self, job_id, attempt, error, retry=True):
+        retry = retry and attempt < MEDIA_JOB_MAX_ATTEMPTS
+        with self.storage.transaction() as conn:
+            conn.execute("""
+                UPDATE media_jobs SET status = ?, error = ?, run_after = ?, lease_until = NULL,
+                    updated_at = ? WHERE id = ?
+            """, ('pending' if retry else 'failed', error,
+                  time.time() + MEDIA_JOB_RETRY_DELAY * 2 ** (attempt - 1), datetime.now().isoformat(), job_id))
+    
+    def counts(self):
+        with self.storage.lock:
+            rows = self.storage.connect().execute("SELECT status, COUNT(*) FROM media_jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+media_jobs = MediaJobQueue(storage)
+
+def save_variant(image, path):
+    """JPEG во временный файл и переименование: читатели не видят недописанный файл"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    image.save(tmp_path, "JPEG", quality=MEDIA_VARIANT_QUALITY, optimize=True)
+    os.replace(tmp_path, path)
+
+def extract_poster(video_path, output_path):
+    """Кадр видео через ffmpeg; для коротких видео — первый кадр"""
+    for offset in (MEDIA_POSTER_OFFSET, 0):
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-ss", str(offset), "-i", video_path, "-frames:v", "1", output_path],
+            capture_output=True, timeout=MEDIA_JOB_TIMEOUT, check=True
+        )
+        if os.path.getsize(output_path):
+            return
+    raise RuntimeError("Не удалось получить кадр видео")
+
+def process_media_job(job_id, source, report=None):
+    """Создание всех уменьшенных копий файла; готовые копии пропускаются"""
+    kind = media_kind(source)
+    source_path = os.path.join(MEDIA_FOLDER, source)
+    pending = [(name, side) for name, side in MEDIA_VARIANT_SIZES.items()
+               if not os.path.exists(variant_path(source, name))]
+    if not pending:
+        return
+    steps = len(pending) + (kind == "video")
+    
+    poster_path = None
+    if kind == "video":
+        fd, poster_path = tempfile.mkstemp(suffix=".jpg", dir=os.path.join(BLOB_FOLDER, 'tmp'))
+        os.close(fd)
+    try:
+        if poster_path:
+            extract_poster(source_path, poster_path)
+            if report:
+                report(job_id, 100 // steps)
+        with Image.open(poster_path or source_path) as original:
+            original = ImageOps.exif_transpose(original).convert("RGB")
+            for done, (name, side) in enumerate(pending, start=1 + (kind == "video")):
+                image = original.copy()
+                image.thumbnail((side, side), Image.LANCZOS)  # Не увеличивает маленькие изображения
+                save_variant(image, variant_path(source, name))
+                if report:
+                    report(job_id, 100 * done // steps)
+    finally:
+        if poster_path:
+            os.remove(poster_path)
+
+def missing_media_tools(source):
+    """Чего не хватает для обработки файла (повторы бесполезны)"""
+    if Image is None:
+        return "Pillow не установлен"
+    if media_kind(source) == "video" and not shutil.which("ffmpeg"):
+        return "ffmpeg не найден"
     return None
 
+def run_media_worker(stop_when_idle=False):
+    """Цикл воркера: берет задачи из очереди, пока не будет остановлен"""
+    while True:
+        job = media_jobs.claim()
+        if job is None:
+            if stop_when_idle:
+                return
+            time.sleep(MEDIA_POLL_INTERVAL)
+            continue
+        
+        job_id, source, attempt, params = job
+        if source in BACKGROUND_TASKS:
+            try:
+                BACKGROUND_TASKS[source](job_id, params, report=media_jobs.progress)
+            except Exception as e:
+                media_jobs.fail(job_id, attempt, f"{type(e).__name__}: {e}")
+            else:
+                media_jobs.complete(job_id)
+            continue
+        
+        missing = missing_media_tools(source)
+        if missing:
+            media_jobs.fail(job_id, attempt, missing, retry=False)
+            continue
+        if not os.path.isfile(os.path.join(MEDIA_FOLDER, source)):
+            media_jobs.fail(job_id, attempt, "Файл не найден", retry=False)
+            continue
+        try:
+            process_media_job(job_id, source, report=media_jobs.progress)
+        except Exception as e:
+            media_jobs.fail(job_id, attempt, f"{type(e).__name__}: {e}")
+        else:
+            media_jobs.complete(job_id)
+
+def start_media_workers(count=MEDIA_WORKERS):
+    """Фоновые процессы обработки; завершаются вместе с сервером.
+    
+    Процессы не демонические: фоновые задачи (перепроверка) запускают
+    собственный пул процессов. Прерванную задачу по истечении аренды
+    подхватит воркер, запущенный следующим.
+    """
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for _ in range(count):
+        worker = context.Process(target=run_media_worker)
+        worker.start()
+        workers.append(worker)
+    atexit.register(lambda: [worker.terminate() for worker in workers if worker.is_alive()])
+    return workers
+
+def scan_media(retry_failed=False):
+    """Постановка задач для файлов, положенных в media/images, videos и stories напрямую"""
+    queued = 0
+    for folder in ('images', 'videos', 'stories'):
+        for root, _, names in os.walk(os.path.join(MEDIA_FOLDER, folder)):
+            for name in names:
+                source = media_relpath(os.path.join(root, name))
+                if media_kind(source):
+                    media_jobs.enqueue(source, retry_failed=retry_failed)
+                    queued += 1
+    return queued
+
+# ==================== ПЕРЕПРОВЕРКА КОНТЕНТА ====================
+
+# Текстовое поле каждой проверяемой коллекции и тип репорта
+RESCAN_COLLECTIONS = (("posts", "content", "post"), ("comments", "text", "comment"))
+
+_rescan_rules = None
+
+def _init_rescan_worker(weights):
+    global _rescan_rules
+    _rescan_rules = SpamRules(weights)
+
+def score_texts(texts):
+    """Баллы спама для пачки текстов (выполняется в процессе пула)"""
+    return [_rescan_rules.score(text) for text in texts]
+
+def load_rescan_checkpoint():
+    try:
+        with open(RESCAN_CHECKPOINT_FILE, 'r', encoding='utf-8') as f:
+            return {k: tuple(v) for k, v in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+def save_rescan_checkpoint(checkpoint):
+    write_atomic(RESCAN_CHECKPOINT_FILE, checkpoint, ensure_ascii=False)
+
+def iter_rescan_chunks(db, checkpoint, chunk_size):
+    """Пачки (коллекция, [записи]) в порядке (createdAt, id) после контрольной точки"""
+    for collection, _, _ in RESCAN_COLLECTIONS:
+        # Снимок ключей: параллельные вставки и удаления не сдвигают обход
+        with document_cache.lock:
+            index = get_index(db)
+            if index:
+                keys = list(index.sorted[collection])
+                by_id = index.by_id[collection]
+            else:
+                records = sorted(db[collection], key=sort_key)
+                keys = [sort_key(r) for r in records]
+                by_id = {r["id"]: r for r in records}
+        
+        start = bisect.bisect_right(keys, checkpoint[collection]) if collection in checkpoint else 0
+        for i in range(start, len(keys), chunk_size):
+            with document_cache.lock:
+                # Удаленные после снимка записи пропускаются
+                records = [record for record in (by_id.get(key[1]) for key in keys[i:i + chunk_size]) if record]
+            if records:
+                yield collection, records
+
+def flag_spam(db, collection, record, score):
+    """Репорт на запись, если на неё ещё нет ожидающего автоматического репорта"""
+    report_type = dict((c, t) for c, _, t in RESCAN_COLLECTIONS)[collection]
+    for report in reports_for_target(record["id"], db):
+        if report.get("reporterId") == "SYSTEM" and report.get("status") == "pending":
+            return False
+    
+    insert_record(db, "reports", {
+        "id": generate_id("report"),
+        "reporterId": "SYSTEM",
+        "targetId": record["id"],
+        "type": report_type,
+        "reason": "spam",
+        "details": f"Автоматическая проверка: {score:g} баллов",
+        "status": "pending",
+        "createdAt": datetime.now().isoformat(),
+        "source": "rescan"
+    })
+    return True
+
+def rescan_content(processes=RESCAN_PROCESSES, chunk_size=RESCAN_CHUNK_SIZE, max_items=None, reset=False,
+                   progress=None):
+    """Повторная проверка существующих постов и комментариев на спам.
+    
+    Записи читаются пачками и оцениваются в пуле процессов, спам отмечается
+    репортами в db["reports"]. После каждой пачки сохраняется контрольная
+    точка, поэтому прерванная или ограниченная max_items проверка
+    продолжается с того же места. progress(stats) вызывается после пачки.
+    """
+    db = load_database()
+    checkpoint = {} if reset else load_rescan_checkpoint()
+    weights = anti_spam.rules().weights
+    fields = {collection: field for collection, field, _ in RESCAN_COLLECTIONS}
+    stats = {"scanned": 0, "flagged": 0, "done": False}
+    started = time.time()
+    
+    if max_items is not None:
+        chunk_size = max(min(chunk_size, max_items), 1)
+    chunks = iter_rescan_chunks(db, checkpoint, chunk_size)
+    
+    def budgeted(chunks):
+        # Не больше max_items записей, учитывая уже отправленные в пул
+        queued = 0
+        for collection, records in chunks:
+            if max_items is not None:
+                if queued >= max_items:
+                    return
+                records = records[:max_items - queued]
+            queued += len(records)
+            yield collection, records
+        stats["done"] = True
+    
+    chunks = budgeted(chunks)
+    
+    def process(collection, records, scores):
+        # Репорты проверяются и добавляются в актуальной базе: за время
+        # проверки её могли изменить другие запросы и воркеры
+        with transaction() as current:
+            for record, score in zip(records, scores):
+                if score <= SPAM_SCORE_THRESHOLD:
+                    continue
+                record = find_record_by_id(collection, record["id"], current)
+                if record and flag_spam(current, collection, record, score):
+                    stats["flagged"] += 1
+        stats["scanned"] += len(records)
+        checkpoint[collection] = list(sort_key(records[-1]))
+        save_rescan_checkpoint(checkpoint)
+        if progress:
+            progress(stats)
+    
+    if processes == 0:
+        _init_rescan_worker(weights)
+        for collection, records in chunks:
+            process(collection, records, score_texts([r.get(fields[collection], "") for r in records]))
+    else:
+        # spawn: дочерние процессы не наследуют потоки и блокировки сервера
+        context = multiprocessing.get_context('spawn')
+        workers = processes or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_rescan_worker,
+                                 initargs=(weights,)) as pool:
+            in_flight = deque()
+            max_in_flight = workers * 2
+            for collection, records in chunks:
+                texts = [r.get(fields[collection], "") for r in records]
+                in_flight.append((collection, records, pool.submit(score_texts, texts)))
+                if len(in_flight) >= max_in_flight:
+                    collection, records, future = in_flight.popleft()
+                    process(collection, records, future.result())
+            while in_flight:
+                collection, records, future = in_flight.popleft()
+                process(collection, records, future.result())
+    
+    elapsed = time.time() - started
+    stats["seconds"] = round(elapsed, 3)
+    stats["items_per_second"] = round(stats["scanned"] / elapsed, 1) if elapsed > 0 else 0.0
+    return stats
+
+RESCAN_TASK = "tasks/rescan"
+
+def run_rescan_task(job_id, params, report=None):
+    """Перепроверка в воркере очереди; прогресс — доля записей, просмотренных в этом запуске"""
+    db = load_database()
+    total = params.get("max_items") or sum(len(db[collection]) for collection, _, _ in RESCAN_COLLECTIONS)
+    
+    def progress(stats):
+        if report:
+            report(job_id, min(99, 100 * stats["scanned"] // max(total, 1)))
+    
+    stats = rescan_content(processes=params.get("processes", RESCAN_PROCESSES), max_items=params.get("max_items"),
+                           reset=params.get("reset", False), progress=progress)
+    log_activity("SYSTEM", "content_rescanned",
+                 f"Rescan: {stats['scanned']} items, {stats['flagged']} flagged", "127.0.0.1")
+
+# Фоновые задачи очереди media_jobs: имя -> функция(job_id, params, report)
+BACKGROUND_TASKS = {RESCAN_TASK: run_rescan_task}
+
+# ==================== ПРОВЕРКА ТРАНЗАКЦИЙ ====================
+
+STRESS_POST_ID = "post_stress_counter"
+
+def _stress_worker(workdir, threads, increments):
+    """Процесс нагрузки: потоки увеличивают счетчик поста и добавляют комментарии"""
+    os.chdir(workdir)  # Хранилище открывается при первом обращении, уже во временном каталоге
+    
+    def run():
+        for _ in range(increments):
+            with transaction() as db:
+                post = find_post_by_id(STRESS_POST_ID, db)
+                post["comments"] += 1
+                update_record(db, "posts", post)
+                insert_record(db, "comments", {
+                    "id": generate_id("comment"),
+                    "userId": "stress",
+                    "postId": STRESS_POST_ID,
+                    "text": "",
+                    "createdAt": datetime.now().isoformat()
+                })
+    
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def stress_transactions(processes=4, threads=4, increments=50):
+    """Проверка отсутствия потерянных обновлений при параллельной записи.
+    
+    processes процессов по threads потоков выполняют increments транзакций
+    read-modify-write над одним постом во временной базе. Счетчик поста
+    и число комментариев должны совпасть с числом транзакций.
+    """
+    workdir = tempfile.mkdtemp(prefix="stress_")
+    test_storage = Storage(os.path.join(workdir, STORAGE_FILE))
+    try:
+        test_storage.set_document("system_settings", {})
+        test_storage.insert("posts", {"id": STRESS_POST_ID, "userId": "stress", "content": "",
+                                      "createdAt": datetime.now().isoformat(), "comments": 0, "likes": []})
+        
+        started = time.time()
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=_stress_worker, args=(workdir, threads, increments)) for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - started
+        
+        expected = processes * threads * increments
+        counter = test_storage.get("posts", STRESS_POST_ID)["comments"]
+        with test_storage.lock:
+            comments = test_storage.connect().execute("SELECT COUNT(*) FROM comments").fetchone()[0]
+        return {
+            "expected": expected,
+            "counter": counter,
+            "comments": comments,
+            "lost": expected - counter,
+            "seconds": round(elapsed, 3),
+            "transactions_per_second": round(expected / elapsed, 1) if elapsed > 0 else 0.0
+        }
+    finally:
+        test_storage.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
 # ==================== АДМИН ПАНЕЛЬ ====================
 
 @app.route('/admin')
@@ -470,38 +3674,40 @@ def admin_login():
             return redirect(url_for('admin_login'))
         
         db = load_database()
-        user = None
-        
-        for u in db["users"]:
-            if u["username"] == username and u.get('isAdmin'):
-                user = u
-                break
+        user = find_user_by_username(username, db)
+        if user and not user.get('isAdmin'):
+            user = None
         
         if not user:
             log_activity("SYSTEM", "admin_login_failed", f"Invalid username: {username}", request.remote_addr)
             return redirect(url_for('admin_login'))
         
-        # Проверка пароля
-        if user['password'] != hash_password(password):
+        # Проверка пароля (вне транзакции — KDF не держит блокировку записи)
+        if not verify_password(password, user['password']):
             # Счетчик попыток входа
-            user['login_attempts'] = user.get('login_attempts', 0) + 1
-            save_database(db)
+            with transaction() as db:
+                user = find_user_by_id(user['id'], db)
+                user['login_attempts'] = user.get('login_attempts', 0) + 1
+                update_record(db, "users", user)
             
             log_activity(user['id'], "admin_login_failed", "Invalid password", request.remote_addr)
             
             # Блокировка после 5 неудачных попыток
             if user['login_attempts'] >= 5:
-                bans = load_bans()
-                bans["user_bans"].append(user['id'])
-                save_bans(bans)
+                ban_manager.add_user_ban(user['id'])
                 log_activity("SYSTEM", "admin_banned", f"Admin account locked: {user['id']}")
             
             return redirect(url_for('admin_login'))
         
-        # Сброс счетчика попыток
-        user['login_attempts'] = 0
-        user['last_login'] = datetime.now().isoformat()
-        save_database(db)
+        # Сброс счетчика попыток и перевод хэша на текущую схему
+        new_hash = hash_password(password) if passwords.needs_rehash(user['password']) else None
+        with transaction() as db:
+            user = find_user_by_id(user['id'], db)
+            user['login_attempts'] = 0
+            user['last_login'] = datetime.now().isoformat()
+            if new_hash:
+                user['password'] = new_hash
+            update_record(db, "users", user)
         
         # Создание сессии
         session['admin_id'] = user['id']
@@ -524,42 +3730,47 @@ def admin_logout():
 
 @app.route('/admin/api/dashboard')
 @require_admin
+@read_locked
 def admin_dashboard(admin):
     """Получение статистики для дашборда"""
     db = load_database()
-    bans = load_bans()
+    banned_ips, banned_users, temp_bans = ban_manager.counts()
     
-    # Статистика
-    stats = {
-        "total_users": len(db["users"]),
-        "total_posts": len(db["posts"]),
-        "total_videos": len(db["videos"]),
-        "total_comments": len(db["comments"]),
-        "active_stories": len([s for s in db["stories"] if 
-                              datetime.fromisoformat(s["createdAt"]) > datetime.now() - timedelta(hours=24)]),
-        "active_live": len([s for s in db["live_streams"] if s.get("active", False)]),
-        "reports_pending": len([r for r in db["reports"] if r.get("status") == "pending"]),
-        "banned_ips": len(bans["ip_bans"]),
-        "banned_users": len(bans["user_bans"]),
-        "temp_bans": len(bans["temp_bans"])
-    }
+    # Счетчики поддерживаются индексом при каждой записи
+    with document_cache.lock:
+        index = get_index(db) or DatabaseIndex(db)
+        metrics = index.metrics
+        week_ago = (datetime.now() - timedelta(days=7)).isoformat()
+        
+        # Статистика
+        stats = {
+            "total_users": len(db["users"]),
+            "total_posts": len(db["posts"]),
+            "total_videos": len(db["videos"]),
+            "total_comments": len(db["comments"]),
+            "active_stories": metrics.active_stories(),
+            "active_live": metrics.active_live,
+            "reports_pending": metrics.reports_pending,
+            "banned_ips": banned_ips,
+            "banned_users": banned_users,
+            "temp_bans": temp_bans
+        }
+        
+        # Новые пользователи (последние 7 дней)
+        new_users = index.count_since("users", week_ago)
+        
+        # Популярный контент
+        popular_posts = metrics.popular_posts.top()
+        popular_videos = metrics.popular_videos.top()
     
     # Последние действия
-    recent_activity = db["admin_logs"][-50:][::-1]  # Последние 50 записей
-    
-    # Новые пользователи (последние 7 дней)
-    week_ago = (datetime.now() - timedelta(days=7)).isoformat()
-    new_users = [u for u in db["users"] if u["createdAt"] > week_ago]
-    
-    # Популярный контент
-    popular_posts = sorted(db["posts"], key=lambda x: len(x.get("likes", [])), reverse=True)[:10]
-    popular_videos = sorted(db["videos"], key=lambda x: x.get("views", 0), reverse=True)[:10]
+    recent_activity = activity_logs.recent(50)  # Последние 50 записей
     
     return jsonify({
         "success": True,
         "stats": stats,
         "recent_activity": recent_activity[:20],
-        "new_users": len(new_users),
+        "new_users": new_users,
         "popular_posts": popular_posts,
         "popular_videos": popular_videos,
         "system_settings": db.get("system_settings", {})
@@ -567,59 +3778,81 @@ def admin_dashboard(admin):
 
 @app.route('/admin/api/users', methods=['GET'])
 @require_admin
+@read_locked
 def admin_get_users(admin):
-    """Получение списка пользователей"""
+    """Получение списка пользователей.
+    
+    С параметром page — постраничный режим, иначе курсорный (cursor, next_cursor).
+    fields=a,b,c ограничивает набор возвращаемых полей.
+    """
     db = load_database()
     
     # Фильтры
-    search = request.args.get('search', '')
+    search = request.args.get('search', '').lower()
     role = request.args.get('role', 'all')
     status = request.args.get('status', 'all')
     limit = int(request.args.get('limit', 50))
-    page = int(request.args.get('page', 1))
-    
-    users = db["users"]
-    
-    # Применяем фильтры
-    if search:
-        search = search.lower()
-        users = [u for u in users if search in u["username"].lower() or search in u["displayName"].lower()]
-    
-    if role != 'all':
-        if role == 'admin':
-            users = [u for u in users if u.get('isAdmin', False)]
-        elif role == 'user':
-            users = [u for u in users if not u.get('isAdmin', False)]
-    
-    if status != 'all':
-        if status == 'verified':
-            users = [u for u in users if u.get('isVerified', False)]
-        elif status == 'unverified':
-            users = [u for u in users if not u.get('isVerified', False)]
-    
-    # Пагинация
-    total = len(users)
-    start = (page - 1) * limit
-    end = start + limit
-    paginated_users = users[start:end]
-    
-    # Удаляем пароли
-    for user in paginated_users:
-        if 'password' in user:
-            del user['password']
+    fields = parse_fields(request.args.get('fields'))
     
-    return jsonify({
-        "success": True,
-        "users": paginated_users,
-        "total": total,
-        "page": page,
-        "pages": (total + limit - 1) // limit
-    })
+    def matches(u):
+        if search and search not in u["username"].lower() and search not in u["displayName"].lower():
+            return False
+        if role == 'admin' and not u.get('isAdmin', False):
+            return False
+        if role == 'user' and u.get('isAdmin', False):
+            return False
+        if status == 'verified' and not u.get('isVerified', False):
+            return False
+        if status == 'unverified' and u.get('isVerified', False):
+            return False
+        return True
+    
+    filtered = search or role in ('admin', 'user') or status in ('verified', 'unverified')
+    result = {"success": True}
+    
+    if 'page' in request.args:
+        # Пагинация
+        page = int(request.args.get('page', 1))
+        users = [u for u in db["users"] if matches(u)] if filtered else db["users"]
+        total = len(users)
+        start = (page - 1) * limit
+        page_users = users[start:start + limit]
+        result.update({"total": total, "page": page, "pages": (total + limit - 1) // limit})
+    else:
+        cursor_key = None
+        if request.args.get('cursor'):
+            cursor_key = decode_cursor(request.args['cursor'])
+            if cursor_key is None:
+                return jsonify({"error": "Неверный курсор"}), 400
+        page_users, next_cursor = keyset_page(db, "users", cursor_key, limit, matches if filtered else None)
+        result["next_cursor"] = next_cursor
+        if not filtered:
+            result["total"] = len(db["users"])
+    
+    # Удаляем пароли (копии — база общая для всех запросов)
+    result["users"] = [project({k: v for k, v in u.items() if k != 'password'}, fields) for u in page_users]
+    
+    return jsonify(result)
 
 @app.route('/admin/api/users/<user_id>', methods=['GET', 'PUT', 'DELETE'])
 @require_admin
 def admin_manage_user(admin, user_id):
     """Управление конкретным пользователем"""
+    if request.method == 'GET':
+        with read_snapshot():
+            return manage_user(admin, user_id)
+    
+    # Хэш вычисляется до транзакции, чтобы KDF не держал блокировку записи
+    password_hash = None
+    data = request.get_json(silent=True)
+    if request.method == 'PUT' and data and data.get('password') and admin.get('isSuperAdmin'):
+        password_hash = hash_password(data['password'])
+    
+    with transaction():
+        return manage_user(admin, user_id, password_hash)
+
+def manage_user(admin, user_id, password_hash=None):
+    """Просмотр и изменение пользователя; GET — внутри read_snapshot(), PUT и DELETE — внутри transaction()"""
     db = load_database()
     user = find_user_by_id(user_id, db)
     
@@ -633,7 +3866,8 @@ def admin_manage_user(admin, user_id):
             del user_data['password']
         
         # Получаем активность пользователя
-        user_activity = [log for log in db["admin_logs"] if log.get("user_id") == user_id][-20:]
+        user_activity, _ = activity_logs.query(user_id=user_id, limit=20)
+        user_activity.reverse()
         
         # Получаем контент пользователя
         user_posts = [p for p in db["posts"] if p["userId"] == user_id]
@@ -668,25 +3902,19 @@ def admin_manage_user(admin, user_id):
                 continue  # Пропускаем чувствительные поля
             
             if key == 'password' and value:
-                user[key] = hash_password(value)
+                user[key] = password_hash
             elif key == 'status' and value == 'banned':
                 # Бан пользователя
-                bans = load_bans()
-                if user_id not in bans["user_bans"]:
-                    bans["user_bans"].append(user_id)
-                    save_bans(bans)
+                if ban_manager.add_user_ban(user_id):
                     log_activity(admin["id"], "user_banned", f"Banned user: {user_id}", request.remote_addr)
             elif key == 'status' and value == 'active':
                 # Разбан пользователя
-                bans = load_bans()
-                if user_id in bans["user_bans"]:
-                    bans["user_bans"].remove(user_id)
-                    save_bans(bans)
+                if ban_manager.remove_user_ban(user_id):
                     log_activity(admin["id"], "user_unbanned", f"Unbanned user: {user_id}", request.remote_addr)
             else:
                 user[key] = value
         
-        save_database(db)
+        update_record(db, "users", user)
         log_activity(admin["id"], "user_updated", f"Updated user: {user_id}", request.remote_addr)
         
         return jsonify({
@@ -700,13 +3928,12 @@ def admin_manage_user(admin, user_id):
             return jsonify({"error": "Требуются права супер-администратора"}), 403
         
         # Удаляем пользователя
-        db["users"] = [u for u in db["users"] if u["id"] != user_id]
+        delete_record(db, "users", user_id)
         
         # Удаляем связанный контент (опционально)
-        # db["posts"] = [p for p in db["posts"] if p["userId"] != user_id]
-        # db["videos"] = [v for v in db["videos"] if v["userId"] != user_id]
-        
-        save_database(db)
+        # for p in [p for p in db["posts"] if p["userId"] == user_id]: delete_record(db, "posts", p["id"])
+        # for v in [v for v in db["videos"] if v["userId"] == user_id]: delete_record(db, "videos", v["id"])
+
         log_activity(admin["id"], "user_deleted", f"Deleted user: {user_id}", request.remote_addr)
         
         return jsonify({
@@ -716,53 +3943,72 @@ def admin_manage_user(admin, user_id):
 
 @app.route('/admin/api/posts', methods=['GET'])
 @require_admin
+@read_locked
 def admin_get_posts(admin):
-    """Получение списка постов"""
+    """Получение списка постов (page — постраничный режим, иначе курсорный; fields — проекция)"""
     db = load_database()
     
     # Фильтры
     status = request.args.get('status', 'all')  # all, reported, hidden
     limit = int(request.args.get('limit', 50))
-    page = int(request.args.get('page', 1))
-    
-    posts = db["posts"]
+    fields = parse_fields(request.args.get('fields'))
     
     # Фильтрация по статусу
     if status == 'reported':
-        reported_post_ids = [r["targetId"] for r in db["reports"] if r["type"] == "post"]
-        posts = [p for p in posts if p["id"] in reported_post_ids]
+        predicate = lambda p: any(r["type"] == "post" for r in reports_for_target(p["id"], db))
     elif status == 'hidden':
-        posts = [p for p in posts if p.get("hidden", False)]
+        predicate = lambda p: p.get("hidden", False)
+    else:
+        predicate = None
     
-    # Добавляем информацию о пользователях
-    for post in posts:
-        user = find_user_by_id(post["userId"], db)
-        if user:
-            post["user"] = {
-                "id": user["id"],
-                "username": user["username"],
-                "displayName": user["displayName"]
-            }
+    result = {"success": True}
+    
+    if 'page' in request.args:
+        # Пагинация
+        page = int(request.args.get('page', 1))
+        posts = [p for p in db["posts"] if predicate(p)] if predicate else db["posts"]
+        total = len(posts)
+        start = (page - 1) * limit
+        page_posts = posts[start:start + limit]
+        result.update({"total": total, "page": page, "pages": (total + limit - 1) // limit})
+    else:
+        cursor_key = None
+        if request.args.get('cursor'):
+            cursor_key = decode_cursor(request.args['cursor'])
+            if cursor_key is None:
+                return jsonify({"error": "Неверный курсор"}), 400
+        page_posts, next_cursor = keyset_page(db, "posts", cursor_key, limit, predicate)
+        result["next_cursor"] = next_cursor
+        if not predicate:
+            result["total"] = len(db["posts"])
+    
+    # Добавляем информацию о пользователях только для страницы
+    def decorate(post):
+        post = dict(post)
+        if not fields or "user" in fields:
+            user = find_user_by_id(post["userId"], db)
+            if user:
+                post["user"] = {
+                    "id": user["id"],
+                    "username": user["username"],
+                    "displayName": user["displayName"]
+                }
         
         # Количество репортов
-        post["report_count"] = len([r for r in db["reports"] if r.get("targetId") == post["id"]])
+        post["report_count"] = len(reports_for_target(post["id"], db))
+        return project(post, fields)
     
-    # Пагинация
-    total = len(posts)
-    start = (page - 1) * limit
-    end = start + limit
-    paginated_posts = posts[start:end]
+    posts = (decorate(post) for post in page_posts)
+    fmt = stream_format()
+    if fmt:
+        return stream_list(result, "posts", posts, fmt)
     
-    return jsonify({
-        "success": True,
-        "posts": paginated_posts,
-        "total": total,
-        "page": page,
-        "pages": (total + limit - 1) // limit
-    })
+    result["posts"] = list(posts)
+    return jsonify(result)
 
 @app.route('/admin/api/posts/<post_id>', methods=['PUT', 'DELETE'])
 @require_admin
+@transactional
 def admin_manage_post(admin, post_id):
     """Управление постом"""
     db = load_database()
@@ -786,7 +4032,7 @@ def admin_manage_post(admin, post_id):
             post["content"] = data['content']
             log_activity(admin["id"], "post_content_updated", f"Updated content for post: {post_id}", request.remote_addr)
         
-        save_database(db)
+        update_record(db, "posts", post)
         
         return jsonify({
             "success": True,
@@ -795,14 +4041,14 @@ def admin_manage_post(admin, post_id):
     
     elif request.method == 'DELETE':
         # Удаление поста
-        db["posts"] = [p for p in db["posts"] if p["id"] != post_id]
+        delete_record(db, "posts", post_id)
         
         # Уменьшаем счетчик у пользователя
         user = find_user_by_id(post["userId"], db)
         if user and user["stats"]["posts"] > 0:
             user["stats"]["posts"] -= 1
-        
-        save_database(db)
+            update_record(db, "users", user)
+
         log_activity(admin["id"], "post_deleted", f"Deleted post: {post_id}", request.remote_addr)
         
         return jsonify({
@@ -812,69 +4058,76 @@ def admin_manage_post(admin, post_id):
 
 @app.route('/admin/api/comments', methods=['GET'])
 @require_admin
+@read_locked
 def admin_get_comments(admin):
-    """Получение списка комментариев"""
+    """Получение списка комментариев (page — постраничный режим, иначе курсорный; fields — проекция)"""
     db = load_database()
     
     limit = int(request.args.get('limit', 50))
-    page = int(request.args.get('page', 1))
-    
-    comments = db["comments"]
+    fields = parse_fields(request.args.get('fields'))
+    result = {"success": True}
     
-    # Добавляем информацию о пользователях
-    for comment in comments:
-        user = find_user_by_id(comment["userId"], db)
-        if user:
-            comment["user"] = {
-                "id": user["id"],
-                "username": user["username"],
-                "displayName": user["displayName"]
-            }
+    if 'page' in request.args:
+        # Пагинация
+        page = int(request.args.get('page', 1))
+        total = len(db["comments"])
+        start = (page - 1) * limit
+        page_comments = db["comments"][start:start + limit]
+        result.update({"total": total, "page": page, "pages": (total + limit - 1) // limit})
+    else:
+        cursor_key = None
+        if request.args.get('cursor'):
+            cursor_key = decode_cursor(request.args['cursor'])
+            if cursor_key is None:
+                return jsonify({"error": "Неверный курсор"}), 400
+        page_comments, next_cursor = keyset_page(db, "comments", cursor_key, limit)
+        result.update({"next_cursor": next_cursor, "total": len(db["comments"])})
     
-    # Пагинация
-    total = len(comments)
-    start = (page - 1) * limit
-    end = start + limit
-    paginated_comments = comments[start:end]
+    # Добавляем информацию о пользователях только для страницы
+    comments = []
+    for comment in page_comments:
+        comment = dict(comment)
+        if not fields or "user" in fields:
+            user = find_user_by_id(comment["userId"], db)
+            if user:
+                comment["user"] = {
+                    "id": user["id"],
+                    "username": user["username"],
+                    "displayName": user["displayName"]
+                }
+        comments.append(project(comment, fields))
     
-    return jsonify({
-        "success": True,
-        "comments": paginated_comments,
-        "total": total,
-        "page": page,
-        "pages": (total + limit - 1) // limit
-    })
+    result["comments"] = comments
+    return jsonify(result)
 
 @app.route('/admin/api/comments/<comment_id>', methods=['DELETE'])
 @require_admin
+@transactional
 def admin_delete_comment(admin, comment_id):
     """Удаление комментария"""
     db = load_database()
     
     # Находим комментарий
-    comment = None
-    for c in db["comments"]:
-        if c["id"] == comment_id:
-            comment = c
-            break
+    comment = find_comment_by_id(comment_id, db)
     
     if not comment:
         return jsonify({"error": "Комментарий не найден"}), 404
     
     # Удаляем комментарий
-    db["comments"] = [c for c in db["comments"] if c["id"] != comment_id]
+    delete_record(db, "comments", comment_id)
     
     # Обновляем счетчики
     if "postId" in comment:
         post = find_post_by_id(comment["postId"], db)
         if post and post.get("comments", 0) > 0:
             post["comments"] -= 1
+            update_record(db, "posts", post)
     elif "videoId" in comment:
         video = find_video_by_id(comment["videoId"], db)
         if video and video.get("comments", 0) > 0:
             video["comments"] -= 1
-    
-    save_database(db)
+            update_record(db, "videos", video)
+
     log_activity(admin["id"], "comment_deleted", f"Deleted comment: {comment_id}", request.remote_addr)
     
     return jsonify({
@@ -884,6 +4137,7 @@ def admin_delete_comment(admin, comment_id):
 
 @app.route('/admin/api/reports', methods=['GET', 'POST'])
 @require_admin
+@transactional
 def admin_reports(admin):
     """Управление репортами"""
     db = load_database()
@@ -892,10 +4146,9 @@ def admin_reports(admin):
         status = request.args.get('status', 'pending')
         limit = int(request.args.get('limit', 50))
         
-        reports = [r for r in db["reports"] if r.get("status") == status]
-        
-        # Добавляем информацию
-        for report in reports:
+        # Добавляем информацию только к отдаваемым репортам
+        def decorate(report):
+            report = dict(report)
             # Пользователь, который пожаловался
             reporter = find_user_by_id(report["reporterId"], db)
             if reporter:
@@ -922,10 +4175,16 @@ def admin_reports(admin):
                         "username": target["username"],
                         "displayName": target["displayName"]
                     }
+            return report
+        
+        reports = (decorate(r) for r in islice((r for r in db["reports"] if r.get("status") == status), limit))
+        fmt = stream_format()
+        if fmt:
+            return stream_list({"success": True}, "reports", reports, fmt)
         
         return jsonify({
             "success": True,
-            "reports": reports[:limit]
+            "reports": list(reports)
         })
     
     elif request.method == 'POST':
@@ -940,11 +4199,7 @@ def admin_reports(admin):
             return jsonify({"error": "Не указан ID репорта или действие"}), 400
         
         # Находим репорт
-        report = None
-        for r in db["reports"]:
-            if r["id"] == report_id:
-                report = r
-                break
+        report = find_report_by_id(report_id, db)
         
         if not report:
             return jsonify({"error": "Репорт не найден"}), 404
@@ -974,7 +4229,7 @@ def admin_reports(admin):
                     "createdAt": datetime.now().isoformat(),
                     "read": False
                 }
-                db["notifications"].append(notification)
+                insert_record(db, "notifications", notification)
             
             message = "Пользователю отправлено предупреждение"
             
@@ -984,17 +4239,14 @@ def admin_reports(admin):
             report["resolvedAt"] = datetime.now().isoformat()
             
             # Бан пользователя
-            bans = load_bans()
-            if report["targetId"] not in bans["user_bans"]:
-                bans["user_bans"].append(report["targetId"])
-                save_bans(bans)
+            ban_manager.add_user_ban(report["targetId"])
             
             message = "Пользователь заблокирован"
         
         else:
             return jsonify({"error": "Неизвестное действие"}), 400
         
-        save_database(db)
+        update_record(db, "reports", report)
         log_activity(admin["id"], "report_resolved", f"Report {action}: {report_id}", request.remote_addr)
         
         return jsonify({
@@ -1002,17 +4254,53 @@ def admin_reports(admin):
             "message": message
         })
 
+def stream_bans(bans, ban_type, fmt):
+    """Потоковая выдача банов: ndjson — строка на бан с полем type"""
+    sections = [(t, key) for t, key in (("ip", "ip_bans"), ("user", "user_bans"), ("temp", "temp_bans"))
+                if ban_type in ('all', t)]
+    
+    if fmt == 'ndjson':
+        def lines():
+            for t, key in sections:
+                if t == "ip":
+                    items = ({"type": t, **ban} for ban in bans[key])
+                elif t == "user":
+                    items = ({"type": t, "user_id": user_id} for user_id in bans[key])
+                else:
+                    items = ({"type": t, "user_id": user_id, **ban} for user_id, ban in bans[key].items())
+                for item in items:
+                    yield json.dumps(item, ensure_ascii=False) + '\n'
+        return stream_response(lines(), fmt)
+    
+    def pieces():
+        yield '{"success": true, "bans": {'
+        for i, (t, key) in enumerate(sections):
+            yield (', ' if i else '') + json.dumps(key) + ': '
+            if t == "temp":
+                yield '{'
+                for j, (user_id, ban) in enumerate(bans[key].items()):
+                    yield (', ' if j else '') + json.dumps(user_id) + ': ' + json.dumps(ban, ensure_ascii=False)
+                yield '}'
+            else:
+                yield from json_array(bans[key])
+        yield '}}'
+    return stream_response(pieces(), fmt)
+
 @app.route('/admin/api/bans', methods=['GET', 'POST', 'DELETE'])
 @require_admin
 def admin_bans(admin):
     """Управление банами"""
-    bans = load_bans()
-    
     if request.method == 'GET':
         ban_type = request.args.get('type', 'all')
         
-        result = {}
+        ban_manager.counts()  # Подхватываем изменения и снимаем истекшие баны
+        bans = ban_manager.snapshot()
+        
+        fmt = stream_format()
+        if fmt:
+            return stream_bans(bans, ban_type, fmt)
         
+        result = {}
         if ban_type in ['all', 'ip']:
             result["ip_bans"] = bans["ip_bans"]
         
@@ -1041,7 +4329,12 @@ def admin_bans(admin):
             return jsonify({"error": "Не указан тип бана или цель"}), 400
         
         if ban_type == "ip":
-            # Бан по IP
+            # Бан по IP, подсети (CIDR) или диапазону a-b
+            try:
+                target = normalize_ip_target(target)
+            except ValueError:
+                return jsonify({"error": "Неверный IP адрес, подсеть или диапазон"}), 400
+            
             new_ban = {
                 "ip": target,
                 "reason": reason,
@@ -1052,31 +4345,29 @@ def admin_bans(admin):
             if duration > 0:
                 new_ban["expires"] = (datetime.now() + timedelta(hours=duration)).isoformat()
             
-            bans["ip_bans"].append(new_ban)
+            ban_manager.add_ip_ban(new_ban)
             message = f"IP {target} заблокирован"
             
         elif ban_type == "user":
             # Бан пользователя
-            if target not in bans["user_bans"]:
-                bans["user_bans"].append(target)
+            ban_manager.add_user_ban(target)
             message = f"Пользователь {target} заблокирован"
             
         elif ban_type == "temp":
             # Временный бан
             expires = (datetime.now() + timedelta(hours=duration)).isoformat()
-            bans["temp_bans"][target] = {
+            ban_manager.add_temp_ban(target, {
                 "reason": reason,
                 "banned_by": admin["id"],
                 "banned_at": datetime.now().isoformat(),
                 "expires": expires,
                 "duration_hours": duration
-            }
+            })
             message = f"Временный бан для {target} на {duration} часов"
         
         else:
             return jsonify({"error": "Неизвестный тип бана"}), 400
         
-        save_bans(bans)
         log_activity(admin["id"], "ban_added", f"{ban_type} ban: {target}", request.remote_addr)
         
         return jsonify({
@@ -1093,20 +4384,20 @@ def admin_bans(admin):
             return jsonify({"error": "Не указан тип бана или цель"}), 400
         
         if ban_type == "ip":
-            bans["ip_bans"] = [b for b in bans["ip_bans"] if b["ip"] != target]
+            ban_manager.remove_ip_ban(target)
             message = f"IP {target} разблокирован"
             
         elif ban_type == "user":
-            if target in bans["user_bans"]:
-                bans["user_bans"].remove(target)
+            ban_manager.remove_user_ban(target)
             message = f"Пользователь {target} разблокирован"
             
         elif ban_type == "temp":
-            if target in bans["temp_bans"]:
-                del bans["temp_bans"][target]
+            ban_manager.remove_temp_ban(target)
             message = f"Временный бан для {target} снят"
         
-        save_bans(bans)
+        else:
+            return jsonify({"error": "Неизвестный тип бана"}), 400
+        
         log_activity(admin["id"], "ban_removed", f"{ban_type} ban removed: {target}", request.remote_addr)
         
         return jsonify({
@@ -1116,6 +4407,7 @@ def admin_bans(admin):
 
 @app.route('/admin/api/settings', methods=['GET', 'PUT'])
 @require_super_admin
+@transactional
 def admin_settings(admin):
     """Управление системными настройками"""
     db = load_database()
@@ -1136,7 +4428,7 @@ def admin_settings(admin):
             if key in db["system_settings"]:
                 db["system_settings"][key] = value
         
-        save_database(db)
+        save_section(db, "system_settings")
         log_activity(admin["id"], "settings_updated", "System settings updated", request.remote_addr)
         
         return jsonify({
@@ -1144,71 +4436,225 @@ def admin_settings(admin):
             "message": "Настройки обновлены"
         })
 
+@app.route('/admin/api/spam/keywords', methods=['GET', 'PUT'])
+@require_admin
+def admin_spam_keywords(admin):
+    """Ключевые слова спам-фильтра с весами"""
+    if request.method == 'GET':
+        return jsonify({
+            "success": True,
+            "keywords": anti_spam.rules().weights,
+            "threshold": SPAM_SCORE_THRESHOLD
+        })
+    
+    elif request.method == 'PUT':
+        data = request.json
+        if not isinstance(data, (dict, list)) or not data:
+            return jsonify({"error": "Нет данных"}), 400
+        
+        if isinstance(data, list):
+            data = {keyword: 1 for keyword in data}
+        try:
+            weights = {str(k).lower(): float(v) for k, v in data.items() if k}
+        except (TypeError, ValueError):
+            return jsonify({"error": "Вес должен быть числом"}), 400
+        
+        save_spam_keywords(weights)
+        log_activity(admin["id"], "spam_keywords_updated", f"Spam keywords: {len(weights)}", request.remote_addr)
+        
+        return jsonify({
+            "success": True,
+            "message": "Ключевые слова обновлены"
+        })
+
+@app.route('/admin/api/moderation/rescan', methods=['GET', 'POST'])
+@require_super_admin
+def admin_rescan_content(admin):
+    """Повторная проверка контента на спам в фоне: POST — запуск, GET — состояние"""
+    if request.method == 'GET':
+        return jsonify({
+            "success": True,
+            "job": media_jobs.status(RESCAN_TASK)
+        })
+    
+    data = request.get_json(silent=True) or {}
+    max_processes = os.cpu_count() or 1
+    processes = data.get('processes', RESCAN_PROCESSES or max_processes)
+    if type(processes) is not int or not 1 <= processes <= max_processes:
+        return jsonify({"error": f"processes: целое число от 1 до {max_processes}"}), 400
+    max_items = data.get('max_items')
+    if max_items is not None and (type(max_items) is not int or max_items < 1):
+        return jsonify({"error": "max_items: целое число больше 0"}), 400
+    
+    params = {"processes": processes, "max_items": max_items, "reset": bool(data.get('reset', False))}
+    if not media_jobs.enqueue(RESCAN_TASK, params=params):
+        return jsonify({"error": "Перепроверка уже выполняется", "job": media_jobs.status(RESCAN_TASK)}), 409
+    log_activity(admin["id"], "content_rescan_queued", f"Rescan queued: {params}", request.remote_addr)
+    
+    return jsonify({
+        "success": True,
+        "job": media_jobs.status(RESCAN_TASK),
+        "message": "Перепроверка запущена в фоне"
+    }), 202
+
+# Экспорт и импорт коллекций (gzip NDJSON)
+def export_collection(collection):
+    """gzip NDJSON коллекции из снимка хранилища, по частям"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 — формат gzip
+    with storage.snapshot() as conn:
+        if collection in STORAGE_TABLES:
+            rows = conn.execute(f"SELECT data FROM {collection} ORDER BY seq")
+            while True:
+                batch = rows.fetchmany(EXPORT_FETCH_SIZE)
+                if not batch:
+                    break
+                chunk = compressor.compress(''.join(row[0] + '\n' for row in batch).encode('utf-8'))
+                if chunk:
+                    yield chunk
+        else:
+            row = conn.execute("SELECT data FROM documents WHERE key = ?", (collection,)).fetchone()
+            value = json.loads(row[0]) if row else []
+            for item in value if isinstance(value, list) else [value]:
+                chunk = compressor.compress((json.dumps(item, ensure_ascii=False) + '\n').encode('utf-8'))
+                if chunk:
+                    yield chunk
+    yield compressor.flush()
+
+def import_collection(collection, fileobj, replace=False):
+    """Импорт gzip NDJSON одной транзакцией; возвращает число записей.
+    
+    Без replace записи с существующим id заменяются, с replace коллекция
+    сначала очищается. Разделы-документы всегда заменяются целиком.
+    """
+    def records():
+        with gzip.open(fileobj, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if collection not in LOG_TABLES and collection not in DOCUMENT_SECTIONS and \
+                            not (isinstance(record, dict) and record.get("id")):
+                        raise ValueError("Запись без id")
+                    yield record
+    
+    count = 0
+    with document_cache.lock:
+        try:
+            with storage.transaction() as conn:
+                if collection in STORAGE_TABLES:
+                    if replace:
+                        conn.execute(f"DELETE FROM {collection}")
+                    batch = []
+                    for record in records():
+                        batch.append(record)
+                        if len(batch) >= IMPORT_BATCH_SIZE:
+                            storage.insert_many(collection, batch, replace=collection not in LOG_TABLES)
+                            count += len(batch)
+                            batch = []
+                    storage.insert_many(collection, batch, replace=collection not in LOG_TABLES)
+                    count += len(batch)
+                else:
+                    items = list(records())
+                    storage.set_document(collection, items if collection != "system_settings" else (items[0] if items else {}))
+                    count = len(items)
+                conn.execute("DELETE FROM rollups WHERE bucket = 'all' AND metric = 'backfilled'")  # Пересчитать сводку
+                if collection in ("users", "posts"):
+                    conn.execute("DELETE FROM timelines")  # Ленты собираются заново
+                if collection in ("posts", "videos"):
+                    blobs.recount({c: [json.loads(row[0]) for row in conn.execute(f"SELECT data FROM {c}")]
+                                   for c in ("posts", "videos")})
+        finally:
+            document_cache.invalidate()  # Собранная база перечитается целиком
+    if collection == "admin_logs":
+        activity_logs.reset()  # Буфер журнала перечитается из таблицы
+    return count
+
+@app.route('/admin/api/export/<collection>', methods=['GET'])
+@require_super_admin
+def admin_export(admin, collection):
+    """Выгрузка коллекции в gzip NDJSON"""
+    if collection not in STORAGE_TABLES and collection not in DOCUMENT_SECTIONS:
+        return jsonify({"error": "Неизвестная коллекция"}), 404
+    
+    log_activity(admin["id"], "collection_exported", f"Exported {collection}", request.remote_addr)
+    return Response(stream_with_context(export_collection(collection)), mimetype='application/gzip',
+                    headers={"Content-Disposition": f"attachment; filename={collection}.ndjson.gz"})
+
+@app.route('/admin/api/import/<collection>', methods=['POST'])
+@require_super_admin
+def admin_import(admin, collection):
+    """Загрузка коллекции из gzip NDJSON (тело запроса); mode=replace очищает коллекцию"""
+    if collection not in STORAGE_TABLES and collection not in DOCUMENT_SECTIONS:
+        return jsonify({"error": "Неизвестная коллекция"}), 404
+    replace = request.args.get('mode') == 'replace'
+    
+    # Тело сначала сохраняется во временный файл, чтобы не держать транзакцию во время загрузки
+    with tempfile.TemporaryFile() as f:
+        shutil.copyfileobj(request.stream, f)
+        f.seek(0)
+        try:
+            count = import_collection(collection, f, replace)
+        except (OSError, ValueError, EOFError) as e:
+            return jsonify({"error": f"Неверные данные импорта: {e}"}), 400
+    
+    log_activity(admin["id"], "collection_imported",
+                 f"Imported {count} records into {collection}", request.remote_addr)
+    return jsonify({
+        "success": True,
+        "imported": count
+    })
+
 @app.route('/admin/api/logs', methods=['GET'])
 @require_admin
 def admin_logs(admin):
-    """Получение логов"""
-    db = load_database()
-    
+    """Получение логов (новые сначала)"""
     action = request.args.get('action', '')
     user_id = request.args.get('user_id', '')
+    since = request.args.get('since', '')  # ISO время
     limit = int(request.args.get('limit', 100))
     
-    logs = db["admin_logs"]
-    
-    # Фильтрация
-    if action:
-        logs = [log for log in logs if log.get("action") == action]
-    
-    if user_id:
-        logs = [log for log in logs if log.get("user_id") == user_id]
-    
-    # Сортируем по времени (новые сначала)
-    logs.sort(key=lambda x: x["timestamp"], reverse=True)
+    # Фильтрация по индексам журнала
+    logs, total = activity_logs.query(action=action, user_id=user_id, since=since, limit=limit)
     
     return jsonify({
         "success": True,
-        "logs": logs[:limit],
-        "total": len(logs)
+        "logs": logs,
+        "total": total
+    })
+
+@app.route('/admin/api/system/cache')
+@require_admin
+def admin_cache_stats(admin):
+    """Счетчики кэша базы"""
+    return jsonify({
+        "success": True,
+        "cache": document_cache.stats(),
+        "activity_log": activity_log.stats()
     })
 
 @app.route('/admin/api/stats/overview')
 @require_admin
+@read_locked
 def admin_stats_overview(admin):
     """Общая статистика"""
     db = load_database()
     
-    # Статистика за последние 30 дней
-    thirty_days_ago = datetime.now() - timedelta(days=30)
-    
-    # Новые пользователи по дням
-    users_by_day = {}
-    for user in db["users"]:
-        if datetime.fromisoformat(user["createdAt"]) > thirty_days_ago:
-            date = user["createdAt"][:10]  # YYYY-MM-DD
-            users_by_day[date] = users_by_day.get(date, 0) + 1
-    
-    # Новые посты по дням
-    posts_by_day = {}
-    for post in db["posts"]:
-        if datetime.fromisoformat(post["createdAt"]) > thirty_days_ago:
-            date = post["createdAt"][:10]
-            posts_by_day[date] = posts_by_day.get(date, 0) + 1
+    # Статистика за последние days дней (по умолчанию 30), interval=hour — по часам
+    days = int(request.args.get('days', 30))
+    hourly = request.args.get('interval') == 'hour'
+    since = (datetime.now() - timedelta(days=days)).isoformat()
+    suffix = "by_hour" if hourly else "by_day"
     
     # Активные пользователи (за последние 7 дней)
     week_ago = datetime.now() - timedelta(days=7)
-    active_users = set()
-    for log in db["admin_logs"]:
-        if datetime.fromisoformat(log["timestamp"]) > week_ago:
-            active_users.add(log["user_id"])
     
     return jsonify({
         "success": True,
-        "users_by_day": users_by_day,
-        "posts_by_day": posts_by_day,
-        "active_users": len(active_users),
-        "total_likes": sum(len(p.get("likes", [])) for p in db["posts"]) + 
-                      sum(len(v.get("likes", [])) for v in db["videos"]),
+        "users_" + suffix: rollups.series("registrations", since, hourly),
+        "posts_" + suffix: rollups.series("posts", since, hourly),
+        "comments_" + suffix: rollups.series("comments", since, hourly),
+        "likes_" + suffix: rollups.series("likes", since, hourly),
+        "active_users": rollups.active_users(week_ago.isoformat()),
+        "total_likes": rollups.total("likes"),
         "total_comments": len(db["comments"]),
         "avg_posts_per_user": len(db["posts"]) / max(len(db["users"]), 1)
     })
@@ -1258,49 +4704,54 @@ def api_register():
     if find_user_by_username(data['username'], db):
         return jsonify({"error": "Имя пользователя уже существует"}), 400
     
-    for user in db["users"]:
-        if user["email"] == data['email']:
-            return jsonify({"error": "Email уже зарегистрирован"}), 400
+    if find_user_by_email(data['email'], db):
+        return jsonify({"error": "Email уже зарегистрирован"}), 400
     
     # Проверка сложности пароля
     if len(data['password']) < MIN_PASSWORD_LENGTH:
         return jsonify({"error": f"Пароль должен быть не менее {MIN_PASSWORD_LENGTH} символов"}), 400
     
-    # Создание нового пользователя
-    new_user = {
-        "id": generate_id("user"),
-        "username": data['username'],
-        "displayName": data['displayName'],
-        "email": data['email'],
-        "password": hash_password(data['password']),
-        "emoji": data['emoji'],
-        "bio": "",
-        "createdAt": datetime.now().isoformat(),
-        "isAdmin": False,
-        "isSuperAdmin": False,
-        "isVerified": False,
-        "notifications": 0,
-        "clan": None,
-        "followers": [],
-        "following": [],
-        "stats": {
-            "posts": 0,
-            "videos": 0,
-            "stories": 0,
-            "likes": 0
-        },
-        "settings": {
-            "theme": "dark",
-            "language": "ru",
-            "notifications": True,
-            "privacy": "public"
-        },
-        "status": "active",
-        "last_active": datetime.now().isoformat()
-    }
+    # Хэш вычисляется до транзакции, чтобы не держать блокировку записи
+    password_hash = hash_password(data['password'])
     
-    db["users"].append(new_user)
-    save_database(db)
+    with transaction() as db:
+        # Повторная проверка: за время хэширования имя могли занять
+        if find_user_by_username(data['username'], db) or find_user_by_email(data['email'], db):
+            return jsonify({"error": "Имя пользователя или email уже заняты"}), 400
+        
+        # Создание нового пользователя
+        new_user = {
+            "id": generate_id("user"),
+            "username": data['username'],
+            "displayName": data['displayName'],
+            "email": data['email'],
+            "password": password_hash,
+            "emoji": data['emoji'],
+            "bio": "",
+            "createdAt": datetime.now().isoformat(),
+            "isAdmin": False,
+            "isSuperAdmin": False,
+            "isVerified": False,
+            "notifications": 0,
+            "clan": None,
+            "followers": [],
+            "following": [],
+            "stats": {
+                "posts": 0,
+                "videos": 0,
+                "stories": 0,
+                "likes": 0
+            },
+            "settings": {
+                "theme": "dark",
+                "language": "ru",
+                "notifications": True,
+                "privacy": "public"
+            },
+            "status": "active",
+            "last_active": datetime.now().isoformat()
+        }
+        insert_record(db, "users", new_user)
     
     log_activity(new_user["id"], "user_registered", "New user registered", request.remote_addr)
     
@@ -1314,13 +4765,162 @@ def api_register():
         "message": "Регистрация успешна!"
     })
 
+@app.route('/api/upload', methods=['POST'])
+@spam_protection("uploads")
+def api_upload():
+    """Загрузка файла для постов и видео.
+    
+    Тело запроса — сам файл (имя в ?filename=) или multipart с полем file.
+    Ответ содержит hash, который указывается в поле media поста.
+    """
+    user_id = request.args.get('userId')
+    if not user_id:
+        return jsonify({"error": "Пользователь не авторизован"}), 401
+    
+    banned, reason = is_banned(user_id=user_id)
+    if banned:
+        return jsonify({"error": f"Аккаунт заблокирован: {reason}"}), 403
+    
+    if not find_user_by_id(user_id, load_database()):
+        return jsonify({"error": "Пользователь не найден"}), 404
+    
+    if request.mimetype == 'multipart/form-data':
+        # Большие части формы werkzeug держит во временных файлах, а не в памяти
+        upload = request.files.get('file')
+        if not upload:
+            return jsonify({"error": "Отсутствует файл"}), 400
+        stream, filename, content_type = upload.stream, upload.filename, upload.mimetype
+    else:
+        stream, filename = request.stream, request.args.get('filename', '')
+        content_type = request.mimetype if request.mimetype != 'application/octet-stream' else None
+    
+    try:
+        blob = blobs.put(stream, filename, content_type)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    log_activity(user_id, "media_uploaded", f"Uploaded {blob['hash']} ({blob['size']} bytes)", request.remote_addr)
+    
+    return jsonify({
+        "success": True,
+        "blob": blob
+    })
+
+@app.route('/api/uploads', methods=['POST'])
+@spam_protection("uploads")
+def api_upload_create():
+    """Начало загрузки частями: {userId, filename, size, sha256?, contentType?}"""
+    data = request.json
+    if not data:
+        return jsonify({"error": "Нет данных"}), 400
+    
+    if 'userId' not in data:
+        return jsonify({"error": "Пользователь не авторизован"}), 401
+    
+    banned, reason = is_banned(user_id=data['userId'])
+    if banned:
+        return jsonify({"error": f"Аккаунт заблокирован: {reason}"}), 403
+    
+    if not find_user_by_id(data['userId'], load_database()):
+        return jsonify({"error": "Пользователь не найден"}), 404
+    
+    try:
+        session = upload_sessions.create(data['userId'], data.get('filename', ''), data.get('size'),
+                                         data.get('sha256'), data.get('contentType'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    return jsonify({
+        "success": True,
+        "upload": UploadSessions.describe(session)
+    })
+
+def find_upload_session(upload_id):
+    """Сессия загрузки текущего пользователя (userId в запросе) или None"""
+    user_id = request.args.get('userId') or (request.get_json(silent=True) or {}).get('userId')
+    session = upload_sessions.get(upload_id)
+    if not session or session["user_id"] != user_id:
+        return None
+    return session
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def api_upload_session(upload_id):
+    """GET — принятое смещение, PUT ?offset= — следующая часть, DELETE — отмена"""
+    banned, reason = is_banned(ip_address=request.remote_addr)
+    if banned:
+        return jsonify({"error": f"Доступ заблокирован: {reason}"}), 403
+    
+    session = find_upload_session(upload_id)
+    if not session:
+        return jsonify({"error": "Загрузка не найдена"}), 404
+    
+    if request.method == 'DELETE':
+        upload_sessions.remove(upload_id)
+        return jsonify({"success": True, "message": "Загрузка отменена"})
+    
+    if request.method == 'PUT':
+        offset = request.args.get('offset', type=int)
+        if request.content_length and session["received"] + request.content_length > session["size"]:
+            return jsonify({"error": "Данных больше объявленного размера"}), 400
+        if offset != session["received"] or not upload_sessions.acquire(upload_id, offset):
+            # Клиент продолжает с актуального смещения из ответа
+            response = jsonify({"error": "Неверное смещение или часть уже загружается",
+                                "upload": UploadSessions.describe(session)})
+            return response, 409
+        try:
+            session["received"] = upload_sessions.write(session, request.stream)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    
+    return jsonify({
+        "success": True,
+        "upload": UploadSessions.describe(session)
+    })
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def api_upload_complete(upload_id):
+    """Завершение: проверка SHA-256 и сохранение файла; ответ как у /api/upload"""
+    session = find_upload_session(upload_id)
+    if not session:
+        return jsonify({"error": "Загрузка не найдена"}), 404
+    
+    if not upload_sessions.acquire(upload_id, session["received"]):
+        return jsonify({"error": "Загрузка еще выполняется"}), 409
+    
+    try:
+        blob = upload_sessions.complete(session, (request.get_json(silent=True) or {}).get('sha256'))
+    except Exception as e:
+        # Сохраненную сессию можно завершить повторно сразу, не дожидаясь конца аренды
+        if upload_sessions.get(upload_id):
+            upload_sessions.release(upload_id, session["received"])
+        if isinstance(e, ValueError):
+            return jsonify({"error": str(e)}), 400
+        raise
+    
+    log_activity(session["user_id"], "media_uploaded", f"Uploaded {blob['hash']} ({blob['size']} bytes)",
+                 request.remote_addr)
+    
+    return jsonify({
+        "success": True,
+        "blob": blob
+    })
+
 @app.route('/api/posts', methods=['POST'])
 @spam_protection("posts")
 def api_create_post():
     """Создание поста с защитой от спама"""
-    db = load_database()
     data = request.json
     
+    # Поиск почти одинаковых сообщений — до транзакции, чтобы SimHash не держал блокировку записи
+    duplicate_of = check_duplicate(data.get('content', ''), data.get('userId')) if data else None
+    
+    with transaction():
+        return create_post(data, duplicate_of)
+
+def create_post(data, duplicate_of=None):
+    """Проверки и сохранение поста внутри transaction()"""
+    db = load_database()
+    
     if not data:
         return jsonify({"error": "Нет данных"}), 400
     
@@ -1342,6 +4942,17 @@ def api_create_post():
                     "Post blocked as spam", request.remote_addr)
         return jsonify({"error": "Сообщение содержит признаки спама"}), 403
     
+    # Проверка на почти одинаковые сообщения других пользователей
+    if duplicate_of and DUPLICATE_ACTION == 'reject':
+        log_activity(data['userId'], "duplicate_post_blocked",
+                    f"Post duplicates {duplicate_of[0]} {duplicate_of[1]}", request.remote_addr)
+        return jsonify({"error": "Похожее сообщение уже опубликовано другим пользователем"}), 403
+    
+    # Файлы должны быть загружены заранее через /api/upload
+    missing = blobs.missing(BlobStore.references(data))
+    if missing:
+        return jsonify({"error": "Файл не найден", "missing": sorted(missing)}), 400
+    
     # Проверка лимита постов
     if not anti_spam.check_rate_limit(request.remote_addr, "posts"):
         log_activity(data['userId'], "post_limit_exceeded", 
@@ -1366,9 +4977,11 @@ def api_create_post():
         "moderated": not db.get("system_settings", {}).get("content_moderation", True)
     }
     
-    db["posts"].insert(0, new_post)
+    insert_record(db, "posts", new_post)
     user["stats"]["posts"] += 1
-    save_database(db)
+    update_record(db, "users", user)
+    if duplicate_of:
+        flag_duplicate(db, "post", new_post["id"], duplicate_of)
     
     log_activity(data['userId'], "post_created", f"Post created: {new_post['id']}", request.remote_addr)
     
@@ -1378,13 +4991,137 @@ def api_create_post():
         "message": "Пост опубликован"
     })
 
+def feed_response(db, posts, next_cursor):
+    """Ответ ленты: посты с краткими данными автора"""
+    def decorate(post):
+        post = dict(post)
+        user = find_user_by_id(post["userId"], db)
+        if user:
+            post["user"] = {
+                "id": user["id"],
+                "username": user["username"],
+                "displayName": user["displayName"],
+                "emoji": user.get("emoji")
+            }
+        return post
+    
+    return jsonify({
+        "success": True,
+        "posts": [decorate(post) for post in posts],
+        "next_cursor": next_cursor
+    })
+
+def feed_page_args():
+    """(курсор, размер страницы) из параметров запроса; курсор False — неверный"""
+    limit = max(1, min(request.args.get('limit', FEED_PAGE_SIZE, type=int), FEED_MAX_PAGE_SIZE))
+    cursor_key = None
+    if request.args.get('cursor'):
+        cursor_key = decode_cursor(request.args['cursor']) or False
+    return cursor_key, limit
+
+@app.route('/api/feed', methods=['GET'])
+@spam_protection("requests")
+@read_locked
+def api_feed():
+    """Домашняя лента: свои посты и посты подписок (cursor, limit)"""
+    db = load_database()
+    user = find_user_by_id(request.args.get('userId'), db)
+    if not user:
+        return jsonify({"error": "Пользователь не найден"}), 404
+    
+    cursor_key, limit = feed_page_args()
+    if cursor_key is False:
+        return jsonify({"error": "Неверный курсор"}), 400
+    
+    posts, next_cursor = feeds.home(db, user, cursor_key, limit)
+    return feed_response(db, posts, next_cursor)
+
+@app.route('/api/users/<user_id>/posts', methods=['GET'])
+@spam_protection("requests")
+@read_locked
+def api_user_posts(user_id):
+    """Посты пользователя, видимые запрашивающему (viewerId; без него — только публичные)"""
+    db = load_database()
+    author = find_user_by_id(user_id, db)
+    if not author:
+        return jsonify({"error": "Пользователь не найден"}), 404
+    
+    cursor_key, limit = feed_page_args()
+    if cursor_key is False:
+        return jsonify({"error": "Неверный курсор"}), 400
+    
+    viewer = find_user_by_id(request.args.get('viewerId'), db)
+    posts, next_cursor = feeds.profile(db, viewer, author, cursor_key, limit)
+    return feed_response(db, posts, next_cursor)
+
+@app.route('/api/users/<user_id>/follow', methods=['POST', 'DELETE'])
+@spam_protection("requests")
+@transactional
+def api_follow(user_id):
+    """Подписка (POST) и отписка (DELETE) пользователя userId на user_id"""
+    db = load_database()
+    data = request.json
+    
+    if not data or 'userId' not in data:
+        return jsonify({"error": "Пользователь не авторизован"}), 401
+    
+    banned, reason = is_banned(user_id=data['userId'])
+    if banned:
+        return jsonify({"error": f"Аккаунт заблокирован: {reason}"}), 403
+    
+    follower = find_user_by_id(data['userId'], db)
+    author = find_user_by_id(user_id, db)
+    if not follower or not author:
+        return jsonify({"error": "Пользователь не найден"}), 404
+    
+    if follower["id"] == author["id"]:
+        return jsonify({"error": "Нельзя подписаться на себя"}), 400
+    
+    following = follower.setdefault("following", [])
+    followers = author.setdefault("followers", [])
+    if request.method == 'POST':
+        if author["id"] not in following:
+            following.append(author["id"])
+            followers.append(follower["id"])
+            update_record(db, "users", follower)
+            update_record(db, "users", author)
+            feeds.follow(db, follower, author)
+            log_activity(follower["id"], "user_followed", f"Followed {author['id']}", request.remote_addr)
+        message = "Вы подписаны"
+    else:
+        if author["id"] in following:
+            following.remove(author["id"])
+            if follower["id"] in followers:
+                followers.remove(follower["id"])
+            update_record(db, "users", follower)
+            update_record(db, "users", author)
+            feeds.unfollow(follower["id"], author["id"])
+            log_activity(follower["id"], "user_unfollowed", f"Unfollowed {author['id']}", request.remote_addr)
+        message = "Подписка отменена"
+    
+    return jsonify({
+        "success": True,
+        "following": author["id"] in following,
+        "followers_count": len(followers),
+        "message": message
+    })
+
 @app.route('/api/comments', methods=['POST'])
 @spam_protection("comments")
 def api_create_comment():
     """Создание комментария с защитой от спама"""
-    db = load_database()
     data = request.json
     
+    # Поиск почти одинаковых сообщений — до транзакции, чтобы SimHash не держал блокировку записи
+    duplicate_of = check_duplicate(data['text'], data.get('userId')) if data and 'text' in data else None
+    
+    with transaction():
+        return create_comment(data, duplicate_of)
+
+def create_comment(data, duplicate_of=None):
+    """Проверки и сохранение комментария внутри transaction()"""
+    db = load_database()
+    
     if not data:
         return jsonify({"error": "Нет данных"}), 400
     
@@ -1404,6 +5141,12 @@ def api_create_comment():
                     "Comment blocked as spam", request.remote_addr)
         return jsonify({"error": "Комментарий содержит признаки спама"}), 403
     
+    # Проверка на почти одинаковые сообщения других пользователей
+    if duplicate_of and DUPLICATE_ACTION == 'reject':
+        log_activity(data['userId'], "duplicate_comment_blocked",
+                    f"Comment duplicates {duplicate_of[0]} {duplicate_of[1]}", request.remote_addr)
+        return jsonify({"error": "Похожее сообщение уже опубликовано другим пользователем"}), 403
+    
     user = find_user_by_id(data['userId'], db)
     if not user:
         return jsonify({"error": "Пользователь не найден"}), 404
@@ -1424,16 +5167,19 @@ def api_create_comment():
         post = find_post_by_id(data['postId'], db)
         if post:
             post["comments"] += 1
+            update_record(db, "posts", post)
     elif 'videoId' in data:
         new_comment["videoId"] = data['videoId']
         video = find_video_by_id(data['videoId'], db)
         if video:
             video["comments"] += 1
+            update_record(db, "videos", video)
     else:
         return jsonify({"error": "Должен быть указан postId или videoId"}), 400
     
-    db["comments"].append(new_comment)
-    save_database(db)
+    insert_record(db, "comments", new_comment)
+    if duplicate_of:
+        flag_duplicate(db, "comment", new_comment["id"], duplicate_of)
     
     log_activity(data['userId'], "comment_created", 
                 f"Comment created: {new_comment['id']}", request.remote_addr)
@@ -1445,6 +5191,7 @@ def api_create_comment():
 
 @app.route('/api/report', methods=['POST'])
 @spam_protection("requests")
+@transactional
 def api_report():
     """Репорт контента или пользователя"""
     db = load_database()
@@ -1475,8 +5222,7 @@ def api_report():
         "createdAt": datetime.now().isoformat()
     }
     
-    db["reports"].append(new_report)
-    save_database(db)
+    insert_record(db, "reports", new_report)
     
     log_activity(data['reporterId'], "report_created", 
                 f"Report created: {data['type']} {data['targetId']}", request.remote_addr)
@@ -1494,9 +5240,7 @@ def api_report():
             "read": False,
             "data": {"reportId": new_report["id"]}
         }
-        db["notifications"].append(notification)
-    
-    save_database(db)
+        insert_record(db, "notifications", notification)
     
     return jsonify({
         "success": True,
@@ -1573,13 +5317,125 @@ def index():
         '''
 
 # Статические файлы
+class FileETagCache:
+    """Сильные ETag файлов: хэш содержимого считается один раз на версию файла"""
+    def __init__(self, max_size=MEDIA_ETAG_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # путь -> ((mtime, размер, inode), etag)
+        self.lock = threading.Lock()
+    
+    def get(self, path):
+        st = os.stat(path)
+        version = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == version:
+                self.entries.move_to_end(path)
+                return entry[1]
+        
+        if st.st_size <= MEDIA_ETAG_HASH_LIMIT:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            etag = digest.hexdigest()
+        else:
+            etag = f"{st.st_size:x}-{st.st_mtime_ns:x}-{st.st_ino:x}"
+        
+        with self.lock:
+            self.entries[path] = (version, etag)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return etag
+
+media_etags = FileETagCache()
+
+def send_media_file(directory, path):
+    """Файл с ETag, условными запросами и Range (частичные ответы 206).
+    
+    Имена-хэши содержимого кэшируются клиентом навсегда (immutable),
+    остальные — на MEDIA_MAX_AGE с последующей проверкой по ETag (304).
+    Тело отдается через wsgi.file_wrapper — сервер может использовать sendfile.
+    """
+    full_path = safe_join(os.path.abspath(directory), path)
+    if full_path is None or not os.path.isfile(full_path):
+        abort(404)
+    
+    immutable = CONTENT_ADDRESSED_RE.match(os.path.basename(full_path)) is not None
+    response = send_file(full_path, etag=media_etags.get(full_path), conditional=True,
+                         max_age=MEDIA_IMMUTABLE_MAX_AGE if immutable else MEDIA_MAX_AGE)
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
 @app.route('/media/<path:path>')
 def serve_media(path):
-    return send_from_directory(MEDIA_FOLDER, path)
+    """?size=small|medium|large — уменьшенная копия (для видео — обложка)"""
+    size = request.args.get('size')
+    if size not in MEDIA_VARIANT_SIZES or not media_kind(path):
+        return send_media_file(MEDIA_FOLDER, path)
+    
+    if os.path.isfile(variant_path(path, size)):
+        return send_media_file(MEDIA_FOLDER, media_relpath(variant_path(path, size)))
+    
+    # Копии еще нет: отдаем оригинал без долгого кэша и ставим задачу
+    response = send_media_file(MEDIA_FOLDER, path)
+    if media_jobs.status(path) is None:
+        media_jobs.enqueue(path)
+    response.cache_control.immutable = False
+    response.cache_control.max_age = None
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/media/status/<path:path>')
+def api_media_status(path):
+    """Состояние обработки файла и адреса готовых копий"""
+    job = media_jobs.status(path)
+    if job is None:
+        return jsonify({"error": "Задача не найдена"}), 404
+    job["variants"] = {name: f"/media/{path}?size={name}" for name in MEDIA_VARIANT_SIZES
+                       if os.path.isfile(variant_path(path, name))}
+    return jsonify(job)
 
 @app.route('/uploads/<path:path>')
 def serve_upload(path):
-    return send_from_directory(UPLOAD_FOLDER, path)
+    return send_media_file(UPLOAD_FOLDER, path)
+
+def benchmark_media(concurrency=8, requests_per_worker=200, file_size=32 * 1024 * 1024, chunk=1024 * 1024):
+    """Пропускная способность параллельных Range-запросов к одному видео"""
+    name = f"bench_{uuid.uuid4().hex}.bin"
+    path = os.path.join(MEDIA_FOLDER, 'videos', name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(file_size))
+    
+    def run(seed):
+        client = app.test_client()
+        rng = random.Random(seed)
+        received = 0
+        for _ in range(requests_per_worker):
+            start = rng.randrange(0, file_size - chunk)
+            response = client.get(f'/media/videos/{name}', headers={"Range": f"bytes={start}-{start + chunk - 1}"})
+            if response.status_code != 206:
+                raise RuntimeError(f"Ожидался ответ 206 на Range-запрос, получен {response.status_code}")
+            received += len(response.data)
+        return received
+    
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            total = sum(pool.map(run, range(concurrency)))
+        elapsed = time.perf_counter() - started
+    finally:
+        os.remove(path)
+    
+    requests_total = concurrency * requests_per_worker
+    return {
+        "concurrency": concurrency,
+        "requests": requests_total,
+        "requests_per_second": round(requests_total / elapsed, 1),
+        "megabytes_per_second": round(total / elapsed / 1024 / 1024, 1)
+    }
 
 # ==================== ЗАПУСК СЕРВЕРА ====================
 
@@ -1588,10 +5444,60 @@ if __name__ == '__main__':
     with app.app_context():
         init_database()
     
+    # python ap.py rescan [--reset] — повторная проверка контента на спам
+    if len(sys.argv) > 1 and sys.argv[1] == 'rescan':
+        stats = rescan_content(reset='--reset' in sys.argv)
+        print(f"Проверено: {stats['scanned']}, отмечено: {stats['flagged']}, "
+              f"{stats['items_per_second']} записей/с")
+        sys.exit(0)
+    
+    # python ap.py bench-passwords — скорость хэширования паролей
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench-passwords':
+        result = passwords.benchmark()
+        print(f"{result['scheme']} {result['params']}: {result['hashes_per_second']} хэшей/с "
+              f"({result['hashes_per_second_per_core']} на ядро, потоков: {result['threads']})")
+        sys.exit(0)
+    
+    # python ap.py gc-blobs — удаление загруженных файлов без ссылок и брошенных загрузок
+    if len(sys.argv) > 1 and sys.argv[1] == 'gc-blobs':
+        expired = upload_sessions.expire()
+        result = blobs.collect_garbage()
+        print(f"Брошенных загрузок удалено: {expired}")
+        print(f"Удалено файлов: {result['removed']}, освобождено {result['freed_bytes']} байт")
+        sys.exit(0)
+    
+    # python ap.py media-workers [процессы] — обработка очереди медиа
+    if len(sys.argv) > 1 and sys.argv[1] == 'media-workers':
+        workers = start_media_workers(int(sys.argv[2]) if len(sys.argv) > 2 else max(MEDIA_WORKERS, 1))
+        for worker in workers:
+            worker.join()
+        sys.exit(0)
+    
+    # python ap.py media-scan [--retry] — задачи для файлов, добавленных в media/ вручную
+    if len(sys.argv) > 1 and sys.argv[1] == 'media-scan':
+        queued = scan_media(retry_failed='--retry' in sys.argv)
+        print(f"Файлов проверено: {queued}, задачи: {media_jobs.counts()}")
+        sys.exit(0)
+    
+    # python ap.py bench-media [параллельность] — пропускная способность Range-запросов
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench-media':
+        result = benchmark_media(*[int(arg) for arg in sys.argv[2:3]])
+        print(f"Параллельность {result['concurrency']}: {result['requests_per_second']} запросов/с, "
+              f"{result['megabytes_per_second']} МБ/с")
+        sys.exit(0)
+    
+    # python ap.py stress-transactions [процессы потоки итерации] — проверка потерянных обновлений
+    if len(sys.argv) > 1 and sys.argv[1] == 'stress-transactions':
+        result = stress_transactions(*[int(arg) for arg in sys.argv[2:5]])
+        print(f"Транзакций: {result['expected']}, счетчик: {result['counter']}, "
+              f"комментариев: {result['comments']}, потеряно: {result['lost']}, "
+              f"{result['transactions_per_second']} транзакций/с")
+        sys.exit(1 if result['lost'] or result['comments'] != result['expected'] else 0)
+    
     print("=" * 60)
     print("🚀 ITD Social Network Server with Admin Panel")
     print("=" * 60)
-    print(f"📁 Database: {DB_FILE}")
+    print(f"📁 Database: {STORAGE_FILE}")
     print(f"📁 Media folder: {MEDIA_FOLDER}")
     print(f"📁 Logs folder: {LOGS_FOLDER}")
     print(f"🔒 Security features: Anti-spam, Rate limiting, Admin panel")
@@ -1605,5 +5511,9 @@ if __name__ == '__main__':
     print("  ⚠️ СМЕНИТЕ ПАРОЛЬ ПРИ ПЕРВОМ ВХОДЕ!")
     print("=" * 60)
     
+    # Воркеры медиа запускаются в процессе сервера, а не в наблюдателе перезагрузки
+    if MEDIA_WORKERS and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_media_workers()
+    
     # Запускаем сервер
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
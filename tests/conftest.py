@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# ap.py создает папки, базу и журналы в текущем каталоге при импорте
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='ap-tests-')
+sys.path.insert(0, ROOT)
+os.chdir(WORKDIR)
+
+import ap  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    ap.app.config['TESTING'] = True
+    with ap.app.app_context():
+        ap.init_database()
+    return ap
+
+
+@pytest.fixture(scope='session', autouse=True)
+def flush_activity_log():
+    """Остаток журнала пишется, пока текущий каталог еще WORKDIR"""
+    yield
+    ap.activity_log.close()
@@ -0,0 +1,51 @@
+from datetime import datetime
+
+import pytest
+
+SPAM = "Купите лучшие часы со скидкой только сегодня переходите по ссылке в профиле и получите подарок бесплатно"
+OTHER = "Сегодня гуляли в парке с собакой погода была отличная и мы встретили старых друзей у фонтана"
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def make_post(post_id, user_id, content):
+    return {"id": post_id, "userId": user_id, "content": content, "createdAt": datetime.now().isoformat(),
+            "comments": 0, "likes": []}
+
+
+def test_simhash_separates_near_duplicates(app_module):
+    simhash = app_module.simhash
+    assert simhash(SPAM) == simhash(SPAM.upper() + "!!!")
+    assert distance(simhash(SPAM), simhash(SPAM.replace("часы", "очки"))) <= app_module.DUPLICATE_MAX_DISTANCE
+    assert distance(simhash(SPAM), simhash(OTHER)) > app_module.DUPLICATE_MAX_DISTANCE
+    assert simhash("слишком короткий текст") is None
+
+
+def test_find_skips_same_user(app_module):
+    index = app_module.DuplicateIndex(app_module.storage)
+    index.add(app_module.simhash(SPAM), "author", ("post", "p1"))
+    
+    near = app_module.simhash(SPAM.replace("часы", "очки"))
+    assert index.find(near, "author") is None
+    assert index.find(near, "bot") == ("post", "p1")
+    assert index.find(app_module.simhash(OTHER), "bot") is None
+
+
+def test_refresh_sees_other_writers_but_not_rollbacks(app_module):
+    ap = app_module
+    index = ap.DuplicateIndex(ap.storage)
+    index.refresh()
+    
+    with pytest.raises(RuntimeError):
+        with ap.transaction() as db:
+            ap.insert_record(db, "posts", make_post("dup_rolled_back", "dup_author", SPAM))
+            raise RuntimeError("откат")
+    index.refresh()
+    assert index.find(ap.simhash(SPAM), "dup_bot") is None
+    
+    # Строка другого воркера видна только через хранилище
+    ap.storage.insert("posts", make_post("dup_committed", "dup_author", SPAM))
+    index.refresh()
+    assert index.find(ap.simhash(SPAM), "dup_bot") == ("post", "dup_committed")
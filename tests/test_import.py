@@ -0,0 +1,48 @@
+import gzip
+import io
+import json
+
+
+def export_records(ap, collection):
+    data = b"".join(ap.export_collection(collection))
+    return [json.loads(line) for line in gzip.decompress(data).decode('utf-8').splitlines() if line.strip()]
+
+
+def gzip_ndjson(records):
+    return io.BytesIO(gzip.compress(''.join(json.dumps(r) + '\n' for r in records).encode('utf-8')))
+
+
+def test_replace_import_resets_activity_log(app_module):
+    ap = app_module
+    entries = [{"timestamp": f"2030-01-01T00:00:0{i}", "user_id": "import_user",
+                "action": "import_test", "details": str(i), "ip": None} for i in range(3)]
+    ap.storage.insert_many("admin_logs", entries)
+    assert ap.activity_logs.query(action="import_test")[1] == 3
+    
+    exported = [e for e in export_records(ap, "admin_logs") if e.get("action") == "import_test"]
+    assert len(exported) == 3
+    ap.import_collection("admin_logs", gzip_ndjson(exported[:1]), replace=True)
+    
+    logs, total = ap.activity_logs.query()
+    assert total == 1
+    assert logs == exported[:1]
+    assert ap.activity_logs.query(user_id="import_user")[1] == 1
+
+
+def test_replace_import_recounts_blob_references(app_module):
+    ap = app_module
+    blob = ap.blobs.put(io.BytesIO(b"import recount image"), "image.png")
+    post = {"id": "import_post", "userId": "import_user", "content": "",
+            "createdAt": "2030-01-01T00:00:00", "comments": 0, "likes": [], "media": [blob["hash"]]}
+    with ap.transaction() as db:
+        ap.insert_record(db, "posts", post)
+    assert ap.blobs.get(blob["hash"])["refs"] == 1
+    
+    records = export_records(ap, "posts")
+    copy = dict(post, id="import_post_copy")
+    ap.import_collection("posts", gzip_ndjson(records + [copy]), replace=True)
+    assert ap.blobs.get(blob["hash"])["refs"] == 2
+    
+    ap.import_collection("posts", gzip_ndjson([r for r in records if r["id"] != "import_post"]), replace=True)
+    assert ap.blobs.get(blob["hash"])["refs"] == 0
+    assert ap.find_post_by_id("import_post", ap.load_database()) is None
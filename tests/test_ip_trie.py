@@ -0,0 +1,90 @@
+import ipaddress
+import random
+
+
+def v4(address):
+    return int(ipaddress.IPv4Address(address))
+
+
+def test_lookup_at_prefix_boundaries(app_module):
+    trie = app_module.IPPrefixTrie(32)
+    prefixes = [("10.0.0.0", 8, "a"), ("10.1.0.0", 16, "b"), ("10.1.2.0", 24, "c"), ("10.1.2.3", 32, "d")]
+    for address, length, value in prefixes:
+        trie.insert(v4(address), length, value)
+    assert trie.size == 4
+    
+    expected = {
+        "9.255.255.255": None, "10.0.0.0": "a", "10.0.255.255": "a", "10.1.0.0": "b", "10.1.2.0": "c",
+        "10.1.2.2": "c", "10.1.2.3": "d", "10.1.2.4": "c", "10.1.2.255": "c", "10.1.3.0": "b",
+        "10.1.255.255": "b", "10.2.0.0": "a", "10.255.255.255": "a", "11.0.0.0": None,
+    }
+    for address, value in expected.items():
+        assert trie.lookup(v4(address)) == value, address
+    
+    assert trie.remove(v4("10.1.2.0"), 24)
+    assert not trie.remove(v4("10.1.2.0"), 24)
+    assert not trie.remove(v4("10.0.0.0"), 9)
+    assert trie.size == 3
+    assert trie.lookup(v4("10.1.2.4")) == "b"
+    assert trie.lookup(v4("10.1.2.3")) == "d"
+    
+    # Повторная вставка меняет значение, не размер; биты за длиной префикса игнорируются
+    trie.insert(v4("10.1.99.99"), 16, "b2")
+    assert trie.size == 3
+    assert trie.lookup(v4("10.1.2.4")) == "b2"
+
+
+def test_matches_linear_scan(app_module):
+    rng = random.Random(7)
+    for bits in (32, 128):
+        trie = app_module.IPPrefixTrie(bits)
+        prefixes = {}
+        
+        def expected(address):
+            matches = [(length, value) for (key, length), value in prefixes.items()
+                       if length == 0 or address >> (bits - length) == key >> (bits - length)]
+            return max(matches)[1] if matches else None
+        
+        for step in range(600):
+            length = rng.choice([0, 1, 7, 8, bits // 2, bits - 1, bits, rng.randint(0, bits)])
+            key = rng.getrandbits(bits) & (((1 << length) - 1) << (bits - length))
+            if prefixes and rng.random() < 0.3:
+                key, length = rng.choice(list(prefixes))
+                assert trie.remove(key, length)
+                del prefixes[key, length]
+            else:
+                trie.insert(key, length, step)
+                prefixes[key, length] = step
+            assert trie.size == len(prefixes)
+            
+            for key, length in rng.sample(list(prefixes), min(3, len(prefixes))):
+                # Первый и последний адрес префикса и соседние с ними
+                last = key | ((1 << (bits - length)) - 1)
+                for address in (key, last, key - 1, last + 1):
+                    if 0 <= address < 1 << bits:
+                        assert trie.lookup(address) == expected(address)
+            address = rng.getrandbits(bits)
+            assert trie.lookup(address) == expected(address)
+
+
+def test_range_splits_into_covering_networks(app_module):
+    networks = app_module.ip_target_networks("10.0.0.5-10.0.0.20")
+    assert [str(n) for n in networks] == ["10.0.0.5/32", "10.0.0.6/31", "10.0.0.8/29", "10.0.0.16/30", "10.0.0.20/32"]
+    assert app_module.normalize_ip_target(" 2001:db8::/32 ") == "2001:db8::/32"
+    assert app_module.normalize_ip_target("10.0.0.7/32") == "10.0.0.7"
+
+
+def test_ban_ranges_and_overlapping_bans(app_module, tmp_path):
+    bans = app_module.BanManager(str(tmp_path / "bans.json"))
+    bans.add_ip_ban({"ip": "10.0.0.5-10.0.0.20", "reason": "диапазон"})
+    bans.add_ip_ban({"ip": "2001:db8::ff-2001:db8::1:0", "reason": "диапазон v6"})
+    for address, banned in (("10.0.0.4", False), ("10.0.0.5", True), ("10.0.0.13", True), ("10.0.0.20", True),
+                            ("10.0.0.21", False), ("2001:db8::fe", False), ("2001:db8::ff", True),
+                            ("2001:db8::1:0", True), ("2001:db8::1:1", False)):
+        assert bans.is_banned(ip_address=address)[0] == banned, address
+    
+    # Подсеть из другого бана остается в дереве после снятия диапазона
+    bans.add_ip_ban({"ip": "10.0.0.8/29", "reason": "подсеть"})
+    bans.remove_ip_ban("10.0.0.5-10.0.0.20")
+    assert bans.is_banned(ip_address="10.0.0.5") == (False, None)
+    assert bans.is_banned(ip_address="10.0.0.9") == (True, "подсеть")
@@ -0,0 +1,32 @@
+from ap import RateLimiter, SharedRateLimitBackend
+
+
+def test_idle_keys_with_pending_hits_are_evicted(tmp_path):
+    backend = SharedRateLimitBackend(str(tmp_path / 'ratelimits.sqlite3'))
+    limiter = RateLimiter({"requests": (60, 60)}, backend=backend)
+    start = 1_000_000.0
+    
+    for i in range(1000):
+        ip = f"10.0.{i // 256}.{i % 256}"
+        assert limiter.hit("requests", ip, now=start)
+        assert limiter.hit("requests", ip, now=start + 0.01)
+    
+    state = limiter.state["requests"]
+    assert limiter.size() == 1000
+    assert all(entry[3] == 1 for entry in state.values())  # Второй запрос учтен локально
+    
+    limiter._cleanup(start + 600)
+    assert limiter.size() == 0
+
+
+def test_evicted_key_starts_fresh(tmp_path):
+    backend = SharedRateLimitBackend(str(tmp_path / 'ratelimits.sqlite3'))
+    limiter = RateLimiter({"requests": (2, 60)}, backend=backend)
+    start = 1_000_000.0
+    
+    assert limiter.hit("requests", "1.2.3.4", now=start)
+    assert limiter.hit("requests", "1.2.3.4", now=start + 1)
+    assert not limiter.hit("requests", "1.2.3.4", now=start + 2)
+    
+    limiter._cleanup(start + 600)
+    assert limiter.hit("requests", "1.2.3.4", now=start + 600)
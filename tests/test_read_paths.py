@@ -0,0 +1,52 @@
+import contextlib
+
+import pytest
+
+
+@pytest.fixture
+def write_transactions(app_module, monkeypatch):
+    """Счетчик открытых транзакций хранилища (BEGIN IMMEDIATE)"""
+    opened = []
+    real_transaction = app_module.storage.transaction
+    
+    @contextlib.contextmanager
+    def transaction():
+        opened.append(app_module.storage._depth == 0)
+        with real_transaction() as conn:
+            yield conn
+    
+    monkeypatch.setattr(app_module.storage, "transaction", transaction)
+    return opened
+
+
+def test_rollup_reads_do_not_take_write_lock(app_module, write_transactions):
+    app_module.rollups.ensure_backfilled()
+    write_transactions.clear()
+    
+    app_module.rollups.total("posts")
+    app_module.rollups.series("posts", "2000-01-01")
+    app_module.rollups.active_users("2000-01-01T00")
+    assert not any(write_transactions)
+
+
+def test_rollups_backfill_once_after_reset(app_module, write_transactions):
+    with app_module.storage.transaction() as conn:
+        conn.execute("DELETE FROM rollups WHERE bucket = 'all' AND metric = 'backfilled'")
+    write_transactions.clear()
+    
+    app_module.rollups.total("posts")
+    assert app_module.rollups.is_backfilled()
+    write_transactions.clear()
+    app_module.rollups.total("posts")
+    assert not any(write_transactions)
+
+
+def test_home_feed_reads_do_not_take_write_lock(app_module, write_transactions):
+    db = app_module.load_database()
+    user = {"id": "feed_reader", "following": [], "followers": []}
+    app_module.feeds.home(db, user, None, 10)
+    assert app_module.feeds.is_built()
+    write_transactions.clear()
+    
+    app_module.feeds.home(db, user, None, 10)
+    assert not any(write_transactions)
@@ -0,0 +1,58 @@
+import json
+import sqlite3
+
+
+def test_rescan_chunks_survive_concurrent_deletes(app_module):
+    ap = app_module
+    db = ap.load_database()
+    ids = [f"rescan_post_{i:03d}" for i in range(30)]
+    for i, post_id in enumerate(ids):
+        ap.insert_record(db, "posts", {
+            "id": post_id, "userId": "rescan_user", "createdAt": f"2000-01-01T00:00:{i:02d}",
+            "content": "ok", "likes": []
+        })
+    
+    seen = []
+    chunks = ap.iter_rescan_chunks(db, {"posts": ("1999", "")}, 5)
+    for collection, records in chunks:
+        if collection != "posts":
+            continue
+        seen.extend(r["id"] for r in records if r["id"].startswith("rescan_post_"))
+        if len(seen) == 5:
+            # Удаление уже просмотренной и еще не просмотренной записи во время обхода
+            ap.delete_record(db, "posts", ids[0])
+            ap.delete_record(db, "posts", ids[10])
+    
+    assert seen == ids[:5] + [post_id for post_id in ids[5:] if post_id != ids[10]]
+
+
+def test_rescan_checks_reports_filed_during_scan(app_module, monkeypatch):
+    ap = app_module
+    ids = ["rescan_spam_a", "rescan_spam_b"]
+    with ap.transaction() as db:
+        for i, post_id in enumerate(ids):
+            ap.insert_record(db, "posts", {
+                "id": post_id, "userId": "rescan_user", "createdAt": f"1990-01-01T00:00:0{i}",
+                "content": "rescan spam", "likes": []
+            })
+    monkeypatch.setattr(ap, "score_texts",
+                        lambda texts: [100.0 if text == "rescan spam" else 0.0 for text in texts])
+    
+    def progress(stats):
+        if stats["scanned"] == 1:
+            # Другой воркер отправляет репорт на еще не проверенный пост
+            conn = sqlite3.connect(ap.storage.path)
+            report = {"id": "rescan_report_b", "reporterId": "SYSTEM", "targetId": ids[1], "type": "post",
+                      "reason": "spam", "status": "pending", "createdAt": "1990-01-02T00:00:00"}
+            with conn:
+                conn.execute("INSERT INTO reports (id, user_id, created_at, data) VALUES (?, ?, ?, ?)",
+                             (report["id"], None, report["createdAt"], json.dumps(report)))
+            conn.close()
+    
+    stats = ap.rescan_content(processes=0, chunk_size=1, reset=True, progress=progress)
+    assert stats["flagged"] == 1
+    
+    db = ap.load_database()
+    for post_id in ids:
+        pending = [r for r in ap.reports_for_target(post_id, db) if r.get("status") == "pending"]
+        assert len(pending) == 1
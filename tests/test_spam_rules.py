@@ -0,0 +1,58 @@
+import random
+from collections import Counter
+
+import pytest
+
+
+def occurrences(patterns, text):
+    """Вхождения каждого шаблона, включая перекрывающиеся, простым перебором"""
+    return Counter({i: sum(text.startswith(p, k) for k in range(len(text)))
+                    for i, p in enumerate(patterns)}) + Counter()
+
+
+def baseline_score(app_module, weights, text):
+    """Прежний подсчет: проход по каждому ключевому слову"""
+    text_lower = text.lower()
+    spam_score = 0
+    for keyword, weight in weights.items():
+        if keyword in text_lower:
+            spam_score += weight
+    link_count = sum(text_lower.count(marker) for marker in app_module.SPAM_LINK_MARKERS)
+    if link_count > 2:
+        spam_score += link_count
+    if any(marker in text for marker in app_module.SPAM_REPEAT_MARKERS):
+        spam_score += 2
+    return spam_score
+
+
+def test_matcher_finds_overlapping_patterns(app_module):
+    patterns = ["he", "she", "his", "hers", "e"]
+    matcher = app_module.KeywordMatcher(patterns)
+    assert Counter(matcher.find("ushers")) == Counter({1: 1, 0: 1, 3: 1, 4: 1})
+    assert Counter(matcher.find("hishers")) == occurrences(patterns, "hishers")
+
+
+def test_matcher_matches_brute_force(app_module):
+    rng = random.Random(11)
+    for _ in range(200):
+        patterns = list({''.join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 8))})
+        text = ''.join(rng.choice("abcd") for _ in range(rng.randint(0, 40)))
+        assert Counter(app_module.KeywordMatcher(patterns).find(text)) == occurrences(patterns, text)
+
+
+@pytest.mark.parametrize("text", [
+    "Обычный пост про погоду",
+    "Купить крипта бесплатно быстро и легко!!!!!",
+    "www.a.ru http://b.com https://c.com",
+    "Смотрите https://x.ru/?q=www.y.com и http://z.com......",
+    "КАЗИНО? ставки?????",
+    "деньги быстро, деньгибыстро, быстроденьги",
+])
+def test_rules_score_matches_baseline(app_module, text):
+    default = app_module.load_spam_keywords("missing-keywords.json")
+    assert app_module.SpamRules(default).score(text) == baseline_score(app_module, default, text)
+    
+    # Перекрывающиеся ключевые слова и ключевые слова внутри маркеров ссылок
+    weights = {"деньги": 1.5, "деньги быстро": 2.0, "быстро": 0.5, "ги бы": 1.0, "www.": 0.25,
+               "w.": 3.0, ".com": 1.0, "http": 0.5, "!!!": 1.0}
+    assert app_module.SpamRules(weights).score(text) == baseline_score(app_module, weights, text)
@@ -0,0 +1,148 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def blocking_log(app_module, monkeypatch):
+    """Маленькая очередь журнала с ожиданием места (LOG_QUEUE_POLICY='block')"""
+    writer = app_module.ActivityLogWriter(max_size=5, policy='block', batch_size=2, interval=0.01)
+    monkeypatch.setattr(app_module, "activity_log", writer)
+    yield writer
+    writer.close()
+
+
+def run_with_timeout(target, timeout=10):
+    errors = []
+    
+    def run():
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+    
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "взаимная блокировка"
+    if errors:
+        raise errors[0]
+
+
+def test_logging_inside_transaction_does_not_deadlock(app_module, blocking_log):
+    def handler():
+        with app_module.transaction():
+            for i in range(10):
+                app_module.log_activity("SYSTEM", "test_deadlock", f"entry {i}", "127.0.0.1")
+    
+    run_with_timeout(handler)
+    blocking_log.flush()
+    assert blocking_log.written == 10
+
+
+def test_logs_of_rolled_back_transaction_are_discarded(app_module, blocking_log):
+    def handler():
+        with pytest.raises(RuntimeError):
+            with app_module.transaction():
+                app_module.log_activity("SYSTEM", "test_rollback", "discarded", "127.0.0.1")
+                raise RuntimeError("откат")
+        app_module.log_activity("SYSTEM", "test_rollback", "kept", "127.0.0.1")
+    
+    run_with_timeout(handler)
+    blocking_log.flush()
+    assert blocking_log.written == 1
+
+
+def test_admin_password_change_hashes_outside_transaction(app_module, monkeypatch):
+    client = app_module.app.test_client()
+    response = client.post('/admin/login', data={'username': 'admin', 'password': 'admin123'})
+    assert response.status_code == 302
+    
+    user = client.post('/api/register', json={
+        'username': 'kdf_user', 'displayName': 'KDF', 'password': 'password1', 'email': 'kdf@example.org', 'emoji': 'x'
+    }).get_json()['user']
+    
+    hashed_in_transaction = []
+    real_hash = app_module.hash_password
+    
+    def hash_password(password):
+        hashed_in_transaction.append(app_module.storage._depth > 0)
+        return real_hash(password)
+    
+    monkeypatch.setattr(app_module, "hash_password", hash_password)
+    response = client.put(f"/admin/api/users/{user['id']}", json={'password': 'new-password1'})
+    assert response.status_code == 200
+    assert hashed_in_transaction == [False]
+    
+    stored = app_module.find_user_by_id(user['id'], app_module.load_database())
+    assert app_module.verify_password('new-password1', stored['password'])
+
+
+def test_concurrent_increments_are_not_lost(app_module):
+    ap = app_module
+    post = {"id": "lost_update_post", "userId": "stress", "content": "",
+            "createdAt": "2024-01-01T00:00:00", "comments": 0, "likes": []}
+    with ap.transaction() as db:
+        ap.insert_record(db, "posts", post)
+    
+    def increment():
+        for _ in range(25):
+            with ap.transaction() as db:
+                record = ap.find_post_by_id(post["id"], db)
+                record["comments"] += 1
+                ap.update_record(db, "posts", record)
+    
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert ap.storage.get("posts", post["id"])["comments"] == 100
+    assert ap.find_post_by_id(post["id"], ap.load_database())["comments"] == 100
+
+
+def test_concurrent_processes_do_not_lose_updates(app_module):
+    result = app_module.stress_transactions(processes=2, threads=2, increments=10)
+    assert result["lost"] == 0
+    assert result["comments"] == result["expected"] == 40
+
+
+def test_reads_do_not_see_uncommitted_changes(app_module, monkeypatch):
+    ap = app_module
+    client = ap.app.test_client()
+    assert client.post('/admin/login', data={'username': 'admin', 'password': 'admin123'}).status_code == 302
+    
+    reading = threading.Event()
+    changed = threading.Event()
+    release = threading.Event()
+    real_parse_fields = ap.parse_fields
+    
+    def parse_fields(value):
+        # Запрос уже получил базу; даем писателю изменить запись на месте
+        reading.set()
+        changed.wait(0.5)
+        return real_parse_fields(value)
+    
+    def writer():
+        reading.wait(10)
+        with pytest.raises(RuntimeError):
+            with ap.transaction() as db:
+                admin = ap.find_user_by_id("admin_001", db)
+                admin["displayName"] = "UNCOMMITTED"
+                changed.set()
+                release.wait(10)
+                raise RuntimeError("откат")
+    
+    monkeypatch.setattr(ap, "parse_fields", parse_fields)
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+    try:
+        response = client.get('/admin/api/users?search=admin').get_json()
+    finally:
+        release.set()
+        writer_thread.join(10)
+    
+    names = [u["displayName"] for u in response["users"]]
+    assert "UNCOMMITTED" not in names
+    assert "Администратор" in names
@@ -0,0 +1,76 @@
+import contextlib
+import hashlib
+import os
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def session(app_module):
+    data = b"resumable upload payload"
+    session = app_module.upload_sessions.create("upload_user", "clip.mp4", len(data))
+    assert app_module.upload_sessions.acquire(session["id"], 0)
+    
+    class Body:
+        def __init__(self):
+            self.chunks = [data]
+        
+        def read(self, size):
+            return self.chunks.pop() if self.chunks else b""
+    
+    session["received"] = app_module.upload_sessions.write(session, Body())
+    session["data"] = data
+    return session
+
+
+def test_transient_error_keeps_session(app_module, session, monkeypatch):
+    def put_file(*args, **kwargs):
+        raise OSError("диск недоступен")
+    
+    monkeypatch.setattr(app_module.blobs, "put_file", put_file)
+    with pytest.raises(OSError):
+        app_module.upload_sessions.complete(session, hashlib.sha256(session["data"]).hexdigest())
+    assert app_module.upload_sessions.get(session["id"]) is not None
+    
+    monkeypatch.undo()
+    blob = app_module.upload_sessions.complete(session, hashlib.sha256(session["data"]).hexdigest())
+    assert blob["size"] == len(session["data"])
+    assert app_module.upload_sessions.get(session["id"]) is None
+
+
+def test_checksum_mismatch_removes_session(app_module, session):
+    with pytest.raises(app_module.ChecksumMismatch):
+        app_module.upload_sessions.complete(session, "0" * 64)
+    assert app_module.upload_sessions.get(session["id"]) is None
+
+
+def test_failed_store_leaves_no_orphan_file(app_module, monkeypatch, tmp_path):
+    ap = app_module
+    data = b"blob that fails to commit"
+    digest = hashlib.sha256(data).hexdigest()
+    source = tmp_path / "upload.part"
+    source.write_bytes(data)
+    real_transaction = ap.storage.transaction
+    
+    @contextlib.contextmanager
+    def failing_commit():
+        outer = ap.storage._depth == 0
+        with real_transaction() as conn:
+            yield conn
+            if outer:
+                raise sqlite3.OperationalError("disk I/O error")
+    
+    monkeypatch.setattr(ap.storage, "transaction", failing_commit)
+    with pytest.raises(sqlite3.OperationalError):
+        ap.blobs.put_file(str(source), "photo.png", sha256=digest)
+    monkeypatch.undo()
+    
+    assert ap.blobs.get(digest) is None
+    assert not os.path.exists(ap.blobs.path(digest, "png"))
+    assert source.read_bytes() == data  # Файл возвращен для повторного завершения
+    
+    blob = ap.blobs.put_file(str(source), "photo.png", sha256=digest)
+    assert ap.blobs.get(digest)["size"] == len(data)
+    assert os.path.exists(ap.blobs.path(digest, "png"))
+    assert not blob["deduplicated"]